@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""Copy-on-write OpenCore bootdisks.
+
+opencore-image-ng.sh builds a complete 384M disk image, EFI folder and
+Resources included, for every config.plist. Only config.plist differs
+between the bootdisks of a fleet, so this builds the common image once
+per OpenCore version (a hash of the EFI folder, Resources and the image
+script) and gives every machine either
+
+  - a qcow2 overlay backed by that base image, holding only the clusters
+    of its config.plist, and of its directory entry when its size changes
+    (a few hundred KiB, however large the base), or
+  - a raw copy of the base (reflinked where the filesystem allows) with
+    the same bytes patched in place.
+
+config.plist is found by reading the GPT and the FAT filesystem of the
+EFI partition directly, so no guestfish or qemu tools are needed after
+the base image exists. The base config.plist is padded, so per-machine
+plists up to SLOT_HEADROOM bytes larger than the master plist fit in the
+clusters it already owns.
+
+--check reads a bootdisk the same way, following qcow2 overlays to their
+backing file, and verifies the partition table, that the FAT cluster
+chain of config.plist is exactly as long as its size needs, and that the
+file is a well-formed plist.
+
+Usage: bootdisk_factory.py --cfg config.plist --img disk.qcow2 [--base-dir dir]
+       bootdisk_factory.py --check disk.qcow2 [disk.raw...]"""
+
+import argparse
+import fcntl
+import hashlib
+import os
+import plistlib
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import uuid
+from xml.parsers.expat import ExpatError
+
+SECTOR_SIZE = 512
+ESP_TYPE = uuid.UUID('C12A7328-F81F-11D2-BA4B-00A0C93EC93B').bytes_le
+CONFIG_PATH = ('EFI', 'OC', 'config.plist')
+SLOT_HEADROOM = 16 * 1024
+FICLONE = 0x40049409
+
+QCOW_MAGIC = b'QFI\xfb'
+QCOW_CLUSTER_BITS = 16
+QCOW_COPIED = 1 << 63
+QCOW_COMPRESSED = 1 << 62
+QCOW_OFFSET_MASK = 0x00fffffffffffe00
+QCOW_EXT_BACKING_FORMAT = 0xe2792aca
+
+
+class BootdiskError(Exception):
+    pass
+
+
+class DiskImage:
+    """Read-only view of a raw or qcow2 disk image. qcow2 clusters that are
+    not allocated are read from the backing file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.backing = None
+        header = self.file.read(104)
+        if header[:4] != QCOW_MAGIC:
+            self.format = 'raw'
+            self.size = os.fstat(self.file.fileno()).st_size
+            return
+        self.format = 'qcow2'
+        (version, backing_offset, backing_size, cluster_bits, self.size, crypt,
+         l1_size, l1_offset) = struct.unpack('>IQIIQIIQ', header[4:48])
+        if version == 3 and struct.unpack('>Q', header[72:80])[0] & ~1:
+            raise BootdiskError(f'{path}: unsupported qcow2 features')
+        if crypt:
+            raise BootdiskError(f'{path}: encrypted qcow2 images are not supported')
+        self.cluster_size = 1 << cluster_bits
+        self.file.seek(l1_offset)
+        self.l1 = struct.unpack('>%dQ' % l1_size, self.file.read(8 * l1_size))
+        self.l2_cache = {}
+        if backing_offset:
+            self.file.seek(backing_offset)
+            name = self.file.read(backing_size).decode('utf-8')
+            self.backing = DiskImage(os.path.join(os.path.dirname(path), name))
+
+    def close(self):
+        self.file.close()
+        if self.backing:
+            self.backing.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _pread(self, offset, length):
+        return os.pread(self.file.fileno(), length, offset)
+
+    def _cluster(self, index):
+        # returns ('data', host offset), ('zero', None) or ('backing', None)
+        entries = self.cluster_size // 8
+        l1_index, l2_index = divmod(index, entries)
+        if l1_index >= len(self.l1) or not self.l1[l1_index] & QCOW_OFFSET_MASK:
+            return 'backing', None
+        l2 = self.l2_cache.get(l1_index)
+        if l2 is None:
+            table = self._pread(self.l1[l1_index] & QCOW_OFFSET_MASK, self.cluster_size)
+            l2 = self.l2_cache[l1_index] = struct.unpack('>%dQ' % entries, table)
+        entry = l2[l2_index]
+        if entry & QCOW_COMPRESSED:
+            raise BootdiskError(f'{self.path}: compressed clusters are not supported')
+        if entry & 1:
+            return 'zero', None
+        if entry & QCOW_OFFSET_MASK:
+            return 'data', entry & QCOW_OFFSET_MASK
+        return 'backing', None
+
+    def read(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        if self.format == 'raw':
+            return self._pread(offset, length)
+        parts = []
+        while length:
+            index, skip = divmod(offset, self.cluster_size)
+            chunk = min(length, self.cluster_size - skip)
+            kind, host = self._cluster(index)
+            if kind == 'data':
+                parts.append(self._pread(host + skip, chunk))
+            elif kind == 'backing' and self.backing:
+                parts.append(self.backing.read(offset, chunk).ljust(chunk, b'\0'))
+            else:
+                parts.append(bytes(chunk))
+            offset += chunk
+            length -= chunk
+        return b''.join(parts)
+
+
+class FatFile:
+    """Where a file lives inside a disk image: the byte offset of its
+    directory entry, its size and the byte extents of its cluster chain."""
+
+    def __init__(self, entry_offset, size, extents, partition):
+        self.entry_offset = entry_offset
+        self.size = size
+        self.extents = extents
+        self.partition = partition
+
+    @property
+    def capacity(self):
+        return sum(length for _, length in self.extents)
+
+
+class FatPartition:
+    def __init__(self, image, start):
+        self.image = image
+        self.start = start
+        boot = image.read(start, SECTOR_SIZE)
+        if len(boot) < SECTOR_SIZE or boot[510:512] != b'\x55\xaa':
+            raise BootdiskError(f'{image.path}: no FAT boot sector at offset {start}')
+        (self.sector_size, self.cluster_sectors, reserved, fats, root_entries,
+         total16, _, fat_size16) = struct.unpack('<HBHBHHBH', boot[11:24])
+        total32, fat_size32 = struct.unpack('<II', boot[32:40])
+        if not self.sector_size or not self.cluster_sectors or not fats:
+            raise BootdiskError(f'{image.path}: invalid FAT boot sector at offset {start}')
+        fat_size = fat_size16 or fat_size32
+        total = total16 or total32
+        root_sectors = (root_entries * 32 + self.sector_size - 1) // self.sector_size
+        self.fat_offset = start + reserved * self.sector_size
+        self.root_offset = self.fat_offset + fats * fat_size * self.sector_size
+        self.root_size = root_entries * 32
+        self.data_offset = self.root_offset + root_sectors * self.sector_size
+        self.cluster_size = self.cluster_sectors * self.sector_size
+        self.clusters = (total - reserved - fats * fat_size - root_sectors) // self.cluster_sectors
+        if self.clusters < 4085:
+            self.bits = 12
+        elif self.clusters < 65525:
+            self.bits = 16
+        else:
+            self.bits = 32
+        self.root_cluster = struct.unpack('<I', boot[44:48])[0] if self.bits == 32 else None
+        self.fat = image.read(self.fat_offset, fat_size * self.sector_size)
+
+    def next_cluster(self, cluster):
+        if self.bits == 12:
+            value = struct.unpack_from('<H', self.fat, cluster + cluster // 2)[0]
+            value = value >> 4 if cluster & 1 else value & 0xfff
+            return None if value >= 0xff8 else value
+        if self.bits == 16:
+            value = struct.unpack_from('<H', self.fat, cluster * 2)[0]
+            return None if value >= 0xfff8 else value
+        value = struct.unpack_from('<I', self.fat, cluster * 4)[0] & 0x0fffffff
+        return None if value >= 0x0ffffff8 else value
+
+    def chain(self, cluster):
+        """Byte extents of a cluster chain, merging contiguous clusters"""
+        extents = []
+        seen = set()
+        while cluster is not None:
+            if cluster < 2 or cluster >= self.clusters + 2 or cluster in seen:
+                raise BootdiskError(f'{self.image.path}: broken FAT chain at cluster {cluster}')
+            seen.add(cluster)
+            offset = self.data_offset + (cluster - 2) * self.cluster_size
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + self.cluster_size)
+            else:
+                extents.append((offset, self.cluster_size))
+            cluster = self.next_cluster(cluster)
+        return extents
+
+    def entries(self, extents):
+        # yields (long or short name, entry offset, attributes, first cluster, size)
+        long_name = []
+        for offset, length in extents:
+            data = self.image.read(offset, length)
+            for position in range(0, len(data) - 31, 32):
+                entry = data[position:position + 32]
+                if entry[0] == 0:
+                    return
+                if entry[0] == 0xe5:
+                    long_name = []
+                    continue
+                if entry[11] == 0x0f:
+                    part = entry[1:11] + entry[14:26] + entry[28:32]
+                    if entry[0] & 0x40:
+                        long_name = []
+                    long_name.insert(0, part)
+                    continue
+                if long_name:
+                    name = b''.join(long_name).decode('utf-16-le', 'replace')
+                    name = name.split('\0', 1)[0]
+                else:
+                    base = entry[:8].decode('ascii', 'replace').rstrip()
+                    extension = entry[8:11].decode('ascii', 'replace').rstrip()
+                    name = base + ('.' + extension if extension else '')
+                long_name = []
+                high, low, size = struct.unpack('<H4xHI', entry[20:32])
+                yield name, offset + position, entry[11], high << 16 | low, size
+
+    def find(self, path):
+        if self.bits == 32:
+            extents = self.chain(self.root_cluster)
+        else:
+            extents = [(self.root_offset, self.root_size)]
+        for depth, part in enumerate(path):
+            for name, entry_offset, attributes, cluster, size in self.entries(extents):
+                if name.lower() == part.lower():
+                    break
+            else:
+                raise BootdiskError(f"{self.image.path}: {'/'.join(path[:depth + 1])} not found")
+            extents = self.chain(cluster) if cluster else []
+        if attributes & 0x10:
+            raise BootdiskError(f"{self.image.path}: {'/'.join(path)} is a directory")
+        return FatFile(entry_offset, size, extents, self)
+
+
+def esp_offset(image):
+    """Byte offset of the EFI system partition, or 0 for a bare FAT image"""
+    header = image.read(SECTOR_SIZE, 92)
+    if header[:8] != b'EFI PART':
+        return 0
+    entries_lba, count, entry_size = struct.unpack('<QII', header[72:88])
+    table = image.read(entries_lba * SECTOR_SIZE, count * entry_size)
+    for index in range(count):
+        entry = table[index * entry_size:(index + 1) * entry_size]
+        if entry[:16] == ESP_TYPE:
+            return struct.unpack('<Q', entry[32:40])[0] * SECTOR_SIZE
+    raise BootdiskError(f'{image.path}: no EFI system partition')
+
+
+def locate_config(image):
+    return FatPartition(image, esp_offset(image)).find(CONFIG_PATH)
+
+
+def config_patches(image, location, config):
+    """Returns {offset: bytes} writes that put config into the clusters the
+    base image already allocated for config.plist.
+
+    The file has to keep needing every cluster of its chain, or fsck
+    truncates the chain and firmware that follows it reads NULs after the
+    plist. So config is padded with whitespace, which is valid after
+    </plist>, up to the size the base image recorded; the size in the
+    directory entry only changes if config is longer than that."""
+    if len(config) > location.capacity:
+        raise BootdiskError(f'config.plist is {len(config)} bytes, but the base image only '
+                            f'has room for {location.capacity}; rebuild the base image')
+    cluster_size = location.partition.cluster_size
+    size = max(len(config), location.size, location.capacity - cluster_size + 1)
+    if size > len(config):
+        config += b' ' * (size - len(config) - 1) + b'\n'
+    patches = {}
+    position = 0
+    for offset, length in location.extents:
+        patches[offset] = config[position:position + length].ljust(length, b'\0')
+        position += length
+    if size != location.size:
+        entry = bytearray(image.read(location.entry_offset, 32))
+        struct.pack_into('<I', entry, 28, size)
+        patches[location.entry_offset] = bytes(entry)
+    return patches
+
+
+def write_overlay(base, output_path, patches):
+    """Writes a qcow2 overlay of base that only allocates the clusters the
+    patches touch. The backing file is recorded relative to the overlay."""
+    cluster_size = 1 << QCOW_CLUSTER_BITS
+    touched = {}
+    for offset, data in sorted(patches.items()):
+        end = offset + len(data)
+        for index in range(offset // cluster_size, (end - 1) // cluster_size + 1):
+            if index not in touched:
+                touched[index] = bytearray(base.read(index * cluster_size, cluster_size)
+                                           .ljust(cluster_size, b'\0'))
+            start = max(offset, index * cluster_size)
+            stop = min(end, (index + 1) * cluster_size)
+            touched[index][start - index * cluster_size:stop - index * cluster_size] = \
+                data[start - offset:stop - offset]
+
+    entries = cluster_size // 8
+    l1_size = max(1, -(-base.size // (cluster_size * entries)))
+    l2_indexes = sorted({index // entries for index in touched})
+    # cluster 0 header, then the L1 table, the refcount table, one refcount
+    # block, the L2 tables and the data clusters
+    l1_clusters = -(-l1_size * 8 // cluster_size)
+    refcount_table = (1 + l1_clusters) * cluster_size
+    refcount_block = refcount_table + cluster_size
+    l2_start = 3 + l1_clusters
+    data_start = l2_start + len(l2_indexes)
+    total_clusters = data_start + len(touched)
+    if total_clusters > cluster_size // 2:
+        raise BootdiskError('too many clusters for a single refcount block')
+
+    backing_name = os.path.relpath(os.path.abspath(base.path),
+                                   os.path.dirname(os.path.abspath(output_path)))
+    backing_format = base.format.encode('ascii')
+    extension = struct.pack('>II', QCOW_EXT_BACKING_FORMAT, len(backing_format))
+    extension += backing_format.ljust(-(-len(backing_format) // 8) * 8, b'\0')
+    extension += struct.pack('>II', 0, 0)
+    backing_offset = 104 + len(extension)
+    header = QCOW_MAGIC + struct.pack(
+        '>IQIIQIIQQIIQQQQII', 3, backing_offset, len(backing_name.encode('utf-8')),
+        QCOW_CLUSTER_BITS, base.size, 0, l1_size, cluster_size, refcount_table, 1,
+        0, 0, 0, 0, 0, 4, 104)
+    header += extension + backing_name.encode('utf-8')
+    if len(header) > cluster_size:
+        raise BootdiskError('backing file name too long')
+
+    l1 = [0] * l1_size
+    l2_tables = {}
+    for position, l1_index in enumerate(l2_indexes):
+        l1[l1_index] = (l2_start + position) * cluster_size | QCOW_COPIED
+        l2_tables[l1_index] = [0] * entries
+    for position, index in enumerate(sorted(touched)):
+        l1_index, l2_index = divmod(index, entries)
+        l2_tables[l1_index][l2_index] = (data_start + position) * cluster_size | QCOW_COPIED
+
+    refcounts = struct.pack('>%dH' % total_clusters, *([1] * total_clusters))
+    tmp_path = output_path + '.partial'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(cluster_size, b'\0'))
+        f.write(struct.pack('>%dQ' % l1_size, *l1).ljust(l1_clusters * cluster_size, b'\0'))
+        f.write(struct.pack('>Q', refcount_block).ljust(cluster_size, b'\0'))
+        f.write(refcounts.ljust(cluster_size, b'\0'))
+        for l1_index in l2_indexes:
+            f.write(struct.pack('>%dQ' % entries, *l2_tables[l1_index]))
+        for index in sorted(touched):
+            f.write(touched[index])
+    os.replace(tmp_path, output_path)
+
+
+def write_raw(base, output_path, patches):
+    """Copies a raw base image, reflinked where possible, and patches it"""
+    if base.format != 'raw':
+        raise BootdiskError('raw bootdisks need a raw base image')
+    tmp_path = output_path + '.partial'
+    with open(base.path, 'rb') as source, open(tmp_path, 'wb') as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+        except OSError:
+            shutil.copyfileobj(source, dest, 1 << 20)
+        for offset, data in patches.items():
+            os.pwrite(dest.fileno(), data, offset)
+    os.replace(tmp_path, output_path)
+
+
+def tree_digest(digest, path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+
+
+class BootdiskFactory:
+    """Builds base images with opencore-image-ng.sh, keyed by the OpenCore
+    files that go into them, and stamps out per-machine bootdisks"""
+
+    def __init__(self, base_dir, work_dir='.'):
+        self.base_dir = base_dir
+        self.work_dir = work_dir
+        self.bases = {}
+
+    def base_key(self, slot_size):
+        digest = hashlib.sha256(b'%d\0' % slot_size)
+        for name in ('EFI', 'resources/OcBinaryData/Resources'):
+            tree_digest(digest, os.path.join(self.work_dir, name))
+        for name in ('startup.nsh', 'opencore-image-ng.sh'):
+            path = os.path.join(self.work_dir, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()[:16]
+
+    def base_image(self, master_config):
+        """Returns the base image for configs shaped like master_config,
+        building it if this OpenCore version has none yet"""
+        # rounded up, so that every config rendered from the same master
+        # plist maps to the same base image
+        slot_size = -(-(len(master_config) + SLOT_HEADROOM) // SLOT_HEADROOM) * SLOT_HEADROOM
+        key = self.base_key(slot_size)
+        if key in self.bases:
+            return self.bases[key]
+        os.makedirs(self.base_dir, exist_ok=True)
+        path = os.path.join(self.base_dir, f'OpenCore-{key}.raw')
+        with open(os.path.join(self.base_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                print(f"Building base bootdisk {path}")
+                with tempfile.NamedTemporaryFile(suffix='.plist') as config:
+                    # trailing whitespace after </plist> keeps it valid
+                    config.write(master_config.ljust(slot_size - 1) + b'\n')
+                    config.flush()
+                    partial = os.path.join(self.base_dir, f'OpenCore-{key}.partial.raw')
+                    subprocess.run([os.path.join(self.work_dir, 'opencore-image-ng.sh'),
+                                    '--cfg', config.name, '--img', os.path.abspath(partial)],
+                                   cwd=self.work_dir, check=True)
+                os.replace(partial, path)
+        base = DiskImage(path)
+        self.bases[key] = (base, locate_config(base))
+        return self.bases[key]
+
+    def make(self, config, output_path, master_config=None):
+        base, location = self.base_image(master_config or config)
+        patches = config_patches(base, location, config)
+        if output_path.endswith(('.raw', '.img')):
+            write_raw(base, output_path, patches)
+        else:
+            write_overlay(base, output_path, patches)
+
+
+def check_bootdisk(path, expected=None):
+    """Returns the problems found in a bootdisk, or an empty list"""
+    try:
+        with DiskImage(path) as image:
+            location = locate_config(image)
+            cluster_size = location.partition.cluster_size
+            if -(-location.size // cluster_size) * cluster_size != location.capacity:
+                return [f'config.plist is {location.size} bytes but its cluster chain '
+                        f'holds {location.capacity}']
+            config = b''.join(image.read(offset, length)
+                              for offset, length in location.extents)[:location.size]
+    except (OSError, BootdiskError, struct.error) as err:
+        return [str(err)]
+    problems = []
+    try:
+        plistlib.loads(config[max(config.find(b'<?xml'), 0):])
+    except (ExpatError, ValueError) as err:
+        problems.append(f'config.plist is not a valid plist: {err}')
+    # config_patches() pads the file with whitespace to fill its chain
+    if expected is not None and (config[:len(expected)] != expected or
+                                 config[len(expected):].strip()):
+        problems.append('config.plist differs from the expected file')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Make OpenCore bootdisks as overlays of a shared base image.')
+    parser.add_argument('--cfg', help='config.plist to put on the bootdisk')
+    parser.add_argument('--img', help='bootdisk to write; .raw or .img for a patched raw '
+                                      'copy, anything else for a qcow2 overlay')
+    parser.add_argument('--base-dir', default='./bootdisks/base',
+                        help='where base images are kept (default: ./bootdisks/base)')
+    parser.add_argument('--master-plist',
+                        help='master plist the base image is sized for (default: --cfg)')
+    parser.add_argument('--check', nargs='+', metavar='IMAGE',
+                        help='check bootdisks offline, against --cfg if given')
+    args = parser.parse_args()
+
+    if args.check:
+        expected = None
+        if args.cfg:
+            with open(args.cfg, 'rb') as f:
+                expected = f.read()
+        failed = False
+        for path in args.check:
+            problems = check_bootdisk(path, expected)
+            print(f"{path}: {'; '.join(problems) if problems else 'ok'}")
+            failed = failed or bool(problems)
+        sys.exit(1 if failed else 0)
+
+    if not args.cfg or not args.img:
+        parser.error('--cfg and --img are required unless --check is given')
+    with open(args.cfg, 'rb') as f:
+        config = f.read()
+    master = None
+    if args.master_plist:
+        with open(args.master_plist, 'rb') as f:
+            master = f.read()
+    try:
+        BootdiskFactory(args.base_dir).make(config, args.img, master)
+    except BootdiskError as err:
+        print(f"Error: {err}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
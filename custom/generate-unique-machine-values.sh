@@ -52,6 +52,11 @@ Defaults:
     - if you set --custom-plist, --plists is assumed
     - if you set --output-env, --envs is assumed
 
+Environment:
+    USE_PYTHON=1                    Generate with generate_unique_machine_values.py,
+                                    which takes the same options and renders
+                                    many plists faster. Needs python3.
+
 Author:  Sick.Codes https://sick.codes/
 Project: https://github.com/sickcodes/osx-serial-generator/
 License: GPLv3+
@@ -60,6 +65,9 @@ License: GPLv3+
 OPENCORE_IMAGE_MAKER_URL='https://raw.githubusercontent.com/sickcodes/osx-serial-generator/master/opencore-image-ng.sh'
 MASTER_PLIST_URL='https://raw.githubusercontent.com/sickcodes/osx-serial-generator/master/config-nopicker-custom.plist'
 
+# kept for the in-process generator, which parses them itself
+SCRIPT_ARGS=("$@")
+
 # gather arguments
 while (( "$#" )); do
     case "${1}"  in
@@ -167,6 +175,17 @@ while (( "$#" )); do
                 shift
             ;;
 
+    --kernel-args=* )
+                export KERNEL_ARGS="${1#*=}"
+                shift
+            ;;
+
+    --kernel-args* )
+                export KERNEL_ARGS="${2}"
+                shift
+                shift
+            ;;
+
     --master-plist-url=* | --input-plist-url=* | --custom-plist-url=* )
                 export MASTER_PLIST_URL="${1#*=}"
                 shift
@@ -372,6 +391,11 @@ EOF
 }
 
 main () {
+    # the in-process generator takes the same options and prints the same
+    # output, but is opt-in until it has replaced the shell loop below
+    if [ -n "${USE_PYTHON}" ]; then
+        exec python3 "$(dirname "$0")/generate_unique_machine_values.py" "${SCRIPT_ARGS[@]}"
+    fi
     # setting default variables if there are no options
     export DATE_NOW="$(date +%F-%T)"
     export DEVICE_MODEL="${DEVICE_MODEL:=iMacPro1,1}"
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+#   ___  _____  __  ___          _      _    ___                       _
+#  / _ \/ __\ \/ / / __| ___ _ _(_)__ _| |  / __|___ _ _  ___ _ _ __ _| |_ ___ _ _
+# | (_) \__ \>  <  \__ \/ -_) '_| / _` | | | (_ / -_) ' \/ -_) '_/ _` |  _/ _ \ '_|
+#  \___/|___/_/\_\ |___/\___|_| |_\__,_|_|  \___\___|_||_\___|_| \__,_|\__\___/_|
+#
+# Repo:             https://github.com/sickcodes/osx-serial-generator/
+# Title:            OSX Serial Generator
+# Author:           Sick.Codes https://sick.codes/
+# Version:          3.1
+# License:          GPLv3+
+"""In-process version of generate-unique-machine-values.sh.
+
+Takes the same options and writes the same CSV, TSV, env and config.plist
+files, but runs macserial once for the whole batch and does everything
+else in this process: the vendor MAC table is read and indexed once, and
+UUIDs, MAC addresses and output rows are generated in bulk and written
+with buffered writes.
+
+Options not given on the command line fall back to the environment
+variables generate-unique-machine-values.sh exports, so the shell script
+can hand its whole configuration over to this module."""
+
+import argparse
+import csv
+import io
+import os
+import plistlib
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from xml.parsers.expat import ExpatError
+from xml.sax.saxutils import escape
+
+OPENCORE_IMAGE_MAKER_URL = 'https://raw.githubusercontent.com/sickcodes/osx-serial-generator/master/opencore-image-ng.sh'
+MASTER_PLIST_URL = 'https://raw.githubusercontent.com/sickcodes/osx-serial-generator/master/config-nopicker-custom.plist'
+MAC_ADDRESSES_URL = 'https://gitlab.com/wireshark/wireshark/-/raw/master/manuf'
+
+FIELDS = ['DEVICE_MODEL', 'SERIAL', 'BOARD_SERIAL', 'UUID', 'MAC_ADDRESS', 'WIDTH', 'HEIGHT', 'KERNEL_ARGS']
+ENV_FIELDS = FIELDS[:-1]
+PLACEHOLDERS = ('DEVICE_MODEL', 'SERIAL', 'BOARD_SERIAL', 'UUID', 'ROM', 'WIDTH', 'HEIGHT',
+                'KERNEL_ARGS')
+PLACEHOLDER_PATTERN = re.compile(r'<!--.*?-->|\{\{(?P<key>%s)\}\}' % '|'.join(PLACEHOLDERS),
+                                 re.DOTALL)
+# below this many plists, starting worker processes costs more than it saves
+PARALLEL_PLISTS = 16
+
+HELP_TEXT = """Usage: ./generate_unique_machine_values.py
+
+General options:
+    --count, -n, -c <count>         Number of serials to generate
+    --model, -m <model>             Device model, e.g. 'iMacPro1,1'
+    --csv <filename>                Optionally change the CSV output filename
+    --tsv <filename>                Optionally change the TSV output filename
+    --output-dir <directory>        Optionally change the script output location
+    --width <string>                Resolution x axis length in px, default 1920
+    --height <string>               Resolution y axis length in px, default 1080
+    --kernel-args <string>          Additional boot-args
+    --input-plist-url <url>         Specify an alternative master plist, via URL
+    --master-plist-url <url>        Same as above.
+    --custom-plist <filename>       Optionally change the input plist.
+    --master-plist <filename>       Same as above.
+    --output-bootdisk <filename>    Optionally change the bootdisk filename
+    --create-envs, --envs           Create all corresponding sourcable envs
+    --create-plists, --plists       Create all corresponding config.plists
+    --create-bootdisks, --bootdisks Create all corresponding bootdisks
+    --jobs <count>                  Processes rendering plists, default one per CPU
+    --help, -h, help                Display this help and exit
+
+Additional options only if you are creating ONE serial set:
+    --output-bootdisk <filename>    Optionally change the bootdisk filename
+    --output-env <filename>         Optionally change the serials env filename
+
+Custom plist placeholders:
+    {{DEVICE_MODEL}}, {{SERIAL}}, {{BOARD_SERIAL}},
+    {{UUID}}, {{ROM}}, {{WIDTH}}, {{HEIGHT}}, {{KERNEL_ARGS}}
+
+Example:
+    ./generate_unique_machine_values.py --count 1 --plists --bootdisks --envs
+
+Defaults:
+    - One serial, for 'iMacPro1,1', in the current working directory
+    - CSV and TSV output
+    - plists in ./plists/ & bootdisks in ./bootdisks/ & envs in ./envs
+    - if you set --bootdisk name, --bootdisks is assumed
+    - if you set --custom-plist, --plists is assumed
+    - if you set --output-env, --envs is assumed
+
+Author:  Sick.Codes https://sick.codes/
+Project: https://github.com/sickcodes/osx-serial-generator/
+License: GPLv3+
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(add_help=False, usage=argparse.SUPPRESS)
+    env = os.environ.get
+    parser.add_argument('--help', '-h', action='store_true')
+    parser.add_argument('--count', '-c', '-n', default=env('SERIAL_SET_COUNT', '1'))
+    parser.add_argument('--model', '-m', default=env('DEVICE_MODEL', 'iMacPro1,1'))
+    parser.add_argument('--csv', default=env('CSV_OUTPUT_FILENAME'))
+    parser.add_argument('--tsv', default=env('TSV_OUTPUT_FILENAME'))
+    parser.add_argument('--output-dir', default=env('OUTPUT_DIRECTORY', '.'))
+    parser.add_argument('--output-bootdisk', default=env('OUTPUT_BOOTDISK'))
+    parser.add_argument('--output-env', default=env('OUTPUT_ENV'))
+    parser.add_argument('--width', default=env('WIDTH') or '1920')
+    parser.add_argument('--height', default=env('HEIGHT') or '1080')
+    parser.add_argument('--kernel-args', default=env('KERNEL_ARGS', ''))
+    parser.add_argument('--master-plist-url', '--input-plist-url', '--custom-plist-url',
+                        dest='master_plist_url', default=env('MASTER_PLIST_URL'))
+    parser.add_argument('--master-plist', '--input-plist', '--custom-plist',
+                        dest='master_plist', default=env('MASTER_PLIST'))
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--create-plists', '--plists', dest='create_plists',
+                        action='store_true', default=bool(env('CREATE_PLISTS')))
+    parser.add_argument('--create-bootdisks', '--bootdisks', dest='create_bootdisks',
+                        action='store_true', default=bool(env('CREATE_BOOTDISKS')))
+    parser.add_argument('--create-envs', '--envs', dest='create_envs',
+                        action='store_true', default=bool(env('CREATE_ENVS')))
+    # the shell script accepts -c=5 as well as --count=5
+    argv = [part for arg in argv
+            for part in (arg.split('=', 1) if re.match(r'^-[a-z]=', arg) else [arg])]
+    args, unknown = parser.parse_known_args(argv)
+    for arg in unknown:
+        if arg in ('help', 'h'):
+            args.help = True
+        else:
+            print("Invalid option. Running with default values...")
+    return args
+
+
+def build_mac_serial():
+    if not os.path.isdir('./OpenCorePkg'):
+        subprocess.run(['git', 'clone', '--depth', '1',
+                        'https://github.com/acidanthera/OpenCorePkg.git'], check=True)
+    subprocess.run(['make', '-C', './OpenCorePkg/Utilities/macserial/'], check=True)
+    shutil.move('./OpenCorePkg/Utilities/macserial/macserial', './macserial')
+    os.chmod('./macserial', 0o755)
+
+
+def download(url, path):
+    with urllib.request.urlopen(url) as response, open(path, 'wb') as f:
+        shutil.copyfileobj(response, f)
+
+
+def load_vendor_prefixes(path, vendor_regex):
+    """Reads the Wireshark manuf table once and returns the 24-bit MAC
+    prefixes of every vendor line matching vendor_regex"""
+    pattern = re.compile(vendor_regex)
+    prefixes = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if pattern.search(line):
+                prefix = line.split('\t', 1)[0].strip()
+                # /28 and /36 blocks can not take three random octets
+                if re.match(r'^[0-9A-Fa-f]{2}([:-][0-9A-Fa-f]{2}){2}$', prefix):
+                    prefixes.append(prefix.replace('-', ':').upper())
+    if not prefixes:
+        raise SystemExit(f"No vendor MAC prefixes matching {vendor_regex!r} in {path}")
+    return prefixes
+
+
+def mac_serials(count, model):
+    # one macserial run for the whole batch; lines are "SERIAL | BOARD_SERIAL"
+    output = subprocess.run(['./macserial', '--num', str(count), '--model', model],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    for line in output.splitlines():
+        parts = line.split('|')
+        if len(parts) == 2:
+            yield parts[0].strip(), parts[1].strip()
+
+
+def generate_rows(serials, args, prefixes, rng):
+    for serial, board_serial in serials:
+        yield {
+            'DEVICE_MODEL': args.model,
+            'SERIAL': serial,
+            'BOARD_SERIAL': board_serial,
+            'UUID': str(uuid.uuid4()).upper(),
+            'MAC_ADDRESS': '%s:%02X:%02X:%02X' % (rng.choice(prefixes), rng.randrange(256),
+                                                  rng.randrange(256), rng.randrange(256)),
+            'WIDTH': args.width,
+            'HEIGHT': args.height,
+            'KERNEL_ARGS': args.kernel_args,
+        }
+
+
+class PlistTemplate:
+    """A master plist compiled once into alternating literal text and
+    placeholder slots, so that rendering a serial set is a single join.
+
+    Placeholders inside XML comments are left as they are: the master
+    plists describe their placeholders in a header comment, and a value
+    there can not be escaped."""
+
+    def __init__(self, text):
+        self.source = text
+        self.literals = []
+        self.keys = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            if match.group('key'):
+                self.literals.append(text[position:match.start()])
+                self.keys.append(match.group('key'))
+                position = match.end()
+        self.literals.append(text[position:])
+
+    def render(self, row):
+        values = dict(row, ROM=row['MAC_ADDRESS'].replace(':', '').lower())
+        values = {key: escape(values[key]) for key in set(self.keys)}
+        parts = [self.literals[0]]
+        for key, literal in zip(self.keys, self.literals[1:]):
+            parts.append(values[key])
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def validate_plist(text):
+    """Raises ValueError unless text is a well-formed property list. The
+    master plists carry comments before the XML declaration, which are
+    skipped here just like OpenCore does."""
+    data = text[max(text.find('<?xml'), 0):].encode('utf-8')
+    try:
+        plistlib.loads(data)
+    except ExpatError as err:
+        raise ValueError(str(err))
+
+
+_template = None
+
+
+def _set_template(template):
+    global _template
+    _template = template
+
+
+def render_plist_file(path, row, template=None):
+    """Renders, validates and writes one config.plist. Returns an error
+    message instead of writing an invalid plist."""
+    text = (template or _template).render(row)
+    try:
+        validate_plist(text)
+    except ValueError as err:
+        return f"Invalid plist for {row['SERIAL']}: {err}"
+    with open(path, 'w') as f:
+        f.write(text)
+    return None
+
+
+def _render_plist_file(item):
+    return render_plist_file(*item)
+
+
+def render_plists(template, items, jobs=None):
+    """Renders (path, row) items, in worker processes when there are enough
+    of them to be worth it. Returns the error messages."""
+    # the first plist checks the template itself, so that a broken template
+    # gives one error instead of one per plist
+    error = render_plist_file(*items[0], template)
+    if error:
+        return [error]
+    items = items[1:]
+    if jobs == 1 or len(items) < PARALLEL_PLISTS:
+        errors = [render_plist_file(path, row, template) for path, row in items]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_set_template,
+                                 initargs=(template,)) as pool:
+            chunksize = max(1, len(items) // ((jobs or os.cpu_count() or 1) * 4))
+            errors = list(pool.map(_render_plist_file, items, chunksize=chunksize))
+    return [error for error in errors if error]
+
+
+def master_plist(args):
+    if args.master_plist:
+        if not os.path.exists(args.master_plist):
+            print(f"Could not find: {args.master_plist}", file=sys.stderr)
+            sys.exit(1)
+        return args.master_plist
+    if args.master_plist_url:
+        path = './config-custom.plist'
+        download(args.master_plist_url, path)
+    else:
+        # default is config-nopicker-custom.plist from OSX-KVM with placeholders used in Docker-OSX
+        path = './config-nopicker-custom.plist'
+        download(MASTER_PLIST_URL, path)
+    return path
+
+
+def download_qcow_efi_folder():
+    efi_folder = './OpenCore/EFI'
+    resources_folder = './resources/OcBinaryData/Resources'
+    # check if we are inside OSX-KVM already
+    # if not, download OSX-KVM locally
+    if not os.path.isdir(efi_folder):
+        if not os.path.isdir('./OSX-KVM'):
+            subprocess.run(['git', 'clone', '--recurse-submodules', '--depth', '1',
+                            'https://github.com/kholia/OSX-KVM.git'], check=True)
+        efi_folder = os.path.join('./OSX-KVM', efi_folder)
+    if not os.path.isdir(resources_folder):
+        resources_folder = os.path.join('./OSX-KVM', resources_folder)
+    # EFI Shell commands
+    with open('startup.nsh', 'w') as f:
+        f.write('fs0:\\EFI\\BOOT\\BOOTx64.efi\n')
+    shutil.copytree(efi_folder, './EFI', symlinks=True, dirs_exist_ok=True)
+    # copy Apple drivers into EFI/OC/Resources
+    shutil.copytree(resources_folder, './EFI/OC/Resources', symlinks=True, dirs_exist_ok=True)
+
+
+def write_serial_sets(rows, args, csv_path, tsv_path):
+    """Writes every output of a batch. rows is consumed once."""
+    create_env = (args.create_envs or args.create_plists or args.create_bootdisks
+                  or args.output_bootdisk or args.output_env)
+    create_plist = args.create_plists or args.create_bootdisks
+    create_bootdisk = args.create_bootdisks or args.output_bootdisk
+    template = None
+    if create_plist:
+        with open(master_plist(args)) as f:
+            template = PlistTemplate(f.read())
+    if create_env:
+        os.makedirs(os.path.join(args.output_dir, 'envs'), exist_ok=True)
+    if create_plist:
+        os.makedirs(os.path.join(args.output_dir, 'plists'), exist_ok=True)
+    if create_bootdisk:
+        if not os.path.exists('./opencore-image-ng.sh'):
+            download(OPENCORE_IMAGE_MAKER_URL, './opencore-image-ng.sh')
+            os.chmod('./opencore-image-ng.sh', 0o755)
+        os.makedirs(os.path.join(args.output_dir, 'bootdisks'), exist_ok=True)
+
+    count = 0
+    plists = []
+    # every row is echoed the way the shell script's tee did
+    csv_line = io.StringIO()
+    csv_writer = csv.writer(csv_line, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    with open(csv_path, 'a', newline='', buffering=1 << 20) as csv_file, \
+            open(tsv_path, 'a', buffering=1 << 20) as tsv_file:
+        for row in rows:
+            count += 1
+            csv_line.seek(0)
+            csv_line.truncate()
+            csv_writer.writerow([row[field] for field in FIELDS])
+            tsv_row = '\t'.join(row[field] for field in FIELDS) + '\n'
+            csv_file.write(csv_line.getvalue())
+            tsv_file.write(tsv_row)
+            sys.stdout.write(f"{csv_line.getvalue()}Wrote CSV to: {csv_path}\n"
+                             f"{tsv_row}Wrote TSV to: {tsv_path}\n")
+            serial = row['SERIAL']
+            if create_env:
+                env_path = args.output_env or os.path.join(args.output_dir, 'envs',
+                                                           f'{serial}.env.sh')
+                with open(env_path, 'w') as f:
+                    f.write(''.join(f'export {field}="{row[field]}"\n' for field in ENV_FIELDS))
+            if create_plist:
+                plists.append((os.path.join(args.output_dir, 'plists', f'{serial}.config.plist'),
+                               row))
+
+    if plists:
+        errors = render_plists(template, plists, args.jobs)
+        for error in errors:
+            print(error)
+        if errors:
+            sys.exit(1)
+    if create_bootdisk:
+        # opencore-image-ng.sh builds one base image per OpenCore version,
+        # every bootdisk is a qcow2 overlay that only swaps in config.plist
+        from bootdisk_factory import BootdiskError, BootdiskFactory
+        factory = BootdiskFactory(os.path.join(args.output_dir, 'bootdisks', 'base'))
+        master = template.source.encode('utf-8')
+        try:
+            for plist_path, row in plists:
+                with open(plist_path, 'rb') as f:
+                    config = f.read()
+                factory.make(config, args.output_bootdisk or os.path.join(
+                    args.output_dir, 'bootdisks', f"{row['SERIAL']}.OpenCore-nopicker.qcow2"),
+                    master)
+        except BootdiskError as err:
+            print(f"Error: {err}")
+            sys.exit(1)
+    return count
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.help:
+        print(HELP_TEXT)
+        return
+    if args.output_bootdisk:
+        args.create_bootdisks = True
+    if args.master_plist:
+        args.create_plists = True
+    if args.output_env:
+        args.create_envs = True
+
+    date_now = time.strftime('%Y-%m-%d-%H:%M:%S')
+    print(f"DEVICE_MODEL:       {args.model}\n"
+          f"SERIAL_SET_COUNT:   {args.count}\n"
+          f"OUTPUT_DIRECTORY:   {args.output_dir}")
+    os.makedirs(args.output_dir, exist_ok=True)
+    if not os.path.exists('./macserial'):
+        build_mac_serial()
+    mac_addresses_file = os.environ.get('MAC_ADDRESSES_FILE', 'vendor_macs.tsv')
+    if not os.path.exists(mac_addresses_file):
+        download(MAC_ADDRESSES_URL, mac_addresses_file)
+    if args.create_bootdisks:
+        download_qcow_efi_folder()
+
+    csv_path = args.csv or os.path.join(args.output_dir, f'serial_sets-{date_now}.csv')
+    tsv_path = args.tsv or os.path.join(args.output_dir, f'serial_sets-{date_now}.tsv')
+    prefixes = load_vendor_prefixes(mac_addresses_file,
+                                    os.environ.get('VENDOR_REGEX', 'Apple, Inc.'))
+    rows = generate_rows(mac_serials(args.count, args.model), args, prefixes,
+                         random.SystemRandom())
+    write_serial_sets(rows, args, csv_path, tsv_path)
+
+    with open(csv_path) as f:
+        sys.stdout.write(','.join(FIELDS) + '\n' + f.read())
+    with open(tsv_path) as f:
+        sys.stdout.write('\t'.join(FIELDS) + '\n' + f.read())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2661 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# https://github.com/munki/macadmin-scripts/blob/master/installinstallmacos.py
+#
+# Copyright 2017 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Thanks to Tim Sutton for ideas, suggestions, and sample code.
+#
+# Updated in May of 2019 by Dhiru Kholia.
+
+'''installinstallmacos.py
+A tool to download the parts for an Install macOS app from Apple's
+softwareupdate servers and install a functioning Install macOS app onto an
+empty disk image'''
+
+# https://github.com/foxlet/macOS-Simple-KVM/blob/master/tools/FetchMacOS/fetch-macos.py
+# is pretty similar.
+
+
+import os
+import zlib
+import bisect
+import heapq
+import itertools
+import struct
+import json
+import fcntl
+import time
+import base64
+import datetime
+import contextlib
+import shutil
+import hashlib
+import argparse
+import threading
+
+from xml.dom import minidom
+from xml.parsers import expat
+from xml.parsers.expat import ExpatError
+
+
+import sys
+
+if sys.version_info[0] < 3:
+    import urlparse as urlstuff
+else:
+    import urllib.parse as urlstuff
+
+# https://github.com/foxlet/macOS-Simple-KVM/blob/master/tools/FetchMacOS/fetch-macos.py (unused)
+# https://github.com/munki/macadmin-scripts
+catalogs = {
+    "CustomerSeed": "https://swscan.apple.com/content/catalogs/others/index-10.16customerseed-10.16-10.15-10.14-10.13-10.12-10.11-10.10-10.9-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog",
+    "DeveloperSeed": "https://swscan.apple.com/content/catalogs/others/index-10.16seed-10.16-10.15-10.14-10.13-10.12-10.11-10.10-10.9-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog",
+    "PublicSeed": "https://swscan.apple.com/content/catalogs/others/index-10.16beta-10.16-10.15-10.14-10.13-10.12-10.11-10.10-10.9-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog",
+    "PublicRelease": "https://swscan.apple.com/content/catalogs/others/index-10.16-10.15-10.14-10.13-10.12-10.11-10.10-10.9-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog",
+    "20": "https://swscan.apple.com/content/catalogs/others/index-11-10.15-10.14-10.13-10.12-10.11-10.10-10.9-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog"
+}
+
+
+DEFAULT_CATALOG = "20"
+
+
+def get_default_catalog():
+    '''Returns the default softwareupdate catalog for the current OS'''
+    return catalogs[DEFAULT_CATALOG]
+    # return catalogs["PublicRelease"]
+    # return catalogs["DeveloperSeed"]
+
+
+class ReplicationError(Exception):
+    '''A custom error when replication fails'''
+    pass
+
+
+class IntegrityError(ReplicationError):
+    '''Downloaded data does not match its chunklist or digest'''
+    pass
+
+
+def print_line(line, the_file=None):
+    '''Prints line with a single write, so that the messages of concurrent
+    fetches do not run into each other'''
+    (the_file or sys.stdout).write(line + '\n')
+
+
+# Parallel range downloads are only worth it for the multi-GB installer
+# packages; anything smaller than a couple of segments is fetched in one go.
+DOWNLOAD_SEGMENTS = 8
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+READ_CHUNK_SIZE = 256 * 1024
+MAX_REDIRECTS = 5
+# concurrent ServerMetadata/.dist fetches when listing installers
+METADATA_JOBS = 8
+# concurrent package downloads
+DOWNLOAD_JOBS = 3
+# seconds a cached catalog index is trusted before it is revalidated
+CATALOG_TTL = 6 * 3600
+CATALOG_INDEX_FORMAT = 2
+# bytes the shared package store may hold before old entries are evicted
+PACKAGE_STORE_BYTES = 40 * 1024 * 1024 * 1024
+# ioctl to clone a file's extents (reflink) on btrfs/xfs
+FICLONE = 0x40049409
+# bytes read from each mirror to sample its throughput, seconds a probe may
+# take, and seconds a mirror ranking is trusted
+MIRROR_PROBE_BYTES = 512 * 1024
+MIRROR_PROBE_TIMEOUT = 10
+MIRROR_TTL = 3600
+
+
+class ConnectionPool(object):
+    '''A small thread-safe pool of keep-alive HTTP(S) connections, keyed by
+    scheme and host, so that consecutive requests and parallel range
+    segments reuse sessions instead of opening one connection per file.'''
+
+    def __init__(self, timeout=DOWNLOAD_TIMEOUT):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, key):
+        import http.client
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return self._new_connection(key)
+
+    def release(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def request(self, url, headers=None, method='GET'):
+        '''Sends a request, following redirects. Returns a tuple of
+        (connection key, connection, response). The caller must read the
+        response fully before handing the connection back with release(),
+        or close it.'''
+        import http.client
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlstuff.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn = self.acquire(key)
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # an idle connection may have been closed by the server,
+                # retry once on a fresh one
+                conn.close()
+                conn = self._new_connection(key)
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                self.release(key, conn)
+                if not location:
+                    raise ReplicationError('Redirect without Location from %s' % url)
+                url = urlstuff.urljoin(url, location)
+                continue
+            return key, conn, response
+        raise ReplicationError('Too many redirects for %s' % url)
+
+
+connection_pool = ConnectionPool()
+
+
+class TransferLimits(object):
+    '''Limits shared by every download of a run: the total bandwidth, as a
+    token bucket refilled at bytes_per_second, and the number of
+    connections transferring at once. A free connection goes to the
+    waiting transfer with the highest priority. 0 means no limit.'''
+
+    def __init__(self, bytes_per_second=0, connections=0):
+        self.bytes_per_second = bytes_per_second
+        self.connections = connections
+        # a quarter of a second of burst, and at least one read
+        self._capacity = max(READ_CHUNK_SIZE, bytes_per_second / 4.0)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+
+    def throttle(self, nbytes):
+        '''Called after receiving nbytes; sleeps for as long as that put
+        the run over its bandwidth'''
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens +
+                               (now - self._updated) * self.bytes_per_second)
+            self._updated = now
+            self._tokens -= nbytes
+            delay = -self._tokens / self.bytes_per_second
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def connection(self, priority=0):
+        '''Holds one of the connections for the enclosed transfer'''
+        if not self.connections:
+            yield
+            return
+        with self._condition:
+            ticket = (-priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            self._condition.wait_for(lambda: self._active < self.connections and
+                                     self._waiting[0] == ticket)
+            heapq.heappop(self._waiting)
+            self._active += 1
+            # the next waiter may fit as well
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+
+transfer_limits = TransferLimits()
+
+
+class Telemetry(object):
+    '''Phase and per-URL timings, transfer sizes, retries and cache hits.
+    Events are written as JSON lines to events_path ('-' for stderr) and
+    the counters to a Prometheus textfile-collector file at
+    prometheus_path. With neither, every method returns immediately.'''
+
+    def __init__(self, events_path=None, prometheus_path=None):
+        self.enabled = bool(events_path or prometheus_path)
+        self.prometheus_path = prometheus_path
+        self._events = None
+        if events_path == '-':
+            self._events = sys.stderr
+        elif events_path:
+            self._events = open(events_path, 'a')
+        # {(metric name, ((label, value), ...)): value}
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def event(self, name, **fields):
+        if not self.enabled:
+            return
+        if self._events is not None:
+            line = json.dumps(dict(fields, event=name, time=round(time.time(), 6)),
+                              default=str, sort_keys=True)
+            with self._lock:
+                self._events.write(line + '\n')
+                self._events.flush()
+
+    def add(self, metric, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._metrics[key] = self._metrics.get(key, 0) + value
+
+    def cache(self, cache, hit, **fields):
+        '''Counts a hit or miss of one of our caches'''
+        if not self.enabled:
+            return
+        self.add('cache_hits_total' if hit else 'cache_misses_total', cache=cache)
+        self.event('cache', cache=cache, hit=hit, **fields)
+
+    def download(self, url, nbytes, seconds, retries=0, **fields):
+        '''Records one completed transfer'''
+        if not self.enabled:
+            return
+        self.add('downloads_total')
+        self.add('downloaded_bytes_total', nbytes)
+        self.add('download_seconds_total', seconds)
+        self.event('download', url=url, bytes=nbytes, seconds=round(seconds, 6),
+                   mib_per_second=round(nbytes / 1048576.0 / max(seconds, 1e-6), 3),
+                   retries=retries, **fields)
+
+    def retry(self, url, error, **fields):
+        '''Records a transfer that is tried again after error'''
+        if not self.enabled:
+            return
+        self.add('retries_total')
+        self.event('retry', url=url, error=str(error), **fields)
+
+    def verify_failed(self, url, check, error, **fields):
+        '''Records data that failed check, a chunk or a whole-file digest'''
+        if not self.enabled:
+            return
+        self.add('verify_failures_total', check=check)
+        self.event('verify_failed', url=url, check=check, error=str(error), **fields)
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        '''Times the enclosed block as a phase'''
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.add('phase_seconds_total', seconds, phase=name)
+            self.event('phase', phase=name, seconds=round(seconds, 6), **fields)
+
+    def close(self):
+        '''Writes the summary event and the Prometheus file'''
+        if not self.enabled:
+            return
+        self.event('summary', seconds=round(time.time() - self._start, 6),
+                   metrics=dict(('%s%s' % (metric, ''.join(
+                       '{%s=%s}' % label for label in labels)), value)
+                       for (metric, labels), value in sorted(self._metrics.items())))
+        if self.prometheus_path:
+            self._write_prometheus()
+        if self._events not in (None, sys.stderr):
+            self._events.close()
+
+    def _write_prometheus(self):
+        lines = []
+        for (metric, labels), value in sorted(self._metrics.items()):
+            name = 'fetch_macos_' + metric
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % label for label in labels)
+            lines.append('%s %s' % (name, repr(float(value))))
+        lines.append('fetch_macos_last_run_timestamp_seconds %s' % repr(time.time()))
+        lines.append('fetch_macos_run_seconds %s' % repr(time.time() - self._start))
+        tmp_path = '%s.%d.tmp' % (self.prometheus_path, os.getpid())
+        with open(tmp_path, 'w') as the_file:
+            the_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_path)
+
+
+telemetry = Telemetry()
+
+
+class DownloadProgress(object):
+    '''Thread-safe byte counter that optionally prints a progress line'''
+
+    def __init__(self, total, done=0, show=False, label=''):
+        self.total = total
+        self.done = done
+        self.show = show
+        self.label = label
+        self._start = time.time()
+        self._start_done = done
+        self._last_print = 0
+        self._lock = threading.Lock()
+
+    @property
+    def transferred(self):
+        '''Bytes received since this progress started'''
+        return self.done - self._start_done
+
+    def update(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            if self.show and time.time() - self._last_print >= 0.5:
+                self._print()
+
+    def finish(self):
+        if self.show:
+            with self._lock:
+                self._print()
+            print(file=sys.stderr)
+
+    def _print(self):
+        self._last_print = time.time()
+        elapsed = max(self._last_print - self._start, 1e-6)
+        rate = (self.done - self._start_done) / elapsed / 1048576
+        if self.total:
+            print('\r    %s %5.1f%% %8.1fMiB/%.1fMiB %7.1fMiB/s' % (
+                self.label, 100.0 * self.done / self.total,
+                self.done / 1048576, self.total / 1048576, rate),
+                end='', file=sys.stderr)
+        else:
+            print('\r    %s %8.1fMiB %7.1fMiB/s' % (
+                self.label, self.done / 1048576, rate), end='', file=sys.stderr)
+
+
+class SegmentState(object):
+    '''Per-segment progress of a ranged download, saved next to the partial
+    file so that each segment resumes on its own after an interruption.'''
+
+    def __init__(self, path, url, size, segments):
+        self.path = path
+        self.url = url
+        self.size = size
+        # list of [start, end, done], end exclusive
+        self.segments = segments
+        self.retries = 0
+        self._lock = threading.Condition()
+        self._last_save = 0
+
+    @classmethod
+    def load(cls, path, url):
+        try:
+            with open(path) as the_file:
+                state = json.load(the_file)
+        except (OSError, IOError, ValueError):
+            return None
+        if state.get('url') != url:
+            return None
+        return cls(path, url, state['size'], state['segments'])
+
+    def advance(self, index, nbytes):
+        with self._lock:
+            self.segments[index][2] += nbytes
+            if time.time() - self._last_save >= 1:
+                self._save()
+            self._lock.notify_all()
+
+    def available(self, offset, length):
+        '''Whether [offset, offset + length) has been written'''
+        end_offset = offset + length
+        with self._lock:
+            for start, end, done in self.segments:
+                # every segment overlapping the range must have written
+                # its part of it
+                if start < end_offset and offset < end and start + done < min(end, end_offset):
+                    return False
+        return True
+
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+
+    def wait(self, timeout=None):
+        '''Blocks until more data has been written, or timeout'''
+        with self._lock:
+            self._lock.wait(timeout)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._last_save = time.time()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as the_file:
+            json.dump({'url': self.url, 'size': self.size,
+                       'segments': self.segments}, the_file)
+        os.replace(tmp_path, self.path)
+
+    def remaining(self):
+        return sum(end - start - done for start, end, done in self.segments)
+
+
+CHUNKLIST_MAGIC = 0x4C4B4E43
+CHUNKLIST_HEADER = struct.Struct('<IIBBBBQQQ')
+CHUNKLIST_ENTRY = struct.Struct('<I32s')
+
+
+class ChunkList(object):
+    '''Chunk sizes and SHA-256 digests of a file, as listed by an Apple
+    chunklist (BaseSystem.chunklist, *.integrityDataV1)'''
+
+    def __init__(self, chunks):
+        # list of (offset, size, sha256 digest)
+        self.chunks = chunks
+        self.offsets = [offset for offset, _, _ in chunks]
+        self.size = sum(size for _, size, _ in chunks)
+
+    @classmethod
+    def parse(cls, data):
+        try:
+            (magic, header_size, _, chunk_method, _, _,
+             chunk_count, chunk_offset, _) = CHUNKLIST_HEADER.unpack_from(data)
+            if magic != CHUNKLIST_MAGIC or header_size != CHUNKLIST_HEADER.size:
+                raise ValueError('not a chunklist')
+            if chunk_method != 1:
+                raise ValueError('unsupported chunk method %d' % chunk_method)
+            chunks = []
+            offset = 0
+            for index in range(chunk_count):
+                size, digest = CHUNKLIST_ENTRY.unpack_from(
+                    data, chunk_offset + index * CHUNKLIST_ENTRY.size)
+                chunks.append((offset, size, digest))
+                offset += size
+        except (struct.error, ValueError) as err:
+            raise IntegrityError('Invalid chunklist: %s' % err)
+        return cls(chunks)
+
+    def index_at(self, offset):
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    def segments(self, count):
+        '''Groups the chunks into at most count contiguous segments, so that
+        every segment starts and ends on a chunk boundary'''
+        target = max(MIN_SEGMENT_SIZE, -(-self.size // max(1, count)))
+        segments = []
+        for offset, size, _ in self.chunks:
+            if segments and segments[-1][1] - segments[-1][0] < target:
+                segments[-1][1] = offset + size
+            else:
+                segments.append([offset, offset + size, 0])
+        return segments
+
+    def aligned(self, segments):
+        '''Whether every segment starts, ends and resumes on a chunk boundary'''
+        boundaries = set(self.offsets)
+        boundaries.add(self.size)
+        return all(start in boundaries and end in boundaries and start + done in boundaries
+                   for start, end, done in segments)
+
+    def realign(self, state, fd, count):
+        '''Returns a SegmentState with count chunk-aligned segments in place
+        of state, which was saved by a download without this chunklist. The
+        chunks at the start of each segment that state had written, and
+        that match the chunklist on disk, count as done.'''
+        segments = self.segments(count)
+        for segment in segments:
+            for offset, size, digest in self.chunks[self.index_at(segment[0]):]:
+                if (offset >= segment[1] or not state.available(offset, size) or
+                        hashlib.sha256(os.pread(fd, size, offset)).digest() != digest):
+                    break
+                segment[2] += size
+        return SegmentState(state.path, state.url, state.size, segments)
+
+
+def split_segments(start, end, count):
+    '''Splits [start, end) into at most count segments of at least
+    MIN_SEGMENT_SIZE bytes'''
+    length = end - start
+    if length <= 0:
+        return []
+    count = max(1, min(count, length // MIN_SEGMENT_SIZE))
+    step = -(-length // count)
+    return [[offset, min(offset + step, end), 0]
+            for offset in range(start, end, step)]
+
+
+def copy_response(response, fd, offset, limit, on_data):
+    '''Writes up to limit bytes (or everything, if limit is None) of an HTTP
+    response to fd at offset, passing each block to on_data once written.
+    Returns the offset after the last write.'''
+    while limit is None or limit > 0:
+        want = READ_CHUNK_SIZE if limit is None else min(READ_CHUNK_SIZE, limit)
+        data = response.read(want)
+        if not data:
+            break
+        os.pwrite(fd, data, offset)
+        offset += len(data)
+        if limit is not None:
+            limit -= len(data)
+        on_data(data)
+        transfer_limits.throttle(len(data))
+    return offset
+
+
+def chunk_verifier(chunklist, offset, on_verified):
+    '''Returns an on_data callback that hashes a stream starting at the chunk
+    boundary offset and calls on_verified(nbytes) for every chunk whose
+    SHA-256 matches the chunklist'''
+    position = [offset, chunklist.index_at(offset), hashlib.sha256()]
+
+    def on_data(data):
+        view = memoryview(data)
+        while view:
+            pos, index, hasher = position
+            chunk_offset, size, digest = chunklist.chunks[index]
+            take = min(len(view), chunk_offset + size - pos)
+            hasher.update(view[:take])
+            view = view[take:]
+            position[0] = pos + take
+            if position[0] == chunk_offset + size:
+                if hasher.digest() != digest:
+                    raise IntegrityError('Chunk %d at offset %d failed verification' % (
+                        index, chunk_offset))
+                on_verified(size)
+                position[1:] = [index + 1, hashlib.sha256()]
+    return on_data
+
+
+def fetch_segment(url, fd, state, index, progress, chunklist=None, priority=0):
+    '''Downloads one segment of a ranged download, retrying from its last
+    written byte on connection errors. With a chunklist, progress is only
+    recorded for verified chunks and a chunk that fails verification is
+    fetched again. priority orders it against other transfers waiting
+    for a connection.'''
+    import http.client
+
+    for attempt in range(DOWNLOAD_RETRIES):
+        start, end, done = state.segments[index]
+        if start + done >= end:
+            return
+        # bytes counted in progress but not yet verified, which are
+        # fetched again after an error
+        unverified = [0]
+        if chunklist is not None:
+            def on_verified(nbytes):
+                state.advance(index, nbytes)
+                unverified[0] -= nbytes
+
+            verify = chunk_verifier(chunklist, start + done, on_verified)
+
+            def on_data(data):
+                progress.update(len(data))
+                unverified[0] += len(data)
+                verify(data)
+        else:
+            def on_data(data):
+                state.advance(index, len(data))
+                progress.update(len(data))
+
+        conn = None
+        try:
+            with transfer_limits.connection(priority):
+                key, conn, response = connection_pool.request(
+                    url, {'Range': 'bytes=%d-%d' % (start + done, end - 1)})
+                if response.status != 206:
+                    raise ReplicationError('Server ignored range request for %s (HTTP %d)' % (
+                        url, response.status))
+                if not response.getheader('Content-Range', '').endswith('/%d' % state.size):
+                    raise ReplicationError('%s changed size since the download started' % url)
+                copy_response(response, fd, start + done, end - start - done, on_data)
+                if response.read(1):
+                    raise ReplicationError('Server sent more than requested for %s' % url)
+                connection_pool.release(key, conn)
+                conn = None
+        except (http.client.HTTPException, OSError, IntegrityError) as err:
+            if conn is not None:
+                conn.close()
+            progress.update(-unverified[0])
+            if isinstance(err, IntegrityError):
+                telemetry.verify_failed(url, 'chunk', err, segment=index)
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise ReplicationError(err)
+            state.retried()
+            telemetry.retry(url, err, segment=index, attempt=attempt + 1)
+            if isinstance(err, IntegrityError):
+                print_line('%s in %s, fetching it again' % (err, url), sys.stderr)
+            time.sleep(2 ** attempt)
+        except ReplicationError:
+            if conn is not None:
+                conn.close()
+            raise
+    start, end, done = state.segments[index]
+    if start + done < end:
+        raise ReplicationError('Segment %d of %s is incomplete' % (index, url))
+
+
+def remote_size(url, priority=0):
+    '''Returns the size of url from a one-byte range request, or None if
+    the server does not support ranges'''
+    import http.client
+    try:
+        with transfer_limits.connection(priority):
+            key, conn, response = connection_pool.request(url, {'Range': 'bytes=0-0'})
+            if response.status != 206:
+                conn.close()
+                return None
+            response.read()
+            connection_pool.release(key, conn)
+    except (http.client.HTTPException, OSError) as err:
+        raise ReplicationError(err)
+    try:
+        return int(response.getheader('Content-Range', '').rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def file_digest(path, algorithm):
+    '''Returns the hex digest of a file'''
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as the_file:
+        for data in iter(lambda: the_file.read(READ_CHUNK_SIZE * 4), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def digest_algorithm(digest):
+    '''Guesses the hash algorithm of a catalog Digest from its length'''
+    return {40: 'sha1', 64: 'sha256'}.get(len(digest or ''))
+
+
+def download_file(full_url, local_file_path,
+                  show_progress=False, ignore_cache=False,
+                  attempt_resume=False, segments=None,
+                  chunklist=None, digest=None, on_state=None, source_url=None,
+                  priority=0):
+    '''Downloads full_url to local_file_path in-process. Large files are
+    split into parallel HTTP range requests over pooled keep-alive
+    connections. Data is written to a .part file, with a .part.json segment
+    map when resuming is possible, and renamed into place once complete.
+
+    With a ChunkList, segments follow chunk boundaries and every chunk is
+    hashed as it streams in, so a resumed download only fetches chunks that
+    are missing or failed. Otherwise a catalog digest, if given, is checked
+    once the file is complete.
+
+    on_state, if given, is called with the SegmentState of a ranged download
+    and the URL it is fetched from before its segments are fetched, so that
+    the file can be consumed while it is still being written.
+
+    source_url, if given, is where the data is fetched from instead, such
+    as the same file on a mirror; resume state is still kept by full_url.
+    priority orders its requests against other downloads waiting for a
+    connection under transfer_limits.'''
+    import concurrent.futures
+    import http.client
+    if segments is None:
+        segments = DOWNLOAD_SEGMENTS
+    if source_url is None:
+        source_url = full_url
+    part_path = local_file_path + '.part'
+    state_path = part_path + '.json'
+    label = os.path.basename(local_file_path)
+
+    if ignore_cache:
+        for path in (local_file_path, part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+    elif os.path.exists(local_file_path):
+        # files are only renamed into place once complete
+        telemetry.cache('file', True, url=full_url)
+        return local_file_path
+    telemetry.cache('file', False, url=full_url)
+    started = time.time()
+
+    local_dir = os.path.dirname(local_file_path)
+    if local_dir:
+        os.makedirs(local_dir, exist_ok=True)
+
+    state = None
+    progress = None
+    if attempt_resume and os.path.exists(part_path):
+        state = SegmentState.load(state_path, full_url)
+        if chunklist is not None:
+            if state is not None and state.size != chunklist.size:
+                state = None
+        elif state is not None and remote_size(source_url, priority) != state.size:
+            # the file changed on the server, so start over
+            state = None
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if (state is not None and chunklist is not None and
+                not chunklist.aligned(state.segments)):
+            # saved by a run without the chunklist, so the segments do not
+            # start on chunk boundaries and could never be verified
+            state = chunklist.realign(state, fd, segments)
+            state.save()
+        if state is None and chunklist is not None:
+            # the chunklist already tells us the size
+            state = SegmentState(state_path, full_url, chunklist.size,
+                                 chunklist.segments(segments))
+            state.save()
+        if state is not None:
+            os.ftruncate(fd, state.size)
+            progress = DownloadProgress(state.size, done=state.size - state.remaining(),
+                                        show=show_progress, label=label)
+        else:
+            # the probe asks for the first segment only, so small files are
+            # complete after a single round trip
+            with transfer_limits.connection(priority):
+                key, conn, response = connection_pool.request(
+                    source_url, {'Range': 'bytes=0-%d' % (MIN_SEGMENT_SIZE - 1)})
+                if response.status == 206:
+                    total = int(response.getheader('Content-Range', '').rsplit('/', 1)[1])
+                    os.ftruncate(fd, total)
+                    state = SegmentState(state_path, full_url, total,
+                                         [[0, min(MIN_SEGMENT_SIZE, total), 0]])
+                    state.segments += split_segments(state.segments[0][1], total, segments)
+                    if len(state.segments) > 1:
+                        state.save()
+                    progress = DownloadProgress(total, show=show_progress, label=label)
+                    copy_response(response, fd, 0, state.segments[0][1],
+                                  lambda data: (state.advance(0, len(data)),
+                                                progress.update(len(data))))
+                    response.read()
+                    connection_pool.release(key, conn)
+                elif response.status == 416:
+                    # empty file
+                    response.read()
+                    connection_pool.release(key, conn)
+                    os.ftruncate(fd, 0)
+                elif response.status == 200:
+                    # no range support, stream the whole body
+                    length = response.getheader('Content-Length')
+                    total = int(length) if length else None
+                    progress = DownloadProgress(total, show=show_progress, label=label)
+                    os.ftruncate(fd, 0)
+                    written = copy_response(response, fd, 0, None,
+                                            lambda data: progress.update(len(data)))
+                    connection_pool.release(key, conn)
+                    progress.finish()
+                    if total is not None and written != total:
+                        raise ReplicationError('Short read from %s: %d of %d bytes' % (
+                            source_url, written, total))
+                else:
+                    response.read()
+                    connection_pool.release(key, conn)
+                    raise ReplicationError('HTTP %d fetching %s' % (response.status, source_url))
+
+        if state is not None:
+            if on_state is not None:
+                on_state(state, source_url)
+            if state.remaining():
+                with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as pool:
+                    futures = [pool.submit(fetch_segment, source_url, fd, state, index,
+                                           progress, chunklist, priority)
+                               for index in range(len(state.segments))]
+                    try:
+                        for future in concurrent.futures.as_completed(futures):
+                            future.result()
+                    finally:
+                        state.save()
+            progress.finish()
+    except (http.client.HTTPException, OSError, ValueError, IndexError) as err:
+        raise ReplicationError(err)
+    finally:
+        os.close(fd)
+
+    algorithm = digest_algorithm(digest) if chunklist is None else None
+    if algorithm and file_digest(part_path, algorithm) != digest.lower():
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        err = IntegrityError('%s does not match its %s digest' % (full_url, algorithm))
+        telemetry.verify_failed(full_url, 'digest', err, source_url=source_url)
+        raise err
+
+    os.replace(part_path, local_file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    telemetry.download(full_url, progress.transferred if progress else 0,
+                       time.time() - started,
+                       retries=state.retries if state else 0,
+                       segments=len(state.segments) if state else 1)
+    return local_file_path
+
+
+def fetch_chunklist(integrity_url, local_dir, ignore_cache=False):
+    '''Downloads and parses the chunklist of a package'''
+    local_file_path = os.path.join(
+        local_dir, os.path.basename(urlstuff.urlsplit(integrity_url)[2]))
+    download_file(integrity_url, local_file_path, ignore_cache=ignore_cache)
+    with open(local_file_path, 'rb') as the_file:
+        data = the_file.read()
+    try:
+        return ChunkList.parse(data)
+    except IntegrityError:
+        os.remove(local_file_path)
+        raise
+
+
+def mirror_url(full_url, mirror):
+    '''Returns full_url on a mirror: a base URL, such as a caching proxy,
+    that serves the same paths, e.g. http://cache.local:3142/apple. None
+    is the catalog's own host.'''
+    if mirror is None:
+        return full_url
+    parts = urlstuff.urlsplit(full_url)
+    base = urlstuff.urlsplit(mirror)
+    return urlstuff.urlunsplit((base.scheme, base.netloc,
+                                base.path.rstrip('/') + parts.path, parts.query, ''))
+
+
+def probe_url(url, nbytes=MIRROR_PROBE_BYTES, timeout=MIRROR_PROBE_TIMEOUT):
+    '''Times a range request for the first nbytes of url on a fresh
+    connection. Returns a dict of the connect time, time to first byte and
+    throughput, and the size the server reports for the file.'''
+    import http.client
+    start = time.perf_counter()
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlstuff.urlsplit(url)
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        try:
+            connect_start = time.perf_counter()
+            conn.connect()
+            connected = time.perf_counter()
+            conn.request('GET', path, headers={'Range': 'bytes=0-%d' % (nbytes - 1)})
+            response = conn.getresponse()
+            first_byte = time.perf_counter()
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                url = urlstuff.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 206:
+                raise ReplicationError('HTTP %d' % response.status)
+            size = int(response.getheader('Content-Range', '').rsplit('/', 1)[1])
+            received = len(response.read())
+            done = time.perf_counter()
+        finally:
+            conn.close()
+        bytes_per_second = received / max(done - first_byte, 1e-6)
+        return {'connect': connected - connect_start,
+                'first_byte': first_byte - start,
+                'mib_per_second': bytes_per_second / 1048576.0,
+                'size': size,
+                # expected seconds to fetch one range segment from here
+                'score': first_byte - start + MIN_SEGMENT_SIZE / bytes_per_second}
+    raise ReplicationError('Too many redirects for %s' % url)
+
+
+class MirrorRanker(object):
+    '''Ranks equivalent endpoints for package downloads: the host the
+    catalog names and the configured mirrors or caching proxies. The
+    candidates are probed in parallel with a range request for the same
+    package, and ranked by the time a range segment is expected to take.
+    Candidates that fail, or report a different size than the catalog's
+    host, go last. Rankings are kept per catalog host in cache_path for
+    ttl seconds, so that the other packages of a run, and later runs,
+    skip the probes.'''
+
+    def __init__(self, mirrors, cache_path=None, ttl=MIRROR_TTL):
+        self.mirrors = [mirror.rstrip('/') for mirror in mirrors]
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as the_file:
+                return json.load(the_file)
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        rankings = self._load()
+        rankings.update(self._rankings)
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as the_file:
+            json.dump(rankings, the_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def _cached(self, origin):
+        entry = self._rankings.get(origin)
+        if entry is None and self.cache_path:
+            entry = self._load().get(origin)
+        if (entry is None or entry['mirrors'] != self.mirrors or
+                time.time() - entry['time'] > self.ttl):
+            return None
+        self._rankings[origin] = entry
+        return entry['ranking']
+
+    def probe(self, full_url):
+        '''Probes every candidate for full_url at once and returns them
+        fastest first, as [mirror, probe or None]'''
+        import concurrent.futures
+        import http.client
+        candidates = [None] + self.mirrors
+
+        def timed(mirror):
+            try:
+                return probe_url(mirror_url(full_url, mirror))
+            except (ReplicationError, http.client.HTTPException, OSError, ValueError,
+                    IndexError) as err:
+                telemetry.event('mirror_probe', url=full_url, mirror=mirror, error=str(err))
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+            probes = list(pool.map(timed, candidates))
+        sizes = [probe['size'] for probe in probes if probe]
+        size = probes[0]['size'] if probes[0] else max(set(sizes), key=sizes.count, default=None)
+        ranking = []
+        for mirror, probe in zip(candidates, probes):
+            if probe:
+                telemetry.event('mirror_probe', url=full_url, mirror=mirror, **probe)
+                if probe['size'] != size:
+                    probe = None
+            ranking.append([mirror, probe])
+        ranking.sort(key=lambda item: (item[1] is None,
+                                       item[1]['score'] if item[1] else 0))
+        return ranking
+
+    def rank(self, full_url):
+        '''Returns the base URLs to fetch full_url from, best first, with
+        None for the catalog's own host'''
+        if not self.mirrors:
+            return [None]
+        origin = '%s://%s' % tuple(urlstuff.urlsplit(full_url)[:2])
+        with self._lock:
+            ranking = self._cached(origin)
+            if ranking is None:
+                ranking = self.probe(full_url)
+                self._rankings[origin] = {'time': time.time(), 'mirrors': self.mirrors,
+                                          'ranking': ranking}
+                self._save()
+                telemetry.cache('mirrors', False, url=origin)
+                print_line('[+] Ranked mirrors for %s: %s' % (origin, ', '.join(
+                    '%s (%s)' % (mirror or origin,
+                                 '%.2fs/segment' % probe['score'] if probe else 'unusable')
+                    for mirror, probe in ranking)))
+            else:
+                telemetry.cache('mirrors', True, url=origin)
+        return [mirror for mirror, _ in ranking]
+
+    def demote(self, full_url, mirror):
+        '''Moves a mirror that failed a download to the end of the ranking'''
+        origin = '%s://%s' % tuple(urlstuff.urlsplit(full_url)[:2])
+        with self._lock:
+            entry = self._rankings.get(origin)
+            if entry is None:
+                return
+            ranking = entry['ranking']
+            entry['ranking'] = ([item for item in ranking if item[0] != mirror] +
+                                [[mirror, None]])
+            self._save()
+
+
+mirror_ranker = None
+
+
+def is_skipped(full_url, installer=False, product_title=""):
+    '''Whether replicate_url() leaves out this package: of an installer,
+    only BaseSystem.dmg is needed, and of Big Sur only InstallAssistant.pkg'''
+    # hack
+    if installer and "BaseSystem.dmg" not in full_url and "Big Sur" not in product_title:
+        return True
+    return "Big Sur" in product_title and "InstallAssistant.pkg" not in full_url
+
+
+def replicate_url(full_url,
+                  root_dir='/tmp',
+                  show_progress=False,
+                  ignore_cache=False,
+                  attempt_resume=False, installer=False, product_title="",
+                  integrity_url=None, digest=None, on_state=None, store=None, priority=0):
+    '''Downloads a URL and stores it in the same relative path on our
+    filesystem. Returns a path to the replicated file.
+
+    integrity_url names the package's chunklist, which is then used to
+    verify the data as it is downloaded; digest is the catalog's whole-file
+    digest, used when there is no chunklist. Installer packages are kept in
+    store, a PackageStore, if given, and linked into root_dir. priority
+    orders the download against others under transfer_limits.'''
+
+    if is_skipped(full_url, installer, product_title):
+        return
+    print_line("[+] Fetching %s" % full_url)
+    path = urlstuff.urlsplit(full_url)[2]
+    relative_url = path.lstrip('/')
+    relative_url = os.path.normpath(relative_url)
+    if installer:
+        # installer packages go straight into the working directory
+        relative_url = os.path.basename(relative_url)
+    # everything else keeps its URL path, as there are multiple metadata
+    # files with the same name
+    local_file_path = os.path.join(root_dir, relative_url)
+
+    chunklist = None
+    if integrity_url:
+        chunklist = fetch_chunklist(integrity_url, os.path.dirname(local_file_path),
+                                    ignore_cache=ignore_cache)
+
+    def download(path):
+        # installer packages come from the fastest mirror, falling back to
+        # the next one in the ranking if a download fails
+        mirrors = mirror_ranker.rank(full_url) if mirror_ranker and installer else [None]
+        for index, mirror in enumerate(mirrors):
+            try:
+                return download_file(full_url, path,
+                                     show_progress=show_progress,
+                                     ignore_cache=ignore_cache and index == 0,
+                                     attempt_resume=attempt_resume,
+                                     chunklist=chunklist, digest=digest, on_state=on_state,
+                                     source_url=mirror_url(full_url, mirror),
+                                     priority=priority)
+            except ReplicationError as err:
+                if index == len(mirrors) - 1:
+                    raise
+                mirror_ranker.demote(full_url, mirror)
+                telemetry.event('mirror_failed', url=full_url, mirror=mirror, error=str(err))
+                print_line('%s: %s, trying %s' % (mirror_url(full_url, mirror), err,
+                                                  mirror_url(full_url, mirrors[index + 1])),
+                           sys.stderr)
+
+    if store is not None and installer:
+        try:
+            return store.replicate(full_url, local_file_path, download,
+                                   digest=digest, ignore_cache=ignore_cache)
+        except OSError as err:
+            raise ReplicationError(err)
+    return download(local_file_path)
+
+
+class PackageStore(object):
+    '''Host-level, content-addressed store of downloaded packages, shared by
+    every invocation and working directory. Entries are keyed by URL and
+    catalog digest, written under a per-entry file lock, and linked into
+    working directories. Least recently used entries are evicted once the
+    store grows past max_bytes.'''
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = PACKAGE_STORE_BYTES if max_bytes is None else max_bytes
+
+    def entry_path(self, full_url, digest=None):
+        key = hashlib.sha256(('%s\0%s' % (full_url, digest or '')).encode('utf-8'))
+        name = os.path.basename(urlstuff.urlsplit(full_url)[2])
+        return os.path.join(self.path, key.hexdigest()[:32], name)
+
+    def _lock(self, path, blocking=True):
+        os.makedirs(self.path, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(fd)
+            if blocking:
+                raise
+            return None
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _matches(self, path, digest):
+        '''Whether the file at path has the catalog digest, if there is one'''
+        algorithm = digest_algorithm(digest)
+        return algorithm is None or file_digest(path, algorithm) == digest.lower()
+
+    def replicate(self, full_url, local_file_path, download, digest=None,
+                  ignore_cache=False):
+        '''Makes local_file_path a link to the stored copy of full_url,
+        calling download(path) to fill the store first if needed'''
+        entry = self.entry_path(full_url, digest)
+        fd = self._lock(os.path.dirname(entry) + '.lock')
+        try:
+            if ignore_cache and os.path.exists(entry):
+                os.remove(entry)
+            if os.path.exists(entry):
+                os.utime(entry)
+                telemetry.cache('store', True, url=full_url)
+            elif (not ignore_cache and os.path.exists(local_file_path) and
+                  self._matches(local_file_path, digest)):
+                # adopt a copy downloaded before the store existed
+                link_file(local_file_path, entry)
+                telemetry.cache('store', True, url=full_url)
+            else:
+                telemetry.cache('store', False, url=full_url)
+                download(entry)
+            link_file(entry, local_file_path)
+        finally:
+            self._unlock(fd)
+        self.evict(keep=entry)
+        return local_file_path
+
+    def evict(self, keep=None):
+        '''Removes least recently used entries until the store fits in
+        max_bytes. Entries that are being written or linked are skipped.'''
+        if not self.max_bytes:
+            return
+        store_fd = self._lock(os.path.join(self.path, '.lock'))
+        try:
+            entries = []
+            for key in os.listdir(self.path):
+                entry_dir = os.path.join(self.path, key)
+                if key.startswith('.') or not os.path.isdir(entry_dir):
+                    continue
+                for name in os.listdir(entry_dir):
+                    path = os.path.join(entry_dir, name)
+                    if name.endswith(('.part', '.json', '.tmp')):
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                fd = self._lock(os.path.dirname(path) + '.lock', blocking=False)
+                if fd is None:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                    telemetry.add('store_evictions_total')
+                    telemetry.event('evict', path=path, bytes=size)
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+                finally:
+                    self._unlock(fd)
+        finally:
+            self._unlock(store_fd)
+
+
+def link_file(source, destination):
+    '''Places source at destination as a hardlink, or a reflink or plain
+    copy when the two are on different filesystems'''
+    try:
+        if os.path.samefile(source, destination):
+            return
+    except FileNotFoundError:
+        pass
+    local_dir = os.path.dirname(destination)
+    if local_dir:
+        os.makedirs(local_dir, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (destination, os.getpid())
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                shutil.copyfileobj(src, dst, READ_CHUNK_SIZE)
+    os.replace(tmp_path, destination)
+
+
+def parse_server_metadata(filename):
+    '''Parses a softwareupdate server metadata file, looking for information
+    of interest.
+    Returns a dictionary containing title, version, and description.'''
+    import plistlib
+    title = ''
+    vers = ''
+    try:
+        with open(filename, 'rb') as the_file:
+            md_plist = plistlib.load(the_file)
+    except (OSError, IOError, ExpatError, ValueError) as err:
+        print_line('Error reading %s: %s' % (filename, err), sys.stderr)
+        return {}
+    vers = md_plist.get('CFBundleShortVersionString', '')
+    localization = md_plist.get('localization', {})
+    preferred_localization = (localization.get('English') or
+                              localization.get('en'))
+    if preferred_localization:
+        title = preferred_localization.get('title', '')
+
+    metadata = {}
+    metadata['title'] = title
+    metadata['version'] = vers
+
+    """
+    {'title': 'macOS Mojave', 'version': '10.14.5'}
+    {'title': 'macOS Mojave', 'version': '10.14.6'}
+    """
+    return metadata
+
+
+def get_server_metadata(catalog, product_key, workdir, ignore_cache=False):
+    '''Replicate ServerMetaData'''
+    try:
+        url = catalog['Products'][product_key]['ServerMetadataURL']
+        try:
+            smd_path = replicate_url(
+                url, root_dir=workdir, ignore_cache=ignore_cache)
+            return smd_path
+        except ReplicationError as err:
+            print_line('Could not replicate %s: %s' % (url, err), sys.stderr)
+            return None
+    except KeyError:
+        # print('Malformed catalog.', file=sys.stderr)
+        return None
+
+
+def parse_dist(filename):
+    '''Parses a softwareupdate dist file, returning a dict of info of
+    interest'''
+    dist_info = {}
+    try:
+        dom = minidom.parse(filename)
+    except ExpatError:
+        print_line('Invalid XML in %s' % filename, sys.stderr)
+        return dist_info
+    except IOError as err:
+        print_line('Error reading %s: %s' % (filename, err), sys.stderr)
+        return dist_info
+
+    titles = dom.getElementsByTagName('title')
+    if titles:
+        dist_info['title_from_dist'] = titles[0].firstChild.wholeText
+
+    auxinfos = dom.getElementsByTagName('auxinfo')
+    if not auxinfos:
+        return dist_info
+    auxinfo = auxinfos[0]
+    key = None
+    value = None
+    children = auxinfo.childNodes
+    # handle the possibility that keys from auxinfo may be nested
+    # within a 'dict' element
+    dict_nodes = [n for n in auxinfo.childNodes
+                  if n.nodeType == n.ELEMENT_NODE and
+                  n.tagName == 'dict']
+    if dict_nodes:
+        children = dict_nodes[0].childNodes
+    for node in children:
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'key':
+            key = node.firstChild.wholeText
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'string':
+            value = node.firstChild.wholeText
+        if key and value:
+            dist_info[key] = value
+            key = None
+            value = None
+    return dist_info
+
+
+# the only per-product fields used after the catalog has been read
+INSTALLER_PRODUCT_FIELDS = frozenset([
+    'Packages', 'Distributions', 'ServerMetadataURL', 'PostDate',
+    'ExtendedMetaInfo',
+])
+
+
+class InstallerCatalogReader(object):
+    '''Event-driven softwareupdate catalog reader. Data is fed in chunks to
+    an expat parser that only tracks nesting and <key> names; the raw bytes
+    of a product are kept until its dict closes and are only turned into
+    objects when it turned out to be a macOS installer. Memory and object
+    construction therefore scale with the number of installers, not with
+    the size of the catalog.'''
+
+    def __init__(self):
+        self.products = {}
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._buffer = bytearray()
+        self._buffer_offset = 0
+        self._depth = 0
+        self._top_key = None
+        self._product_id = None
+        self._product_start = None
+        self._installer = False
+        self._text = []
+
+    def feed(self, data):
+        self._buffer += data
+        self._parser.Parse(data, False)
+        # only the bytes of the product currently being read are needed
+        keep_from = self._product_start
+        if keep_from is None:
+            keep_from = self._buffer_offset + len(self._buffer)
+        del self._buffer[:keep_from - self._buffer_offset]
+        self._buffer_offset = keep_from
+
+    def close(self):
+        self._parser.Parse(b'', True)
+        return {'Products': self.products}
+
+    def _data(self, data):
+        self._text.append(data)
+
+    def _start(self, name, attrs):
+        if name == 'key':
+            self._text = []
+            self._parser.CharacterDataHandler = self._data
+        elif name in ('dict', 'array'):
+            self._depth += 1
+            if self._depth == 3 and self._top_key == 'Products':
+                self._product_start = self._parser.CurrentByteIndex
+                self._installer = False
+
+    def _end(self, name):
+        if name == 'key':
+            self._parser.CharacterDataHandler = None
+            if self._depth == 1:
+                self._top_key = ''.join(self._text)
+            elif self._depth == 2:
+                self._product_id = ''.join(self._text)
+            elif ''.join(self._text) == 'InstallAssistantPackageIdentifiers':
+                self._installer = True
+        elif name in ('dict', 'array'):
+            if self._depth == 3 and self._product_start is not None:
+                if self._installer:
+                    self._add_product()
+                self._product_start = None
+            self._depth -= 1
+
+    def _add_product(self):
+        import plistlib
+        start = self._product_start - self._buffer_offset
+        end = self._buffer.index(b'>', self._parser.CurrentByteIndex - self._buffer_offset) + 1
+        product = plistlib.loads(b'<plist version="1.0">' +
+                                 bytes(self._buffer[start:end]) + b'</plist>')
+        try:
+            if not product['ExtendedMetaInfo']['InstallAssistantPackageIdentifiers']:
+                return
+        except (KeyError, TypeError):
+            return
+        self.products[self._product_id] = dict(
+            (key, value) for key, value in product.items()
+            if key in INSTALLER_PRODUCT_FIELDS)
+
+
+def read_installer_catalog(the_file, chunk_size=READ_CHUNK_SIZE):
+    '''Reads a softwareupdate catalog from a binary file object, gunzipping
+    it on the fly when needed, and returns it reduced to installer products'''
+    reader = InstallerCatalogReader()
+    decompressor = None
+    data = the_file.read(chunk_size)
+    if data[:2] == b'\x1f\x8b':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while data:
+        if decompressor is not None:
+            # bound the output so highly compressed input stays streaming
+            data = decompressor.decompress(data, chunk_size)
+            while data:
+                reader.feed(data)
+                data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+        else:
+            reader.feed(data)
+        data = the_file.read(chunk_size)
+    if decompressor is not None:
+        reader.feed(decompressor.flush())
+    return reader.close()
+
+
+def parse_sucatalog(localcatalogpath):
+    '''Returns the macOS installer products of a local softwareupdate catalog,
+    plain or gzipped'''
+    try:
+        with open(localcatalogpath, 'rb') as the_file:
+            return read_installer_catalog(the_file)
+    except (OSError, IOError, ExpatError, ValueError, zlib.error) as err:
+        print_line('Error reading %s: %s' % (localcatalogpath, err), sys.stderr)
+        exit(-1)
+
+
+def download_and_parse_sucatalog(sucatalog, workdir, ignore_cache=False):
+    '''Downloads and returns a parsed softwareupdate catalog, reduced to its
+    macOS installer products'''
+    try:
+        localcatalogpath = replicate_url(
+            sucatalog, root_dir=workdir, ignore_cache=ignore_cache)
+    except ReplicationError as err:
+        print_line('Could not replicate %s: %s' % (sucatalog, err), sys.stderr)
+        exit(-1)
+    return parse_sucatalog(localcatalogpath)
+
+
+def find_mac_os_installers(catalog):
+    '''Return a list of product identifiers for what appear to be macOS
+    installers'''
+    mac_os_installer_products = []
+    if 'Products' in catalog:
+        for product_key in catalog['Products'].keys():
+            product = catalog['Products'][product_key]
+            try:
+                if product['ExtendedMetaInfo'][
+                        'InstallAssistantPackageIdentifiers']:
+                    mac_os_installer_products.append(product_key)
+            except KeyError:
+                continue
+
+    return mac_os_installer_products
+
+
+def product_installer_info(catalog, product_key, workdir, ignore_cache=False):
+    '''Fetches and parses the ServerMetadata and English distribution file
+    of a single installer product'''
+    info = {}
+    filename = get_server_metadata(catalog, product_key, workdir,
+                                   ignore_cache=ignore_cache)
+    if filename:
+        info = parse_server_metadata(filename)
+    info.setdefault('title', None)
+    info.setdefault('version', None)
+
+    product = catalog['Products'][product_key]
+    info['PostDate'] = product['PostDate']
+    distributions = product['Distributions']
+    dist_url = distributions.get('English') or distributions.get('en')
+    try:
+        dist_path = replicate_url(
+            dist_url, root_dir=workdir, ignore_cache=ignore_cache)
+    except ReplicationError as err:
+        print_line('Could not replicate %s: %s' % (dist_url, err), sys.stderr)
+    else:
+        dist_info = parse_dist(dist_path)
+        info['DistributionPath'] = dist_path
+        info.update(dist_info)
+        if not info['title']:
+            info['title'] = dist_info.get('title_from_dist')
+        if not info['version']:
+            info['version'] = dist_info.get('VERSION')
+    return info
+
+
+class SharedFetches(object):
+    '''Submits jobs to an executor once per key, so that catalogs listing
+    the same product share a single metadata fetch'''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, function, *args, **kwargs):
+        with self._lock:
+            future = self._futures.get(key)
+            shared = future is not None
+            if not shared:
+                future = self.pool.submit(function, *args, **kwargs)
+                self._futures[key] = future
+        telemetry.cache('metadata', shared, url=key[0])
+        return future
+
+
+def product_fetch_key(product):
+    '''The URLs product_installer_info() downloads for a product'''
+    distributions = product.get('Distributions', {})
+    return (product.get('ServerMetadataURL'),
+            distributions.get('English') or distributions.get('en'))
+
+
+def os_installer_product_info(catalog, workdir, ignore_cache=False, jobs=None,
+                              fetches=None):
+    '''Returns a dict of info about products that look like macOS installers.
+    Products are fetched and parsed concurrently by up to jobs workers; the
+    result keeps catalog order and a failing product does not affect the
+    others. Passing a SharedFetches reuses fetches of the same product made
+    for other catalogs.'''
+    import concurrent.futures
+    if jobs is None:
+        jobs = METADATA_JOBS
+    installer_products = find_mac_os_installers(catalog)
+    if fetches is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            return os_installer_product_info(catalog, workdir, ignore_cache, jobs,
+                                             SharedFetches(pool))
+
+    futures = [fetches.submit(product_fetch_key(catalog['Products'][product_key]),
+                              product_installer_info, catalog, product_key,
+                              workdir, ignore_cache=ignore_cache)
+               for product_key in installer_products]
+
+    product_info = {}
+    for product_key, future in zip(installer_products, futures):
+        try:
+            product_info[product_key] = dict(future.result())
+        except Exception as err:
+            print_line('Could not get info for %s: %s' % (product_key, err), sys.stderr)
+            product_info[product_key] = {
+                'title': None,
+                'version': None,
+                'PostDate': catalog['Products'][product_key].get('PostDate'),
+            }
+
+    return product_info
+
+
+def default_cache_dir():
+    '''Returns the host-level cache directory shared by all invocations'''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'docker-osx')
+
+
+def catalog_index_path(cache_dir, sucatalog):
+    '''Returns the path of the parsed index cached for a catalog URL'''
+    digest = hashlib.sha256(sucatalog.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'catalog-%s.json' % digest)
+
+
+def index_json_default(value):
+    # the catalog's dates and data, which JSON has no types for
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'$data': base64.b64encode(value).decode('ascii')}
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def index_json_object(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return datetime.datetime.fromisoformat(obj['$date'])
+    if len(obj) == 1 and '$data' in obj:
+        return base64.b64decode(obj['$data'])
+    return obj
+
+
+def load_catalog_index(path):
+    '''Returns a previously saved catalog index, or None. The index is
+    JSON, as the cache directory is shared and loading it must not be able
+    to run code.'''
+    try:
+        with open(path) as the_file:
+            index = json.load(the_file, object_hook=index_json_object)
+    except (OSError, IOError, ValueError, TypeError):
+        return None
+    if not isinstance(index, dict) or index.get('format') != CATALOG_INDEX_FORMAT:
+        return None
+    return index
+
+
+def save_catalog_index(path, index):
+    '''Atomically writes a catalog index'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        json.dump(index, the_file, default=index_json_default)
+    os.replace(tmp_path, path)
+
+
+def relocate_product_info(product_info, start, workdir):
+    '''Returns product_info with every DistributionPath moved from under
+    start to under workdir. The index is shared by invocations with
+    different working directories, so it keeps these paths relative.'''
+    relocated = {}
+    for product_id, info in product_info.items():
+        if info.get('DistributionPath'):
+            path = os.path.relpath(info['DistributionPath'], start) if start else \
+                info['DistributionPath']
+            info = dict(info, DistributionPath=os.path.join(workdir, path)
+                        if workdir else path)
+        relocated[product_id] = info
+    return relocated
+
+
+def revalidate_url(full_url, local_file_path, etag=None, last_modified=None):
+    '''Conditionally downloads full_url to local_file_path using the given
+    validators. Returns (modified, etag, last_modified); modified is False
+    when the server answered 304 and the local copy is still current.'''
+    import http.client
+    headers = {}
+    if os.path.exists(local_file_path):
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    print_line("[+] Fetching %s" % full_url)
+    started = time.time()
+    try:
+        key, conn, response = connection_pool.request(full_url, headers)
+        if response.status == 304:
+            response.read()
+            connection_pool.release(key, conn)
+            telemetry.cache('catalog', True, url=full_url)
+            return False, etag, last_modified
+        if response.status != 200:
+            response.read()
+            connection_pool.release(key, conn)
+            raise ReplicationError('HTTP %d fetching %s' % (response.status, full_url))
+        local_dir = os.path.dirname(local_file_path)
+        if local_dir:
+            os.makedirs(local_dir, exist_ok=True)
+        part_path = local_file_path + '.part'
+        with open(part_path, 'wb') as the_file:
+            shutil.copyfileobj(response, the_file, READ_CHUNK_SIZE)
+            nbytes = the_file.tell()
+        connection_pool.release(key, conn)
+        os.replace(part_path, local_file_path)
+    except (http.client.HTTPException, OSError) as err:
+        raise ReplicationError(err)
+    telemetry.download(full_url, nbytes, time.time() - started)
+    return (True, response.getheader('ETag'),
+            response.getheader('Last-Modified'))
+
+
+def get_product_index(sucatalog, workdir, cache_dir=None, ttl=None,
+                      ignore_cache=False, jobs=None, fetches=None):
+    '''Returns (catalog, product_info) for the macOS installers in sucatalog.
+    The parsed result is cached in cache_dir and served from there for ttl
+    seconds; after that the catalog is revalidated with its ETag and
+    Last-Modified, and only re-parsed when the server reports a change.
+    ignore_cache forces a full refresh of the catalog and metadata.
+    Raises ReplicationError if the catalog can be neither fetched nor
+    served from the cache.'''
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if ttl is None:
+        ttl = CATALOG_TTL
+    index_path = catalog_index_path(cache_dir, sucatalog)
+    index = None if ignore_cache else load_catalog_index(index_path)
+    if index:
+        index['product_info'] = relocate_product_info(index['product_info'], None, workdir)
+    if index and index['url'] == sucatalog and time.time() - index['checked'] < ttl:
+        telemetry.cache('index', True, url=sucatalog)
+        return index['catalog'], index['product_info']
+    telemetry.cache('index', False, url=sucatalog)
+
+    path = urlstuff.urlsplit(sucatalog)[2]
+    local_catalog_path = os.path.join(workdir, os.path.normpath(path.lstrip('/')))
+    if ignore_cache and os.path.exists(local_catalog_path):
+        os.remove(local_catalog_path)
+    etag = index['etag'] if index else None
+    last_modified = index['last_modified'] if index else None
+    try:
+        with telemetry.phase('catalog_download', url=sucatalog):
+            modified, etag, last_modified = revalidate_url(
+                sucatalog, local_catalog_path, etag, last_modified)
+    except ReplicationError as err:
+        if index:
+            print_line('Could not revalidate %s, using cached index: %s' % (sucatalog, err),
+                       sys.stderr)
+            return index['catalog'], index['product_info']
+        raise ReplicationError('Could not replicate %s: %s' % (sucatalog, err))
+
+    if index and not modified:
+        save_catalog_index(index_path, dict(
+            index, checked=time.time(),
+            product_info=relocate_product_info(index['product_info'], workdir, None)))
+        return index['catalog'], index['product_info']
+
+    with telemetry.phase('catalog_parse', url=sucatalog):
+        catalog = parse_sucatalog(local_catalog_path)
+    with telemetry.phase('product_info', url=sucatalog):
+        product_info = os_installer_product_info(
+            catalog, workdir, ignore_cache=ignore_cache, jobs=jobs, fetches=fetches)
+    save_catalog_index(index_path, {
+        'format': CATALOG_INDEX_FORMAT,
+        'url': sucatalog,
+        'etag': etag,
+        'last_modified': last_modified,
+        'checked': time.time(),
+        'catalog': catalog,
+        'product_info': relocate_product_info(product_info, workdir, None),
+    })
+    return catalog, product_info
+
+
+def merge_product_indexes(indexes):
+    '''Merges (seed, catalog, product_info) triples into a single
+    (catalog, product_info) keyed by product ID. Each product keeps the
+    first catalog entry seen for it, and product_info[...]['seeds'] lists
+    every seed it was found in.'''
+    merged_products = {}
+    merged_info = {}
+    for seed, catalog, product_info in indexes:
+        for product_key, info in product_info.items():
+            if product_key not in merged_info:
+                merged_products[product_key] = catalog['Products'][product_key]
+                merged_info[product_key] = dict(info, seeds=[])
+            merged_info[product_key]['seeds'].append(seed)
+    return {'Products': merged_products}, merged_info
+
+
+def get_merged_product_index(seeds, workdir, cache_dir=None, ttl=None,
+                             ignore_cache=False, jobs=None):
+    '''Returns (catalog, product_info) merged across the named catalogs,
+    which are fetched concurrently. Products listed in more than one catalog
+    have their metadata fetched only once. A catalog that cannot be fetched
+    is reported and left out of the merge; it is only an error when none
+    of them can be.'''
+    if len(seeds) == 1:
+        try:
+            return merge_product_indexes([(seeds[0],) + get_product_index(
+                catalogs[seeds[0]], workdir, cache_dir=cache_dir, ttl=ttl,
+                ignore_cache=ignore_cache, jobs=jobs)])
+        except ReplicationError as err:
+            print_line(str(err), sys.stderr)
+            exit(-1)
+    import concurrent.futures
+    if jobs is None:
+        jobs = METADATA_JOBS
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as metadata_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=len(seeds)) as catalog_pool:
+        fetches = SharedFetches(metadata_pool)
+        futures = [catalog_pool.submit(get_product_index, catalogs[seed], workdir,
+                                       cache_dir=cache_dir, ttl=ttl,
+                                       ignore_cache=ignore_cache, jobs=jobs,
+                                       fetches=fetches)
+                   for seed in seeds]
+        indexes = []
+        failed = []
+        for seed, future in zip(seeds, futures):
+            try:
+                indexes.append((seed,) + future.result())
+            except ReplicationError as err:
+                print_line(str(err), sys.stderr)
+                failed.append(seed)
+    if failed:
+        telemetry.event('catalog_failed', seeds=failed)
+        print_line('Leaving out the %s catalog%s.' % (
+            ', '.join(failed), 's' if len(failed) > 1 else ''), sys.stderr)
+    if not indexes:
+        exit(-1)
+    return merge_product_indexes(indexes)
+
+
+def package_integrity_url(package, packages):
+    '''Returns the chunklist URL for a package: its IntegrityDataURL, or a
+    sibling package such as BaseSystem.chunklist for BaseSystem.dmg'''
+    if package.get('IntegrityDataURL'):
+        return package['IntegrityDataURL']
+    chunklist_url = os.path.splitext(package.get('URL', ''))[0] + '.chunklist'
+    for other in packages:
+        if other.get('URL') == chunklist_url:
+            return chunklist_url
+    return None
+
+
+def replicate_product(catalog, product_id, workdir, ignore_cache=False, product_title="",
+                      convert_path=None, convert_format='qcow2', convert_jobs=None,
+                      store=None):
+    '''Downloads all the packages for a product. With convert_path,
+    BaseSystem.dmg is also converted to a disk image while it downloads.
+    Packages are shared with other working directories through store.'''
+    failed = replicate_products(catalog, [(product_id, product_title, workdir, 0)],
+                                ignore_cache=ignore_cache, convert_path=convert_path,
+                                convert_format=convert_format, convert_jobs=convert_jobs,
+                                store=store)
+    if failed:
+        exit(-1)
+
+
+def replicate_products(catalog, targets, ignore_cache=False, convert_path=None,
+                       convert_format='qcow2', convert_jobs=None, store=None, jobs=None):
+    '''Downloads the packages of several products at once. targets is a
+    list of (product ID, title, working directory, priority).
+
+    Every package URL is one job, downloaded once however many targets
+    need it and linked into the others' working directories. Up to jobs
+    jobs run at a time, highest priority first, all under the run's
+    transfer_limits. Retrying is left to download_file(), and to the next
+    mirror in replicate_url(); a job that still fails only fails the
+    targets that need it. Returns the set of product IDs that failed.
+
+    With convert_path, the first target's BaseSystem.dmg is also converted
+    to a disk image while it downloads.'''
+    import concurrent.futures
+    if jobs is None:
+        jobs = DOWNLOAD_JOBS
+    # {url: job}, in the order the jobs are started
+    queue = {}
+    convert_url = None
+    for product_id, product_title, workdir, priority in sorted(
+            targets, key=lambda target: -target[3]):
+        packages = catalog['Products'][product_id].get('Packages', [])
+        for package in packages:
+            # TO-DO: Check 'Size' attribute and make sure
+            # we have enough space on the target
+            # filesystem before attempting to download
+            for url_key in ('URL', 'MetadataURL'):
+                url = package.get(url_key)
+                if not url:
+                    continue
+                if (convert_path and convert_url is None and url_key == 'URL' and
+                        url.endswith('/BaseSystem.dmg') and
+                        not is_skipped(url, True, product_title)):
+                    convert_url = url
+                if url not in queue:
+                    kwargs = dict(ignore_cache=ignore_cache, installer=True, priority=priority)
+                    if url_key == 'URL':
+                        kwargs.update(
+                            show_progress=True, attempt_resume=(not ignore_cache),
+                            product_title=product_title,
+                            integrity_url=package_integrity_url(package, packages),
+                            digest=package.get('Digest'), store=store)
+                    queue[url] = {'url': url, 'kwargs': kwargs, 'workdirs': [],
+                                  'products': [], 'convert': url == convert_url}
+                job = queue[url]
+                if workdir not in job['workdirs']:
+                    job['workdirs'].append(workdir)
+                job['products'].append(product_id)
+    if convert_path and convert_url is None:
+        print_line('No BaseSystem.dmg is downloaded for %s, not converting it.'
+                   % ', '.join(target[1] for target in targets), sys.stderr)
+
+    failed = set()
+    failed_lock = threading.Lock()
+    convert_jobs = UDIF_JOBS if convert_jobs is None else convert_jobs
+
+    def run(job, pool=None):
+        url = job['url']
+        try:
+            if job['convert']:
+                replicate_and_convert(url, job['workdirs'][0], convert_path,
+                                      convert_format, convert_jobs, pool, **job['kwargs'])
+                path = os.path.join(job['workdirs'][0],
+                                    os.path.basename(urlstuff.urlsplit(url)[2]))
+            else:
+                path = replicate_url(url, root_dir=job['workdirs'][0], **job['kwargs'])
+            if path and os.path.exists(path):
+                for workdir in job['workdirs'][1:]:
+                    link_file(path, os.path.join(workdir, os.path.basename(path)))
+            return
+        except UdifError as err:
+            print_line('Could not convert %s: %s' % (url, err), sys.stderr)
+        except (ReplicationError, OSError) as err:
+            print_line('Could not replicate %s: %s' % (url, err), sys.stderr)
+        with failed_lock:
+            failed.update(job['products'])
+
+    converts = [job for job in queue.values() if job['convert']]
+    others = [job for job in queue.values() if not job['convert']]
+    with contextlib.ExitStack() as stack:
+        # the decompressing processes have to be forked before the download
+        # threads exist, and the conversion runs on this thread meanwhile
+        pool = stack.enter_context(udif_pool(convert_jobs)) if converts else None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [executor.submit(run, job) for job in others]
+            for job in converts:
+                run(job, pool)
+            for future in futures:
+                future.result()
+    return failed
+
+
+SECTOR_SIZE = 512
+KOLY_TRAILER = struct.Struct('>4sIIIQQQQQII16sII128sQQ120sII128sIQ12s')
+MISH_HEADER = struct.Struct('>4sIQQQII24sII128sI')
+MISH_CHUNK = struct.Struct('>IIQQQQ')
+UDIF_ZERO = 0x00000000
+UDIF_RAW = 0x00000001
+UDIF_IGNORE = 0x00000002
+UDIF_ADC = 0x80000004
+UDIF_ZLIB = 0x80000005
+UDIF_BZIP2 = 0x80000006
+UDIF_LZFSE = 0x80000007
+UDIF_LZMA = 0x80000008
+UDIF_COMMENT = 0x7ffffffe
+UDIF_TERMINATOR = 0xffffffff
+UDIF_JOBS = os.cpu_count() or 1
+
+
+class UdifError(Exception):
+    '''A custom error when a DMG cannot be decoded'''
+    pass
+
+
+class UdifImage(object):
+    '''The block map of a UDIF disk image (a .dmg such as BaseSystem.dmg),
+    read from its koly trailer and the mish tables in its XML plist.
+    chunks holds (type, output offset, output length, input offset,
+    input length) tuples.'''
+
+    def __init__(self, size, chunks):
+        self.size = size
+        self.chunks = chunks
+
+    @classmethod
+    def read(cls, read, file_size):
+        '''Parses the image from read(offset, length), which returns bytes
+        of the .dmg, and the size of the .dmg'''
+        import plistlib
+        trailer = read(file_size - KOLY_TRAILER.size, KOLY_TRAILER.size)
+        fields = KOLY_TRAILER.unpack(trailer)
+        if fields[0] != b'koly':
+            raise UdifError('No koly trailer, not a UDIF image')
+        data_fork_offset = fields[5]
+        xml_offset, xml_length = fields[15], fields[16]
+        sector_count = fields[22]
+        try:
+            plist = plistlib.loads(read(xml_offset, xml_length))
+            blkx = plist['resource-fork']['blkx']
+        except (ExpatError, ValueError, KeyError, TypeError) as err:
+            raise UdifError('Unreadable block table: %s' % err)
+
+        chunks = []
+        for entry in blkx:
+            table = entry['Data']
+            header = MISH_HEADER.unpack_from(table)
+            if header[0] != b'mish':
+                raise UdifError('Bad mish block in %s' % entry.get('Name'))
+            first_sector, data_offset, chunk_count = header[2], header[4], header[11]
+            for index in range(chunk_count):
+                (entry_type, _, sector, count, offset, length) = MISH_CHUNK.unpack_from(
+                    table, MISH_HEADER.size + index * MISH_CHUNK.size)
+                if entry_type in (UDIF_COMMENT, UDIF_TERMINATOR):
+                    continue
+                chunks.append((entry_type,
+                               (first_sector + sector) * SECTOR_SIZE,
+                               count * SECTOR_SIZE,
+                               data_fork_offset + data_offset + offset,
+                               length))
+        return cls(sector_count * SECTOR_SIZE, chunks)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as the_file:
+            file_size = os.fstat(the_file.fileno()).st_size
+            return cls.read(lambda offset, length: os.pread(
+                the_file.fileno(), length, offset), file_size)
+
+
+def adc_decompress(data, length):
+    '''Decompresses Apple Data Compression'''
+    out = bytearray()
+    pos = 0
+    while pos < len(data) and len(out) < length:
+        byte = data[pos]
+        if byte & 0x80:
+            run = (byte & 0x7f) + 1
+            out += data[pos + 1:pos + 1 + run]
+            pos += 1 + run
+            continue
+        if byte & 0x40:
+            run = (byte & 0x3f) + 4
+            distance = (data[pos + 1] << 8 | data[pos + 2]) + 1
+            pos += 3
+        else:
+            run = ((byte & 0x3c) >> 2) + 3
+            distance = ((byte & 0x03) << 8 | data[pos + 1]) + 1
+            pos += 2
+        for _ in range(run):
+            out.append(out[-distance])
+    return bytes(out)
+
+
+def decompress_udif_chunk(entry_type, data, length):
+    '''Returns the decompressed contents of one UDIF chunk, or None when it
+    is all zeroes. Runs in the worker processes.'''
+    if entry_type == UDIF_RAW:
+        out = data
+    elif entry_type == UDIF_ZLIB:
+        out = zlib.decompress(data)
+    elif entry_type == UDIF_BZIP2:
+        import bz2
+        out = bz2.decompress(data)
+    elif entry_type == UDIF_LZMA:
+        import lzma
+        out = lzma.decompress(data)
+    elif entry_type == UDIF_ADC:
+        out = adc_decompress(data, length)
+    else:
+        raise UdifError('Unsupported chunk type 0x%08x' % entry_type)
+    if len(out) != length:
+        raise UdifError('Chunk decompressed to %d bytes instead of %d' % (len(out), length))
+    if out.count(0) == length:
+        return None
+    return out
+
+
+class RawImageWriter(object):
+    '''Writes a sparse raw disk image; holes are never written'''
+
+    def __init__(self, path, size):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, size)
+
+    def write(self, offset, data):
+        os.pwrite(self.fd, data, offset)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Qcow2ImageWriter(object):
+    '''Writes a qcow2 (version 2) image in a single pass. Data clusters and
+    L2 tables are allocated at the end of the file as they are first
+    written, all-zero clusters stay unallocated, and the header, L1 table
+    and refcounts are written by close().'''
+
+    def __init__(self, path, size, cluster_bits=16):
+        self.size = size
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.l1 = [0] * max(1, -(-size // (self.cluster_size * self.l2_entries)))
+        self.l2_tables = {}
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        # cluster 0 holds the header, the L1 table follows it
+        self.l1_offset = self.cluster_size
+        self.next_cluster = 1 + -(-len(self.l1) * 8 // self.cluster_size)
+
+    def _allocate(self):
+        offset = self.next_cluster * self.cluster_size
+        self.next_cluster += 1
+        return offset
+
+    def _cluster_offset(self, guest_offset):
+        cluster = guest_offset >> self.cluster_bits
+        l1_index, l2_index = divmod(cluster, self.l2_entries)
+        l2 = self.l2_tables.get(l1_index)
+        if l2 is None:
+            self.l1[l1_index] = self._allocate()
+            l2 = self.l2_tables[l1_index] = [0] * self.l2_entries
+        if not l2[l2_index]:
+            l2[l2_index] = self._allocate()
+            os.ftruncate(self.fd, self.next_cluster * self.cluster_size)
+        return l2[l2_index]
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        while view:
+            in_cluster = offset & (self.cluster_size - 1)
+            take = min(len(view), self.cluster_size - in_cluster)
+            piece = view[:take]
+            if bytes(piece).count(0) != take:
+                os.pwrite(self.fd, piece, self._cluster_offset(offset) + in_cluster)
+            offset += take
+            view = view[take:]
+
+    def close(self):
+        copied = 1 << 63
+        for l1_index, l2 in self.l2_tables.items():
+            os.pwrite(self.fd, struct.pack('>%dQ' % len(l2), *[
+                entry | copied if entry else 0 for entry in l2]), self.l1[l1_index])
+        os.pwrite(self.fd, struct.pack('>%dQ' % len(self.l1), *[
+            entry | copied if entry else 0 for entry in self.l1]), self.l1_offset)
+
+        # every cluster so far has a refcount of one; the refcount blocks
+        # and table go at the end and have to cover themselves as well
+        per_block = self.cluster_size // 2
+        used = self.next_cluster
+        blocks = table_clusters = 0
+        while True:
+            total = used + blocks + table_clusters
+            need_blocks = -(-total // per_block)
+            need_table = -(-need_blocks * 8 // self.cluster_size)
+            if (need_blocks, need_table) == (blocks, table_clusters):
+                break
+            blocks, table_clusters = need_blocks, need_table
+        block_offsets = [(used + index) * self.cluster_size for index in range(blocks)]
+        table_offset = (used + blocks) * self.cluster_size
+        for index, block_offset in enumerate(block_offsets):
+            count = min(per_block, total - index * per_block)
+            os.pwrite(self.fd, struct.pack('>%dH' % count, *([1] * count)), block_offset)
+        os.pwrite(self.fd, struct.pack('>%dQ' % blocks, *block_offsets), table_offset)
+        os.ftruncate(self.fd, total * self.cluster_size)
+
+        header = struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', 2, 0, 0, self.cluster_bits,
+                             self.size, 0, len(self.l1), self.l1_offset,
+                             table_offset, table_clusters, 0, 0)
+        os.pwrite(self.fd, header, 0)
+        os.close(self.fd)
+
+
+def image_writer(path, size, output_format):
+    if output_format == 'raw':
+        return RawImageWriter(path, size)
+    if output_format == 'qcow2':
+        return Qcow2ImageWriter(path, size)
+    raise UdifError('Unsupported output format %s' % output_format)
+
+
+def convert_udif(image, read, output_path, output_format='qcow2',
+                 jobs=None, available=None, wait=None, pool=None):
+    '''Decodes a UdifImage into a sparse raw or qcow2 image at output_path.
+    Compressed chunks are read with read(offset, length) and decompressed
+    across a process pool. When converting a file that is still being
+    downloaded, available(offset, length) tells whether a chunk's input has
+    arrived and wait() blocks until more data may have.'''
+    import concurrent.futures
+    if jobs is None:
+        jobs = UDIF_JOBS
+    if pool is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+            return convert_udif(image, read, output_path, output_format,
+                                jobs, available, wait, pool)
+
+    pending = sorted((chunk for chunk in image.chunks
+                      if chunk[0] not in (UDIF_ZERO, UDIF_IGNORE)),
+                     key=lambda chunk: chunk[3])
+    writer = image_writer(output_path + '.part', image.size, output_format)
+    try:
+        inflight = {}
+        while pending or inflight:
+            waiting = []
+            for chunk in pending:
+                if len(inflight) >= jobs * 2 or (
+                        available is not None and not available(chunk[3], chunk[4])):
+                    waiting.append(chunk)
+                    continue
+                entry_type, out_offset, out_length, in_offset, in_length = chunk
+                future = pool.submit(decompress_udif_chunk, entry_type,
+                                     read(in_offset, in_length), out_length)
+                inflight[future] = out_offset
+            pending = waiting
+            if not inflight:
+                wait()
+                continue
+            done, _ = concurrent.futures.wait(
+                inflight, timeout=None if available is None else 0.5,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                data = future.result()
+                if data is not None:
+                    writer.write(inflight[future], data)
+                del inflight[future]
+    except (zlib.error, OSError, ValueError, EOFError) as err:
+        raise UdifError(err)
+    finally:
+        writer.close()
+    os.replace(output_path + '.part', output_path)
+    return output_path
+
+
+def convert_dmg(dmg_path, output_path, output_format='qcow2', jobs=None):
+    '''Converts a complete .dmg on disk, like qemu-img convert would'''
+    image = UdifImage.open(dmg_path)
+    with open(dmg_path, 'rb') as the_file:
+        fd = the_file.fileno()
+        return convert_udif(image, lambda offset, length: os.pread(fd, length, offset),
+                            output_path, output_format, jobs)
+
+
+def replicate_and_convert(full_url, workdir, output_path, output_format='qcow2',
+                          jobs=None, pool=None, **kwargs):
+    '''Downloads a .dmg with replicate_url() and converts it at the same time:
+    the block tables are fetched from the end of the file first, and every
+    chunk is decompressed as soon as its bytes have been downloaded.
+
+    pool is a process pool of jobs workers to decompress with; one is
+    started if not given.'''
+    states = []
+    state_ready = threading.Event()
+    result = {}
+
+    def on_state(state, source_url):
+        states.append((state, source_url))
+        state_ready.set()
+
+    def download():
+        try:
+            result['path'] = replicate_url(full_url, root_dir=workdir,
+                                           on_state=on_state, **kwargs)
+        except BaseException as err:
+            result['error'] = err
+        finally:
+            state_ready.set()
+
+    if jobs is None:
+        jobs = UDIF_JOBS
+    if pool is None:
+        with udif_pool(jobs) as pool:
+            return replicate_and_convert(full_url, workdir, output_path, output_format,
+                                         jobs, pool, **kwargs)
+    thread = threading.Thread(target=download)
+    thread.start()
+    state_ready.wait()
+    if not states:
+        # nothing to overlap with: cached, or no range support
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        if result['path'] is None:
+            # replicate_url() skipped the package, so there is nothing to convert
+            return None
+        image = UdifImage.open(result['path'])
+        with open(result['path'], 'rb') as the_file:
+            fd = the_file.fileno()
+            return convert_udif(image, lambda offset, length: os.pread(fd, length, offset),
+                                output_path, output_format, jobs, pool=pool)
+    state, source_url = states[0]
+    return convert_while_downloading(source_url, output_path, output_format, jobs, pool,
+                                     state, thread, result, kwargs.get('priority', 0))
+
+
+@contextlib.contextmanager
+def udif_pool(jobs):
+    '''A process pool for convert_udif(), with its workers started before
+    the caller starts any threads that they could fork in a bad state'''
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        concurrent.futures.wait([pool.submit(int) for _ in range(jobs)])
+        yield pool
+
+
+def convert_while_downloading(source_url, output_path, output_format, jobs, pool,
+                              state, thread, result, priority=0):
+    '''The pipelined half of replicate_and_convert(). The block tables are
+    read from source_url, the host the download itself uses, under the
+    same transfer_limits and priority.'''
+
+    part_path = state.path[:-len('.json')]
+
+    def read_remote(offset, length):
+        with transfer_limits.connection(priority):
+            key, conn, response = connection_pool.request(
+                source_url, {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+            data = response.read()
+            connection_pool.release(key, conn)
+            transfer_limits.throttle(len(data))
+        if response.status != 206 or len(data) != length:
+            raise UdifError('Could not read %d bytes at %d from %s' % (
+                length, offset, source_url))
+        return data
+
+    def wait():
+        if 'error' in result:
+            raise result['error']
+        state.wait(0.5)
+
+    try:
+        image = UdifImage.read(read_remote, state.size)
+        try:
+            the_file = open(part_path, 'rb')
+        except FileNotFoundError:
+            # the download finished and was renamed in the meantime
+            the_file = open(part_path[:-len('.part')], 'rb')
+        with the_file:
+            fd = the_file.fileno()
+            convert_udif(image, lambda offset, length: os.pread(fd, length, offset),
+                         output_path, output_format, jobs,
+                         available=state.available, wait=wait, pool=pool)
+    finally:
+        thread.join()
+    if 'error' in result:
+        raise result['error']
+    return output_path
+
+
+def find_installer_app(mountpoint):
+    '''Returns the path to the Install macOS app on the mountpoint'''
+    applications_dir = os.path.join(mountpoint, 'Applications')
+    for item in os.listdir(applications_dir):
+        if item.endswith('.app'):
+            return os.path.join(applications_dir, item)
+    return None
+
+
+def version_key(version):
+    '''Sort key that orders dotted versions numerically, so that 10.9 sorts
+    before 10.15 and 11.0.1. Versions without a leading number sort first.'''
+    key = []
+    for part in str(version or '').split('.'):
+        digits = len(part) - len(part.lstrip('0123456789'))
+        if not digits:
+            break
+        key.append(int(part[:digits]))
+    return tuple(key)
+
+
+def resolve_version(version, product_info):
+    '''Returns the product ID for a version, or None. version is an exact
+    version such as "10.15.7", a prefix such as "10.15" that picks the
+    highest matching version, or "latest". Ties go to the newest post.'''
+    def newest(product_ids):
+        if not product_ids:
+            return None
+        return max(product_ids, key=lambda product_id: (
+            version_key(product_info[product_id]['version']),
+            product_info[product_id].get('PostDate') or datetime.datetime.min))
+
+    versioned = [product_id for product_id in product_info
+                 if version_key(product_info[product_id].get('version'))]
+    if version == 'latest':
+        return newest(versioned)
+    exact = [product_id for product_id in versioned
+             if product_info[product_id]['version'] == version]
+    if exact:
+        return newest(exact)
+    wanted = version_key(version)
+    if not wanted:
+        return None
+    return newest([product_id for product_id in versioned
+                   if version_key(product_info[product_id]['version'])[:len(wanted)] == wanted])
+
+
+def list_installers(product_info):
+    '''Returns the installers in product_info as JSON-friendly dicts, in
+    version order'''
+    installers = []
+    for product_id, info in product_info.items():
+        post_date = info.get('PostDate')
+        installers.append({
+            'product_id': product_id,
+            'version': info.get('version'),
+            'build': info.get('BUILD'),
+            'title': info.get('title'),
+            'post_date': post_date.isoformat() if post_date else None,
+            'seeds': info.get('seeds', []),
+        })
+    installers.sort(key=lambda installer: (version_key(installer['version']),
+                                           installer['post_date'] or ''))
+    return installers
+
+
+def print_installers(product_info):
+    '''Prints the numbered table of installers that the menu chooses from'''
+    print('%2s %12s %10s %11s  %-30s %s' % ('#', 'ProductID', 'Version',
+                                                'Post Date', 'Title', 'Catalogs'))
+    for index, product_id in enumerate(product_info):
+        print('%2s %12s %10s %11s  %-30s %s' % (
+            index + 1,
+            product_id,
+            product_info[product_id]['version'],
+            product_info[product_id]['PostDate'].strftime('%Y-%m-%d'),
+            product_info[product_id]['title'],
+            ','.join(product_info[product_id].get('seeds', []))
+        ))
+
+
+def determine_version(version, product_info):
+    if version:
+        product_id = resolve_version(version, product_info)
+        if product_id is not None:
+            return product_id, product_info[product_id]['title']
+
+        print("Could not find version {}. Versions available are:".format(version))
+        for _, pid in enumerate(product_info):
+            print("- {}".format(product_info[pid]['version']))
+
+        exit(1)
+
+    # display a menu of choices (some seed catalogs have multiple installers)
+    print_installers(product_info)
+    if not sys.stdin.isatty():
+        print('No --version given and stdin is not a terminal to choose from the list '
+              'above. Pass --version, e.g. --version latest, or find one with --list '
+              'or --resolve.', file=sys.stderr)
+        exit(1)
+
+    answer = input(
+        '\nChoose a product to download (1-%s): ' % len(product_info))
+    try:
+        index = int(answer) - 1
+        if index < 0:
+            raise ValueError
+        product_id = list(product_info.keys())[index]
+        return product_id, product_info[product_id]['title']
+    except (ValueError, IndexError):
+        pass
+
+    print('Invalid input provided.')
+    exit(0)
+
+
+def query(args, product_info):
+    '''Answers --list and --resolve'''
+    if args.list:
+        if args.json:
+            print(json.dumps(list_installers(product_info), indent=2))
+        else:
+            print_installers(product_info)
+        return
+    product_id = resolve_version(args.resolve, product_info)
+    if product_id is None:
+        print('Could not find version %s.' % args.resolve, file=sys.stderr)
+        exit(1)
+    if args.json:
+        installer, = [installer for installer in list_installers(product_info)
+                      if installer['product_id'] == product_id]
+        print(json.dumps(installer, indent=2))
+    else:
+        print(product_id)
+
+
+def main(argv=None):
+    '''Do the main thing here'''
+    global DOWNLOAD_SEGMENTS, telemetry, mirror_ranker, transfer_limits
+    """
+    if os.getuid() != 0:
+        sys.exit('This command requires root (to install packages), so please '
+                 'run again with sudo or as root.')
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', metavar='path_to_working_dir',
+                        default='.',
+                        help='Path to working directory on a volume with over '
+                             '10G of available space. Defaults to current working '
+                             'directory.')
+    parser.add_argument('--version', metavar='version', action='append',
+                        default=None,
+                        help='The version to download in the format of '
+                             '"$major.$minor.$patch", e.g. "10.15.4". Can '
+                             'be "latest" to download the latest version. '
+                             'Can be given more than once to download several '
+                             'versions in one run, each into a directory named '
+                             'after its product ID in the working directory. '
+                             'A "@priority" suffix, e.g. "10.15.7@10", makes '
+                             'higher numbers download first; by default, '
+                             'versions download in the order given. Without '
+                             '--version, a product is chosen from a menu, which '
+                             'needs a terminal; non-interactive runs must give '
+                             '--version, or look one up with --list or --resolve.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Output a read-only compressed disk image with '
+                             'the Install macOS app at the root. This is now the '
+                             'default. Use --raw to get a read-write sparse image '
+                             'with the app in the Applications directory.')
+    parser.add_argument('--raw', action='store_true',
+                        help='Output a read-write sparse image '
+                             'with the app in the Applications directory. Requires '
+                             'less available disk space and is faster.')
+    parser.add_argument('--catalog', choices=list(catalogs) + ['all'],
+                        default=DEFAULT_CATALOG,
+                        help='The softwareupdate catalog to search, or "all" to '
+                             'fetch every catalog and merge their products. '
+                             'Defaults to %(default)s.')
+    parser.add_argument('--ignore-cache', action='store_true',
+                        help='Ignore any previously cached files.')
+    parser.add_argument('--segments', metavar='count', type=int,
+                        default=DOWNLOAD_SEGMENTS,
+                        help='Number of parallel range requests used for large '
+                             'downloads. Defaults to %d.' % DOWNLOAD_SEGMENTS)
+    parser.add_argument('--jobs', metavar='count', type=int,
+                        default=METADATA_JOBS,
+                        help='Number of installer products whose metadata is '
+                             'fetched concurrently. Defaults to %d.' % METADATA_JOBS)
+    parser.add_argument('--download-jobs', metavar='count', type=int,
+                        default=DOWNLOAD_JOBS,
+                        help='Number of packages downloaded at once. Defaults '
+                             'to %d.' % DOWNLOAD_JOBS)
+    parser.add_argument('--bandwidth', metavar='MiB/s', type=float, default=0,
+                        help='Total bandwidth all downloads may use. 0, the '
+                             'default, is unlimited.')
+    parser.add_argument('--max-connections', metavar='count', type=int, default=0,
+                        help='Number of connections transferring data at once, '
+                             'across all downloads. 0, the default, is unlimited.')
+    parser.add_argument('--cache-dir', metavar='path',
+                        default=default_cache_dir(),
+                        help='Directory for the parsed catalog index. Defaults '
+                             'to %(default)s.')
+    parser.add_argument('--catalog-ttl', metavar='seconds', type=int,
+                        default=CATALOG_TTL,
+                        help='Seconds a cached catalog index is used before it is '
+                             'revalidated with the server. Defaults to %d.' % CATALOG_TTL)
+    parser.add_argument('--package-store', metavar='path',
+                        default=os.environ.get('FETCH_MACOS_PACKAGE_STORE') or None,
+                        help='Keep installer packages in a store shared by all '
+                             'working directories, e.g. %s, and link them into the '
+                             'working directory. A store on another filesystem than '
+                             'the working directory means a second copy of every '
+                             'package. Defaults to $FETCH_MACOS_PACKAGE_STORE; '
+                             'packages are only downloaded into the working '
+                             'directory without one.' % os.path.join(default_cache_dir(),
+                                                                     'packages'))
+    parser.add_argument('--package-store-size', metavar='GiB', type=float,
+                        default=PACKAGE_STORE_BYTES / 1024.0 ** 3,
+                        help='Size the package store is trimmed to, evicting the '
+                             'least recently used packages. 0 disables eviction. '
+                             'Defaults to %(default)g.')
+    parser.add_argument('--mirror', metavar='url', action='append',
+                        default=os.environ.get('FETCH_MACOS_MIRRORS', '').replace(',', ' ').split(),
+                        help='Base URL of a mirror or caching proxy serving the '
+                             'same paths as Apple\'s servers, e.g. '
+                             'http://cache.local:3142. Can be given more than once; '
+                             'defaults to $FETCH_MACOS_MIRRORS. The fastest of these '
+                             'and Apple\'s own host is used for installer packages.')
+    parser.add_argument('--mirror-ttl', metavar='seconds', type=int,
+                        default=MIRROR_TTL,
+                        help='Seconds a mirror ranking is reused before the '
+                             'mirrors are probed again. Defaults to %d.' % MIRROR_TTL)
+    parser.add_argument('--telemetry', metavar='path', default=None,
+                        help='Write timing, throughput, retry, verification and '
+                             'cache events as JSON lines to this file, or - for '
+                             'stderr.')
+    parser.add_argument('--prometheus', metavar='path', default=None,
+                        help='Write the run\'s counters to this Prometheus '
+                             'textfile-collector file, e.g. '
+                             '/var/lib/node_exporter/fetch_macos.prom.')
+    parser.add_argument('--convert', metavar='path', default=None,
+                        help='Also convert BaseSystem.dmg into a disk image at this '
+                             'path, decompressing it while it downloads, e.g. '
+                             'BaseSystem.img.')
+    parser.add_argument('--convert-format', choices=('qcow2', 'raw'),
+                        default='qcow2',
+                        help='Format of the --convert image. Defaults to qcow2.')
+    parser.add_argument('--convert-jobs', metavar='count', type=int,
+                        default=UDIF_JOBS,
+                        help='Number of processes decompressing BaseSystem.dmg. '
+                             'Defaults to the number of CPUs.')
+    parser.add_argument('--list', action='store_true',
+                        help='List the available installers and exit, without '
+                             'downloading anything.')
+    parser.add_argument('--resolve', metavar='version', default=None,
+                        help='Print the product ID that --version would download, '
+                             'e.g. "10.15.7", "10.15" or "latest", and exit.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print --list and --resolve results as JSON.')
+    args = parser.parse_args(argv)
+
+    DOWNLOAD_SEGMENTS = max(1, args.segments)
+    telemetry = Telemetry(args.telemetry, args.prometheus)
+    transfer_limits = TransferLimits(int(args.bandwidth * 1024 * 1024),
+                                     max(0, args.max_connections))
+    mirror_ranker = None
+    if args.mirror:
+        mirror_ranker = MirrorRanker(args.mirror, os.path.join(args.cache_dir, 'mirrors.json'),
+                                     args.mirror_ttl)
+
+    try:
+        seeds = list(catalogs) if args.catalog == 'all' else [args.catalog]
+        store = None
+        if args.package_store:
+            store = PackageStore(args.package_store,
+                                 int(args.package_store_size * 1024 ** 3))
+
+        if args.list or args.resolve:
+            # keep stdout for the answer
+            with contextlib.redirect_stdout(sys.stderr):
+                _, product_info = get_merged_product_index(
+                    seeds, args.workdir, cache_dir=args.cache_dir,
+                    ttl=args.catalog_ttl, ignore_cache=args.ignore_cache, jobs=args.jobs)
+            query(args, product_info)
+            return
+
+        # download the sucatalogs and look for products that are for macOS installers
+        with telemetry.phase('catalog', seeds=seeds):
+            catalog, product_info = get_merged_product_index(
+                seeds, args.workdir, cache_dir=args.cache_dir,
+                ttl=args.catalog_ttl, ignore_cache=args.ignore_cache, jobs=args.jobs)
+
+        if not product_info:
+            print('No macOS installer products found in the sucatalog.', file=sys.stderr)
+            exit(-1)
+
+        versions = args.version or [None]
+        if len(versions) > 1 and args.convert:
+            print('--convert takes a single --version.', file=sys.stderr)
+            exit(1)
+        targets = []
+        with telemetry.phase('select'):
+            for index, version in enumerate(versions):
+                # earlier versions go first unless given a priority
+                priority = len(versions) - index
+                if version and '@' in version:
+                    version, _, priority = version.rpartition('@')
+                    try:
+                        priority = int(priority)
+                    except ValueError:
+                        print('Invalid priority in --version %s.' % versions[index],
+                              file=sys.stderr)
+                        exit(1)
+                product_id, product_title = determine_version(version, product_info)
+                print(product_id, product_title)
+                if any(target[0] == product_id for target in targets):
+                    continue
+                workdir = args.workdir
+                if len(versions) > 1:
+                    workdir = os.path.join(args.workdir, product_id)
+                targets.append((product_id, product_title, workdir, priority))
+
+        # download all the packages for the selected products
+        with telemetry.phase('replicate', product_id=','.join(target[0] for target in targets)):
+            failed = replicate_products(catalog, targets, ignore_cache=args.ignore_cache,
+                                        convert_path=args.convert,
+                                        convert_format=args.convert_format,
+                                        convert_jobs=args.convert_jobs, store=store,
+                                        jobs=args.download_jobs)
+        if failed:
+            print('Could not download %s.' % ', '.join(sorted(failed)), file=sys.stderr)
+            exit(-1)
+    finally:
+        telemetry.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,433 @@
 #!/usr/bin/env python3
 import plistlib
+import argparse
+import hashlib
 import base64
+import json
+import glob
 import os
 import sys
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# Fields holding binary data in OpenCore patch entries. Patch sets written
+# as JSON or YAML give them as base64 strings.
+DATA_KEYS = ('Find', 'Replace', 'Mask', 'ReplaceMask')
+
+# Fields that do not change what a patch does, and so are left out of its
+# fingerprint
+UNFINGERPRINTED_KEYS = ('Comment', 'Enabled')
+
+# What OpenCore assumes for fields a patch entry leaves out. A field set to
+# its default is left out of the fingerprint too, so that an entry spelling
+# out Skip = 0 matches one that omits it.
+DEFAULT_VALUES = {
+    'Arch': 'Any',
+    'Base': '',
+    'BaseSkip': 0,
+    'Count': 0,
+    'Limit': 0,
+    'Mask': b'',
+    'MaxKernel': '',
+    'MinKernel': '',
+    'ReplaceMask': b'',
+    'Skip': 0,
+    'TableLength': 0,
+}
+
+# The two Sonoma VM BT Enabler patches, used when no patch set is given
+SONOMA_BT_PATCH_SET = {
+    'Kernel': {
+        'Patch': [
+            {
+                'Arch': 'x86_64',
+                'Base': '',
+                'Comment': 'Sonoma VM BT Enabler - PART 1 of 2 - Patch kern.hv_vmm_present=0',
+                'Count': 1,
+                'Enabled': True,
+                'Find': base64.b64decode('aGliZXJuYXRlaGlkcmVhZHkAaGliZXJuYXRlY291bnQA'),
+                'Identifier': 'kernel',
+                'Limit': 0,
+                'Mask': b'',
+                'MaxKernel': '',
+                'MinKernel': '20.4.0',
+                'Replace': base64.b64decode('aGliZXJuYXRlaGlkcmVhZHkAaHZfdm1tX3ByZXNlbnQA'),
+                'ReplaceMask': b'',
+                'Skip': 0,
+            },
+            {
+                'Arch': 'x86_64',
+                'Base': '',
+                'Comment': 'Sonoma VM BT Enabler - PART 2 of 2 - Patch kern.hv_vmm_present=0',
+                'Count': 1,
+                'Enabled': True,
+                'Find': base64.b64decode('Ym9vdCBzZXNzaW9uIFVVSUQAaHZfdm1tX3ByZXNlbnQA'),
+                'Identifier': 'kernel',
+                'Limit': 0,
+                'Mask': b'',
+                'MaxKernel': '',
+                'MinKernel': '22.0.0',
+                'Replace': base64.b64decode('Ym9vdCBzZXNzaW9uIFVVSUQAaGliZXJuYXRlY291bnQA'),
+                'ReplaceMask': b'',
+                'Skip': 0,
+            },
+        ],
+    },
+}
+
+
+class PatchSetError(Exception):
+    pass
+
+
+def decode_data_keys(node):
+    # JSON and YAML have no data type, so binary fields arrive as base64
+    if isinstance(node, dict):
+        return {key: (base64.b64decode(value) if key in DATA_KEYS and isinstance(value, str)
+                      else decode_data_keys(value))
+                for key, value in node.items()}
+    if isinstance(node, list):
+        return [decode_data_keys(value) for value in node]
+    return node
+
+
+def load_patch_set(path):
+    """Reads a patch set: a plist, JSON or YAML file shaped like the part of
+    config.plist it extends, e.g. {'Kernel': {'Patch': [...]}}. Every list
+    in it holds entries to add to the list at the same place in config.plist."""
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, 'rb') as f:
+            if extension == '.json':
+                patch_set = decode_data_keys(json.load(f))
+            elif extension in ('.yaml', '.yml'):
+                try:
+                    import yaml
+                except ImportError:
+                    raise PatchSetError(f"Reading {path} requires PyYAML (pip install pyyaml)")
+                patch_set = decode_data_keys(yaml.safe_load(f))
+            else:
+                patch_set = plistlib.load(f)
+    except (OSError, ValueError) as err:
+        raise PatchSetError(f"Could not read patch set {path}: {err}")
+    if not isinstance(patch_set, dict) or not list(patch_lists(patch_set)):
+        raise PatchSetError(f"Patch set {path} does not contain any patch lists")
+    for key_path, entries in patch_lists(patch_set):
+        for index, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                raise PatchSetError(f"Patch set {path}: entry {index + 1} of "
+                                    f"{' -> '.join(key_path)} is not a dictionary")
+    return patch_set
+
+
+def patch_lists(patch_set, path=()):
+    # yields (key path, entries) for every list in a patch set
+    for key, value in patch_set.items():
+        if isinstance(value, list):
+            yield path + (key,), value
+        elif isinstance(value, dict):
+            yield from patch_lists(value, path + (key,))
+
+
+def canonical(value):
+    if isinstance(value, bytes):
+        return {'data': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, dict):
+        return {key: canonical(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [canonical(item) for item in value]
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def fingerprint(entry):
+    """Identifies a patch entry by what it does, ignoring its comment,
+    whether it is enabled and fields left at their defaults, so renamed,
+    disabled or more terse copies are recognised"""
+    if not isinstance(entry, dict):
+        return None
+    fields = {key: value for key, value in entry.items()
+              if key not in UNFINGERPRINTED_KEYS and
+              not (key in DEFAULT_VALUES and value == DEFAULT_VALUES[key])}
+    data = json.dumps(canonical(fields), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def patch_set_digest(patch_set):
+    data = json.dumps(canonical(patch_set), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def is_enabled(entry):
+    # OpenCore skips entries without Enabled
+    return entry.get('Enabled', False) is True
+
+
+def apply_patch_set(config, patch_set):
+    """Adds the entries of patch_set that config does not have yet, and
+    enables disabled copies of the enabled ones. Returns (added, enabled,
+    present) lists of entry comments, or raises KeyError naming a list the
+    config lacks."""
+    added = []
+    enabled = []
+    present = []
+    for path, entries in patch_lists(patch_set):
+        target = config
+        for key in path:
+            if not isinstance(target, dict) or key not in target:
+                raise KeyError(' -> '.join(path))
+            target = target[key]
+        if not isinstance(target, list):
+            raise KeyError(' -> '.join(path))
+        existing = {fingerprint(entry): entry for entry in target}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                raise ValueError(f"entry in {' -> '.join(path)} of the patch set "
+                                 f"is not a dictionary")
+            label = entry.get('Comment', fingerprint(entry)[:12])
+            copy = existing.get(fingerprint(entry))
+            if copy is None:
+                target.append(entry)
+                existing[fingerprint(entry)] = entry
+                added.append(label)
+            elif is_enabled(entry) and not is_enabled(copy):
+                copy['Enabled'] = True
+                enabled.append(label)
+            else:
+                present.append(label)
+    return added, enabled, present
+
+
+def read_plist(config_path):
+    """Returns (config, prefix). The config.plist templates start with XML
+    comments ahead of the <?xml declaration, which plistlib rejects; they
+    are returned as prefix and written back unchanged."""
+    with open(config_path, 'rb') as f:
+        data = f.read()
+    start = data.find(b'<?xml')
+    prefix = data[:start] if start > 0 else b''
+    return plistlib.loads(data[len(prefix):]), prefix
+
+
+def write_plist_atomically(config, config_path, prefix=b''):
+    directory = os.path.dirname(os.path.abspath(config_path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(config_path) + '.',
+                                    dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(prefix)
+            plistlib.dump(config, f)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(config_path, tmp_path)
+        os.replace(tmp_path, config_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def patch_file(config_path, patch_set, backup=True, dry_run=False):
+    """Applies a patch set to one config.plist. Returns a report dict with
+    the path, a status of patched, unchanged, skipped or failed, and the
+    entries added, enabled or already present."""
+    report = {'path': config_path, 'status': 'unchanged', 'added': [], 'enabled': [],
+              'present': []}
+    try:
+        config, prefix = read_plist(config_path)
+        report['added'], report['enabled'], report['present'] = apply_patch_set(
+            config, patch_set)
+        if report['added'] or report['enabled']:
+            report['status'] = 'patched'
+            if not dry_run:
+                if backup:
+                    shutil.copy2(config_path, config_path + '.backup')
+                write_plist_atomically(config, config_path, prefix)
+    except KeyError as err:
+        report['status'] = 'skipped'
+        report['error'] = f"no {err.args[0]} section"
+    except (OSError, ValueError) as err:
+        report['status'] = 'failed'
+        report['error'] = str(err)
+    return report
+
+
+def _patch_file(args):
+    return patch_file(*args)
+
+
+def find_config_plists(targets, pattern='*config.plist'):
+    """Expands files, directories (searched recursively for pattern) and
+    globs into a sorted list of config.plist paths"""
+    paths = set()
+    for target in targets:
+        if os.path.isdir(target):
+            paths.update(glob.glob(os.path.join(target, '**', pattern), recursive=True))
+        elif os.path.exists(target):
+            paths.add(target)
+        else:
+            paths.update(path for path in glob.glob(target, recursive=True)
+                         if os.path.isfile(path))
+    return sorted(paths)
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_path, state):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def patch_files(paths, patch_set, jobs=None, backup=True, dry_run=False, state_path=None):
+    """Applies a patch set to many config.plists across a process pool.
+    With state_path, files already known to be patched with this patch set
+    and unchanged since are not even opened."""
+    digest = patch_set_digest(patch_set)
+    state = load_state(state_path) if state_path else {}
+    reports = []
+    todo = []
+    for path in paths:
+        key = os.path.abspath(path)
+        try:
+            if state.get(key) == [digest] + file_stamp(path):
+                reports.append({'path': path, 'status': 'unchanged', 'added': [],
+                                'enabled': [], 'present': [], 'cached': True})
+                continue
+        except OSError:
+            pass
+        todo.append(path)
+
+    if len(todo) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            reports += pool.map(_patch_file, [(path, patch_set, backup, dry_run) for path in todo],
+                                chunksize=max(1, len(todo) // (4 * (jobs or os.cpu_count() or 1))))
+    else:
+        reports += [patch_file(path, patch_set, backup, dry_run) for path in todo]
+
+    if state_path and not dry_run:
+        for report in reports:
+            if report['status'] in ('patched', 'unchanged'):
+                state[os.path.abspath(report['path'])] = [digest] + file_stamp(report['path'])
+        save_state(state_path, state)
+    return sorted(reports, key=lambda report: report['path'])
+
+
+def summarize(reports):
+    summary = {'total': len(reports)}
+    for status in ('patched', 'unchanged', 'skipped', 'failed'):
+        summary[status] = sum(1 for report in reports if report['status'] == status)
+    return summary
+
 
 def add_kernel_patches(config_path):
-    # Make a backup of the original file
+    # Single-file mode: the two Sonoma VM BT Enabler patches. As it always
+    # has, this mode keeps a .backup whether or not anything changes.
     backup_path = config_path + '.backup'
-    os.system(f'cp "{config_path}" "{backup_path}"')
+    try:
+        shutil.copy2(config_path, backup_path)
+    except OSError as err:
+        print(f"Error: Could not create {backup_path}: {err}")
+        return False
     print(f"Backup created at {backup_path}")
-    
-    # Read the plist file
-    with open(config_path, 'rb') as f:
-        config = plistlib.load(f)
-    
-    # Prepare the patch entries
-    patch1 = {
-        'Arch': 'x86_64',
-        'Base': '',
-        'Comment': 'Sonoma VM BT Enabler - PART 1 of 2 - Patch kern.hv_vmm_present=0',
-        'Count': 1,
-        'Enabled': True,
-        'Find': base64.b64decode('aGliZXJuYXRlaGlkcmVhZHkAaGliZXJuYXRlY291bnQA'),
-        'Identifier': 'kernel',
-        'Limit': 0,
-        'Mask': b'',
-        'MaxKernel': '',
-        'MinKernel': '20.4.0',
-        'Replace': base64.b64decode('aGliZXJuYXRlaGlkcmVhZHkAaHZfdm1tX3ByZXNlbnQA'),
-        'ReplaceMask': b'',
-        'Skip': 0,
-    }
-    
-    patch2 = {
-        'Arch': 'x86_64',
-        'Base': '',
-        'Comment': 'Sonoma VM BT Enabler - PART 2 of 2 - Patch kern.hv_vmm_present=0',
-        'Count': 1,
-        'Enabled': True,
-        'Find': base64.b64decode('Ym9vdCBzZXNzaW9uIFVVSUQAaHZfdm1tX3ByZXNlbnQA'),
-        'Identifier': 'kernel',
-        'Limit': 0,
-        'Mask': b'',
-        'MaxKernel': '',
-        'MinKernel': '22.0.0',
-        'Replace': base64.b64decode('Ym9vdCBzZXNzaW9uIFVVSUQAaGliZXJuYXRlY291bnQA'),
-        'ReplaceMask': b'',
-        'Skip': 0,
-    }
-    
-    # Add patches to the kernel patch section
-    if 'Kernel' in config and 'Patch' in config['Kernel']:
-        # Check if patches already exist
-        patch_exists = False
-        for patch in config['Kernel']['Patch']:
-            if isinstance(patch, dict) and 'Comment' in patch:
-                if 'Sonoma VM BT Enabler' in patch['Comment']:
-                    patch_exists = True
-                    print(f"Patch already exists: {patch['Comment']}")
-        
-        if not patch_exists:
-            config['Kernel']['Patch'].append(patch1)
-            config['Kernel']['Patch'].append(patch2)
-            print("Added both Sonoma VM BT Enabler patches to config.plist")
-        
-    else:
+    report = patch_file(config_path, SONOMA_BT_PATCH_SET, backup=False)
+    for comment in report['present']:
+        print(f"Patch already exists: {comment}")
+    for comment in report['enabled']:
+        print(f"Enabled existing patch: {comment}")
+    if report['status'] == 'skipped':
         print("Error: Could not find Kernel -> Patch section in config.plist")
         return False
-    
-    # Write the updated plist file
-    with open(config_path, 'wb') as f:
-        plistlib.dump(config, f)
-    
+    if report['status'] == 'failed':
+        print(f"Error: {report['error']}")
+        return False
+    if report['added']:
+        print(f"Added {len(report['added'])} Sonoma VM BT Enabler patches to config.plist")
     print(f"Successfully updated {config_path}")
     return True
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python apply_appleid_kernelpatch.py /path/to/config.plist")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Add kernel patches to OpenCore config.plists. With a single '
+                    'config.plist and no options, adds the Sonoma VM BT Enabler patches.')
+    parser.add_argument('targets', nargs='+',
+                        help='config.plist files, directories to search, or globs')
+    parser.add_argument('--patch-set', metavar='FILE',
+                        help='plist, JSON or YAML patch set to apply instead of the '
+                             'Sonoma VM BT Enabler patches')
+    parser.add_argument('--pattern', default='*config.plist',
+                        help='file name pattern searched for in directories '
+                             '(default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('--no-backup', action='store_true',
+                        help='do not keep a .backup copy of patched files')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would change without writing anything')
+    parser.add_argument('--state', metavar='FILE',
+                        help='remember patched files here, so unchanged files are '
+                             'skipped without being read on the next run')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write a JSON report of every file to FILE')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print one line per file')
+    args = parser.parse_args()
+
+    single = (len(args.targets) == 1 and os.path.isfile(args.targets[0]) and
+              not any((args.patch_set, args.no_backup, args.dry_run, args.state,
+                       args.report, args.verbose)))
+    if single:
+        success = add_kernel_patches(args.targets[0])
+        if success:
+            print("Patches applied successfully. Please reboot to apply changes.")
+        else:
+            print("Failed to apply patches.")
+            sys.exit(1)
+        return
+
+    try:
+        patch_set = load_patch_set(args.patch_set) if args.patch_set else SONOMA_BT_PATCH_SET
+    except PatchSetError as err:
+        print(f"Error: {err}")
         sys.exit(1)
-    
-    config_path = sys.argv[1]
-    if not os.path.exists(config_path):
-        print(f"Error: File {config_path} does not exist")
+
+    paths = find_config_plists(args.targets, args.pattern)
+    if not paths:
+        print("Error: No config.plist files found")
         sys.exit(1)
-    
-    success = add_kernel_patches(config_path)
-    if success:
-        print("Patches applied successfully. Please reboot to apply changes.")
-    else:
-        print("Failed to apply patches.")
\ No newline at end of file
+
+    reports = patch_files(paths, patch_set, jobs=args.jobs, backup=not args.no_backup,
+                          dry_run=args.dry_run, state_path=args.state)
+    for report in reports:
+        if args.verbose or report['status'] == 'failed':
+            detail = report.get('error') or ', '.join(
+                report['added'] + [f"{comment} (enabled)" for comment in report['enabled']])
+            print(f"{report['status']:9} {report['path']}" + (f": {detail}" if detail else ''))
+    summary = summarize(reports)
+    print(', '.join(f"{count} {status}" for status, count in summary.items()) +
+          (' (dry run)' if args.dry_run else ''))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'summary': summary, 'files': reports}, f, indent=2)
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
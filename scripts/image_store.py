@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Prepared-image store shared by the containers on a host.
+
+Without it every container converts its own BaseSystem.dmg with
+qemu-img convert, and holds its own copy of every disk image. The store
+keeps each prepared image once, keyed by the SHA-256 of its source file
+and the conversion parameters (format, compression), and hands every
+container a qcow2 overlay backed by the read-only prepared image. Only
+the first container to ask for a given source converts it; the others
+wait on its lock and then take an overlay, which takes milliseconds.
+
+Layout under the store directory, which must be mounted at the same path
+in every container since overlays record the absolute backing path:
+
+    entries/<key>/image.<format>   prepared images, read-only
+    entries/<key>.lock             held while an entry is converted
+    refs/<name>                    key of the entry a name points to, and
+                                   when it was last checked against a source
+    digests.json                   source digests, by path, size and mtime
+    digests.lock                   held while digests.json is rewritten
+
+Usage: image_store.py --store /image-store prepare --output BaseSystem.img
+           [--source BaseSystem.dmg] [--ref sequoia] [--format qcow2] [--compress]
+           [--keep-existing]
+       image_store.py --store /image-store list
+
+scripts/prepare_images.sh runs prepare for the Dockerfiles' CMD.
+
+prepare exits 3 when --ref is not in the store and there is no --source,
+so that callers can download the source and try again. A ref is only
+trusted for --ref-ttl seconds after it was last checked against a source;
+after that it is reported as missing too, so that a newer source for the
+same name is downloaded and converted instead of serving the old image
+forever. With --source, the source always decides, and the ref is moved
+to it. With --keep-existing, a disk already at --output that is not an
+overlay from the store is left alone and prepare exits 4, before the
+source is hashed or imported."""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+FICLONE = 0x40049409
+READ_CHUNK_SIZE = 1024 * 1024
+NOT_IN_STORE = 3
+KEPT_EXISTING = 4
+# seconds a ref is used without its source before it must be checked again
+REF_TTL = 7 * 24 * 3600
+
+# Part of every key, so that changing how images are prepared does not
+# reuse entries prepared the old way
+PREPARE_VERSION = 1
+
+# --format source keeps the source image as it is instead of converting it
+FORMATS = ('qcow2', 'raw', 'source')
+
+
+class StoreError(Exception):
+    pass
+
+
+def image_format(path):
+    with open(path, 'rb') as f:
+        return 'qcow2' if f.read(4) == b'QFI\xfb' else 'raw'
+
+
+def copy_file(source, destination):
+    # reflink where the filesystem allows, never a hardlink: the source may
+    # still be written to after it was imported
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, READ_CHUNK_SIZE)
+
+
+class ImageStore:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.join(self.path, 'entries'), exist_ok=True)
+        os.makedirs(os.path.join(self.path, 'refs'), exist_ok=True)
+
+    def _lock(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def source_digest(self, source):
+        """SHA-256 of source, remembered by path, inode, size and mtime so
+        that multi-gigabyte disk images are only hashed once"""
+        stat = os.stat(source)
+        stamp = [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        digests_path = os.path.join(self.path, 'digests.json')
+        try:
+            with open(digests_path) as f:
+                digests = json.load(f)
+        except (OSError, ValueError):
+            digests = {}
+        key = os.path.realpath(source)
+        known = digests.get(key)
+        if known and known[:4] == stamp:
+            return known[4]
+        digest = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                digest.update(block)
+        # re-read under the lock, so that digests other containers added
+        # while this one was hashing are kept
+        fd = self._lock(os.path.join(self.path, 'digests.lock'))
+        try:
+            try:
+                with open(digests_path) as f:
+                    digests = json.load(f)
+            except (OSError, ValueError):
+                digests = {}
+            digests[key] = stamp + [digest.hexdigest()]
+            tmp_path = '%s.%d.tmp' % (digests_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(digests, f)
+            os.replace(tmp_path, digests_path)
+        finally:
+            self._unlock(fd)
+        return digest.hexdigest()
+
+    def entry_key(self, digest, output_format, compress):
+        parameters = '%s\0%s\0%d\0%d' % (digest, output_format, compress, PREPARE_VERSION)
+        return hashlib.sha256(parameters.encode('utf-8')).hexdigest()[:32]
+
+    def entry_image(self, key):
+        entry = os.path.join(self.path, 'entries', key)
+        for name in ('image.qcow2', 'image.raw'):
+            if os.path.exists(os.path.join(entry, name)):
+                return os.path.join(entry, name)
+        return None
+
+    def read_ref(self, ref):
+        """Returns (key, time the ref was last checked) of a ref, or None"""
+        try:
+            with open(os.path.join(self.path, 'refs', ref)) as f:
+                fields = f.read().split()
+        except OSError:
+            return None
+        if not fields:
+            return None
+        # refs written before they recorded a time count as never checked
+        checked = float(fields[1]) if len(fields) > 1 else 0.0
+        return fields[0], checked
+
+    def resolve(self, ref, ttl=REF_TTL):
+        """Returns the image a ref points to, or None if there is none or the
+        ref has not been checked against a source for ttl seconds"""
+        found = self.read_ref(ref)
+        if found is None:
+            return None
+        key, checked = found
+        if ttl is not None and time.time() - checked > ttl:
+            return None
+        return self.entry_image(key)
+
+    def set_ref(self, ref, key):
+        ref_path = os.path.join(self.path, 'refs', ref)
+        tmp_path = '%s.%d.tmp' % (ref_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write('%s %d\n' % (key, time.time()))
+        os.replace(tmp_path, ref_path)
+
+    def prepare(self, source, output_format='qcow2', compress=False):
+        """Returns the prepared image for source, converting it first if no
+        container has yet"""
+        if output_format == 'source':
+            compress = False
+        key = self.entry_key(self.source_digest(source), output_format, compress)
+        entry = os.path.join(self.path, 'entries', key)
+        fd = self._lock(entry + '.lock')
+        try:
+            image = self.entry_image(key)
+            if image:
+                return key, image
+            os.makedirs(entry, exist_ok=True)
+            if output_format == 'source':
+                image = os.path.join(entry, 'image.' + image_format(source))
+            else:
+                image = os.path.join(entry, 'image.' + output_format)
+            tmp_path = image + '.partial'
+            print(f"Preparing {source} as {image}")
+            if output_format == 'source':
+                copy_file(source, tmp_path)
+            else:
+                command = ['qemu-img', 'convert', source, '-O', output_format, '-p']
+                if compress and output_format == 'qcow2':
+                    command.append('-c')
+                subprocess.run(command + [tmp_path], check=True)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, image)
+            return key, image
+        finally:
+            self._unlock(fd)
+
+    def is_overlay(self, path):
+        """Whether path is a qcow2 overlay of an image in this store"""
+        if image_format(path) != 'qcow2':
+            return False
+        backing = backing_file(path) or ''
+        return backing.startswith(os.path.join(self.path, 'entries') + os.sep)
+
+    def entries(self):
+        entries_dir = os.path.join(self.path, 'entries')
+        refs_dir = os.path.join(self.path, 'refs')
+        refs = {}
+        for name in os.listdir(refs_dir):
+            if not name.endswith('.tmp'):
+                found = self.read_ref(name)
+                if found:
+                    refs.setdefault(found[0], []).append(name)
+        for key in sorted(os.listdir(entries_dir)):
+            image = self.entry_image(key) if not key.endswith('.lock') else None
+            if image:
+                yield key, image, os.stat(image).st_size, sorted(refs.get(key, []))
+
+
+def backing_file(path):
+    info = subprocess.run(['qemu-img', 'info', '--output=json', '-U', path], check=True,
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
+    info = json.loads(info)
+    return info.get('full-backing-filename') or info.get('backing-filename')
+
+
+def create_overlay(image, output):
+    """Creates a qcow2 overlay of image at output. An existing overlay of the
+    same image is kept, so that a restarted container keeps its writes; any
+    other existing, non-empty file is left alone."""
+    if os.path.exists(output) and os.path.getsize(output):
+        if image_format(output) == 'qcow2' and backing_file(output) == image:
+            return False
+        raise StoreError(f'{output} exists and is not an overlay of {image}')
+    tmp_path = '%s.%d.tmp' % (output, os.getpid())
+    subprocess.run(['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', image_format(image),
+                    '-b', image, tmp_path], check=True)
+    os.replace(tmp_path, output)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Share prepared disk images between containers through qcow2 overlays.')
+    parser.add_argument('--store', default=os.environ.get('IMAGE_STORE'),
+                        help='store directory (default: $IMAGE_STORE)')
+    commands = parser.add_subparsers(dest='command')
+    prepare = commands.add_parser('prepare', help='put an overlay of a prepared image at --output')
+    prepare.add_argument('--output', required=True, help='overlay to create')
+    prepare.add_argument('--source', help='image to prepare, e.g. BaseSystem.dmg')
+    prepare.add_argument('--ref', help='name to look the prepared image up by without '
+                                       'its source, e.g. the macOS SHORTNAME')
+    prepare.add_argument('--format', choices=FORMATS, default='qcow2',
+                         help='format to convert to, or source to keep the image as it is')
+    prepare.add_argument('--compress', action='store_true',
+                         help='compress converted qcow2 images')
+    prepare.add_argument('--keep-existing', action='store_true',
+                         help='leave a disk at --output that is not an overlay from the '
+                              'store alone, and exit %d' % KEPT_EXISTING)
+    prepare.add_argument('--ref-ttl', type=int, default=REF_TTL,
+                         help='seconds --ref is used without --source before it must '
+                              'be checked against a new source (default: %(default)s)')
+    commands.add_parser('list', help='list the prepared images')
+    args = parser.parse_args()
+
+    if not args.store:
+        print("Error: no store given, use --store or set IMAGE_STORE")
+        sys.exit(1)
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+    store = ImageStore(args.store)
+
+    if args.command == 'list':
+        for key, image, size, refs in store.entries():
+            print(f"{key}  {size / 1073741824.0:8.2f} GiB  {image}  {' '.join(refs)}")
+        return
+
+    # refs are scoped by the parameters, so that asking for a raw image by
+    # name never returns the compressed qcow2 one
+    ref = args.ref and '%s-%s%s' % (args.ref, args.format, '-compressed' if args.compress else '')
+    try:
+        if (args.keep_existing and os.path.exists(args.output) and
+                os.path.getsize(args.output) and not store.is_overlay(args.output)):
+            print(f"Keeping {args.output}, which is not an overlay from the image store")
+            sys.exit(KEPT_EXISTING)
+        if args.source and os.path.exists(args.source):
+            # the source decides, so that a ref follows a newer source
+            key, image = store.prepare(args.source, args.format, args.compress)
+            if ref:
+                store.set_ref(ref, key)
+        else:
+            image = store.resolve(ref, args.ref_ttl) if ref else None
+            if image is None:
+                print(f"{args.ref or args.source} is not in the image store, "
+                      f"or is due to be checked against its source")
+                sys.exit(NOT_IN_STORE)
+        if create_overlay(image, args.output):
+            print(f"Created {args.output} backed by {image}")
+    except (OSError, StoreError, subprocess.CalledProcessError) as err:
+        print(f"Error: {err}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+"""Builds the QEMU command line of the Docker-OSX VM from the container's
+environment and the host's topology, in place of the tee-built Launch.sh.
+
+LAUNCH_PROFILE=compat (the default) gives the same QEMU options as
+Launch.sh, with RAM=max and RAM=half resolved from /proc/meminfo, and
+takes ownership of /dev/kvm and /dev/snd the way Launch.sh does.
+LAUNCH_PROFILE=tuned turns on:
+
+  - CPU_PINNING: every vCPU thread is pinned to its own host CPU,
+    preferring one NUMA node and one thread per physical core, with QEMU's
+    other threads kept off those CPUs. Guest memory is bound to that node.
+    A cpulist such as 2-9 limits the host CPUs used.
+  - HUGEPAGES: guest memory is backed by free 2M or 1G hugepages when
+    there are enough of them.
+  - DISK_AIO: io_uring when the kernel (and the container's seccomp
+    profile) allows it, native with DISK_CACHE=none, threads otherwise.
+    QEMU only accepts aio=native with O_DIRECT, so DISK_AIO=native
+    defaults DISK_CACHE to none and refuses a cache mode that is not.
+  - DISK_BUS=virtio puts the macOS disk and the installer on virtio-blk
+    with one iothread each. AHCI disks can not use iothreads.
+  - NETWORK_BACKEND=tap uses TAP_DEVICE with vhost-net, and multiqueue
+    virtio-net (NET_QUEUES, one queue per vCPU by default) when NETWORKING
+    is virtio-net-pci.
+
+Every one of these can also be set on its own, under either profile.
+QEMU has no option for vCPU affinity, so with pinning QEMU is started
+with a QMP socket, the vCPU thread IDs are read from it and pinned, and
+this script then waits for QEMU to exit.
+
+Usage: launch_profile.py [--dry-run] [-- extra qemu arguments]"""
+import argparse
+import ctypes
+import glob
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+OSX_KVM = '/home/arch/OSX-KVM'
+DEFAULT_CPUID_FLAGS = ('vendor=GenuineIntel,+invtsc,vmware-cpuid-freq=on,+ssse3,+sse4.2,'
+                       '+popcnt,+avx,+aes,+xsave,+xsaveopt,check,')
+OSK = 'ourhardworkbythesewordsguardedpleasedontsteal(c)AppleComputerInc'
+IO_URING_SETUP = 425
+MAX_NET_QUEUES = 8
+
+TUNED = {
+    'CPU_PINNING': 'auto',
+    'HUGEPAGES': 'auto',
+    'DISK_AIO': 'auto',
+}
+
+
+def setting(env, name, default=''):
+    """A tuning setting: the env var if set, else the profile's default"""
+    value = env.get(name)
+    if value is None and env.get('LAUNCH_PROFILE') == 'tuned':
+        value = TUNED.get(name)
+    return default if value is None else value
+
+
+def is_on(value):
+    return value.lower() in ('1', 'true', 'yes', 'on', 'auto')
+
+
+def read_file(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def parse_cpulist(text):
+    # '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in filter(None, (text or '').split(',')):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def meminfo(root='/'):
+    """/proc/meminfo as {field: kB}"""
+    info = {}
+    for line in (read_file(os.path.join(root, 'proc/meminfo'), '') or '').splitlines():
+        name, _, value = line.partition(':')
+        if value.split():
+            info[name] = int(value.split()[0])
+    return info
+
+
+def resolve_ram(ram, root='/'):
+    # RAM is in GB, as QEMU is given "${RAM}000" megabytes
+    if ram in ('max', 'half'):
+        total = meminfo(root).get('MemTotal', 4000000)
+        return str(total // (1000000 if ram == 'max' else 2000000))
+    return ram or '4'
+
+
+def ram_megabytes(ram):
+    """RAM, in GB and possibly fractional, as QEMU's -m megabytes"""
+    try:
+        return int(round(float(ram) * 1000))
+    except ValueError:
+        raise SystemExit('Error: RAM must be a number of GB, max or half, not %s' % ram)
+
+
+def smp_cpus(smp):
+    """The vCPU count of a QEMU -smp value: its cpus= key or leading count,
+    e.g. 8,sockets=1,cores=4,threads=2, or else the product of the
+    topology, e.g. sockets=1,cores=4,threads=2"""
+    options = {}
+    try:
+        for index, part in enumerate(smp.split(',')):
+            name, sep, value = part.partition('=')
+            if not sep and index == 0:
+                name, value = 'cpus', name
+            options[name.strip()] = int(value)
+    except ValueError:
+        raise SystemExit('Error: could not read the vCPU count from -smp %s' % smp)
+    if 'cpus' in options:
+        return options['cpus']
+    topology = [options[name] for name in ('sockets', 'dies', 'clusters', 'cores', 'threads')
+                if name in options]
+    if not topology:
+        return options.get('maxcpus', 1)
+    count = 1
+    for value in topology:
+        count *= value
+    return count
+
+
+def host_topology(root='/'):
+    """One {'cpu', 'core', 'package', 'node'} per online host CPU"""
+    cpu_dir = os.path.join(root, 'sys/devices/system/cpu')
+    nodes = {}
+    for node_dir in glob.glob(os.path.join(root, 'sys/devices/system/node/node[0-9]*')):
+        node = int(os.path.basename(node_dir)[4:])
+        for cpu in parse_cpulist(read_file(os.path.join(node_dir, 'cpulist'))):
+            nodes[cpu] = node
+    online = parse_cpulist(read_file(os.path.join(cpu_dir, 'online')))
+    if not online:
+        online = sorted(os.sched_getaffinity(0))
+    allowed = os.sched_getaffinity(0) if root == '/' else set(online)
+    topology = []
+    for cpu in online:
+        if cpu not in allowed:
+            continue
+        topology_dir = os.path.join(cpu_dir, 'cpu%d' % cpu, 'topology')
+        topology.append({
+            'cpu': cpu,
+            'core': int(read_file(os.path.join(topology_dir, 'core_id'), cpu)),
+            'package': int(read_file(os.path.join(topology_dir, 'physical_package_id'), 0)),
+            'node': nodes.get(cpu, 0),
+        })
+    return topology
+
+
+def pick_cpus(topology, count, cpulist=None, prefer=None):
+    """Returns (host CPUs for count vCPUs, their NUMA node or None). Fills
+    one thread per physical core before using SMT siblings, stays on one
+    node when one is big enough (the prefer node if it is), and leaves
+    the first core to the host when there is room."""
+    if cpulist:
+        wanted = parse_cpulist(cpulist)
+        topology = [cpu for cpu in topology if cpu['cpu'] in wanted]
+    by_node = {}
+    for cpu in topology:
+        by_node.setdefault(cpu['node'], []).append(cpu)
+    candidates = [cpus for _, cpus in sorted(by_node.items()) if len(cpus) >= count]
+    preferred = by_node.get(prefer, [])
+    if len(preferred) >= count:
+        cpus = preferred
+    else:
+        cpus = max(candidates, key=len) if candidates else topology
+    node = cpus[0]['node'] if candidates and len(by_node) > 1 else None
+
+    cores = {}
+    for cpu in sorted(cpus, key=lambda cpu: cpu['cpu']):
+        cores.setdefault((cpu['package'], cpu['core']), []).append(cpu['cpu'])
+    cores = list(cores.values())
+    if not cpulist and len(cpus) - len(cores[0]) >= count:
+        cores = cores[1:]
+    ordered = [core[level] for level in range(max(map(len, cores)))
+               for core in cores if len(core) > level]
+    return ordered[:count], node
+
+
+def free_hugepages(size_kb, node=None, root='/'):
+    if node is None:
+        path = 'sys/kernel/mm/hugepages/hugepages-%dkB/free_hugepages' % size_kb
+    else:
+        path = 'sys/devices/system/node/node%d/hugepages/hugepages-%dkB/free_hugepages' % (
+            node, size_kb)
+    return int(read_file(os.path.join(root, path), 0))
+
+
+def hugepage_size(memory_mb, node=None, root='/'):
+    """The hugepage size, in kB, that can back memory_mb, or None"""
+    for size_kb in (1048576, 2048):
+        if (memory_mb * 1024) % size_kb == 0 and \
+                free_hugepages(size_kb, node, root) * size_kb >= memory_mb * 1024:
+            return size_kb
+    return None
+
+
+def io_uring_available():
+    """Probes io_uring_setup(), which seccomp profiles often block even
+    when the kernel has it"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        params = ctypes.create_string_buffer(120)
+        fd = libc.syscall(IO_URING_SETUP, 1, params)
+    except (OSError, AttributeError):
+        return False
+    if fd < 0:
+        return False
+    os.close(fd)
+    return True
+
+
+class LaunchProfile:
+    """The QEMU argv and the vCPU pinning plan for one environment"""
+
+    def __init__(self, env, root='/', extra=()):
+        self.env = env
+        self.root = root
+        self.args = ['qemu-system-x86_64']
+        self.notes = []
+        self.pinning = None
+        self.housekeeping = None
+        self.build(list(extra))
+
+    def add(self, *args):
+        self.args.extend(args)
+
+    def build(self, extra):
+        env = self.env
+        memory = ram_megabytes(resolve_ram(env.get('RAM', '4'), self.root))
+        smp = env.get('SMP') or '4'
+        # CPU_STRING replaces the whole -smp value, e.g. 8,sockets=1,cores=4,threads=2
+        vcpus = smp_cpus(env.get('CPU_STRING') or smp)
+        machine = ['q35', env.get('KVM', 'accel=kvm:tcg')]
+
+        node = self.plan_pinning(vcpus, memory)
+        backend = self.memory_backend(memory, node)
+        if backend:
+            self.add('-object', backend)
+            machine.append('memory-backend=mem0')
+
+        self.add('-m', '%d' % memory)
+        self.add('-cpu', '%s,%s%s' % (env.get('CPU') or 'Penryn',
+                                      env.get('CPUID_FLAGS') or DEFAULT_CPUID_FLAGS,
+                                      env.get('BOOT_ARGS', '')))
+        self.add('-machine', ','.join(filter(None, machine)))
+        self.add('-smp', env.get('CPU_STRING') or '%s,cores=%s' % (smp, env.get('CORES') or '4'))
+        self.add('-device', 'qemu-xhci,id=xhci')
+        self.add('-device', 'usb-kbd,bus=xhci.0', '-device', 'usb-tablet,bus=xhci.0')
+        self.add('-device', 'isa-applesmc,osk=%s' % OSK)
+        self.add('-drive', 'if=pflash,format=raw,readonly=on,file=%s/OVMF_CODE.fd' % OSX_KVM)
+        self.add('-drive', 'if=pflash,format=raw,file=%s/OVMF_VARS-1024x768.fd' % OSX_KVM)
+        self.add('-smbios', 'type=2')
+        self.add('-audiodev', '%s,id=hda' % (env.get('AUDIO_DRIVER') or 'alsa'),
+                 '-device', 'ich9-intel-hda', '-device', 'hda-duplex,audiodev=hda')
+        self.add('-device', 'ich9-ahci,id=sata')
+        self.disks()
+        self.network(vcpus)
+        self.add('-monitor', 'stdio')
+        self.add('-boot', 'menu=on')
+        self.add('-vga', 'vmware')
+        self.args.extend(shlex.split(env.get('EXTRA', '')))
+        self.args.extend(extra)
+
+    def plan_pinning(self, vcpus, memory_mb):
+        pinning = setting(self.env, 'CPU_PINNING', 'false')
+        if not is_on(pinning) and not pinning[:1].isdigit():
+            return None
+        topology = host_topology(self.root)
+        if len(topology) < vcpus:
+            self.notes.append('not pinning: %d vCPUs but only %d host CPUs'
+                              % (vcpus, len(topology)))
+            return None
+        # a node that can also hold guest memory in hugepages wins
+        prefer = None
+        if is_on(setting(self.env, 'HUGEPAGES', 'false')):
+            prefer = next((node for node in sorted({cpu['node'] for cpu in topology})
+                           if hugepage_size(memory_mb, node, self.root)), None)
+        cpus, node = pick_cpus(topology, vcpus, pinning if pinning[:1].isdigit() else None,
+                               prefer)
+        self.pinning = cpus
+        # QEMU's own threads stay on the vCPUs' node when there is room left
+        rest = [cpu['cpu'] for cpu in topology if cpu['cpu'] not in cpus
+                and (node is None or cpu['node'] == node)]
+        rest = rest or [cpu['cpu'] for cpu in topology if cpu['cpu'] not in cpus]
+        self.housekeeping = rest or None
+        for index, cpu in enumerate(cpus):
+            self.notes.append('pin vCPU %d to host CPU %d' % (index, cpu))
+        if rest:
+            self.notes.append('QEMU main and I/O threads on host CPUs %s'
+                              % ','.join(map(str, rest)))
+        if node is not None:
+            self.notes.append('guest memory bound to NUMA node %d' % node)
+        return node
+
+    def memory_backend(self, memory_mb, node):
+        options = []
+        hugepages = setting(self.env, 'HUGEPAGES', 'false')
+        size_kb = None
+        if is_on(hugepages):
+            size_kb = hugepage_size(memory_mb, node, self.root)
+            if size_kb is None:
+                message = 'not enough free hugepages for %d MB' % memory_mb
+                if hugepages.lower() != 'auto':
+                    raise SystemExit('Error: ' + message)
+                self.notes.append(message)
+        if size_kb:
+            options += ['memory-backend-memfd', 'hugetlb=on',
+                        'hugetlbsize=%dM' % (size_kb // 1024), 'prealloc=on']
+            self.notes.append('guest memory on %s hugepages'
+                              % ('1G' if size_kb == 1048576 else '2M'))
+        elif node is not None:
+            options += ['memory-backend-ram']
+        else:
+            return None
+        options[1:1] = ['id=mem0', 'size=%dM' % memory_mb]
+        if node is not None:
+            options += ['host-nodes=%d' % node, 'policy=bind']
+        return ','.join(options)
+
+    def drive_options(self):
+        cache = setting(self.env, 'DISK_CACHE')
+        aio = setting(self.env, 'DISK_AIO')
+        if aio == 'native':
+            if not cache:
+                cache = 'none'
+                self.notes.append('disk cache=none, as aio=native needs it')
+            elif cache not in ('none', 'directsync'):
+                raise SystemExit('Error: DISK_AIO=native needs DISK_CACHE=none or directsync, '
+                                 'not %s' % cache)
+        if aio == 'auto':
+            if io_uring_available():
+                aio = 'io_uring'
+            elif cache in ('none', 'directsync'):
+                aio = 'native'
+            else:
+                aio = 'threads'
+            self.notes.append('disk aio=%s' % aio)
+        return ''.join(',%s=%s' % option for option in (('cache', cache), ('aio', aio))
+                       if option[1])
+
+    def disks(self):
+        env = self.env
+        options = self.drive_options()
+        virtio = setting(env, 'DISK_BUS', 'sata') == 'virtio'
+        self.add('-drive', 'id=OpenCoreBoot,if=none,snapshot=on,format=qcow2,file=%s' % (
+            env.get('BOOTDISK') or '%s/OpenCore/OpenCore.qcow2' % OSX_KVM))
+        self.add('-device', 'ide-hd,bus=sata.2,drive=OpenCoreBoot')
+        disks = [('InstallMedia', '%s/BaseSystem.img' % OSX_KVM,
+                  env.get('BASESYSTEM_FORMAT') or 'qcow2', 'sata.3'),
+                 ('MacHDD', env.get('IMAGE_PATH') or '%s/mac_hdd_ng.img' % OSX_KVM,
+                  env.get('IMAGE_FORMAT') or 'qcow2', 'sata.4')]
+        for iothread, (name, path, image_format, bus) in enumerate(disks):
+            self.add('-drive', 'id=%s,if=none,file=%s,format=%s%s' % (
+                name, path, image_format, options))
+            if virtio:
+                self.add('-object', 'iothread,id=io%d' % iothread)
+                self.add('-device', 'virtio-blk-pci,drive=%s,iothread=io%d' % (name, iothread))
+            else:
+                self.add('-device', 'ide-hd,bus=%s,drive=%s' % (bus, name))
+
+    def network(self, vcpus):
+        env = self.env
+        model = env.get('NETWORKING') or 'vmxnet3'
+        device = '%s,netdev=net0,id=net0,mac=%s' % (model,
+                                                    env.get('MAC_ADDRESS') or '52:54:00:09:49:17')
+        if setting(env, 'NETWORK_BACKEND', 'user') == 'tap':
+            netdev = 'tap,id=net0,ifname=%s,script=no,downscript=no' % (
+                env.get('TAP_DEVICE') or 'tap0')
+            if os.access(os.path.join(self.root, 'dev/vhost-net'), os.R_OK | os.W_OK):
+                netdev += ',vhost=on'
+            else:
+                self.notes.append('no access to /dev/vhost-net, not using vhost')
+            queues = min(int(env.get('NET_QUEUES') or vcpus), MAX_NET_QUEUES)
+            if model == 'virtio-net-pci' and queues > 1:
+                netdev += ',queues=%d' % queues
+                device += ',mq=on,vectors=%d' % (2 * queues + 2)
+            self.add('-netdev', netdev)
+        else:
+            forwards = ['hostfwd=tcp::%s-:22' % (env.get('INTERNAL_SSH_PORT') or '10022'),
+                        'hostfwd=tcp::%s-:5900' % (env.get('SCREEN_SHARE_PORT') or '5900')]
+            self.add('-netdev', ','.join(['user', 'id=net0'] + forwards +
+                                         [env.get('ADDITIONAL_PORTS', '').strip(',')]).rstrip(','))
+        self.add('-device', device)
+
+    def script(self):
+        """The argv as a readable shell command, one option per line"""
+        lines = ['# ' + note for note in self.notes]
+        line = [self.args[0]]
+        for arg in self.args[1:]:
+            if arg.startswith('-'):
+                lines.append(' '.join(line) + ' \\')
+                line = []
+            line.append(shlex.quote(arg))
+        lines.append(' '.join(line))
+        return '\n'.join(lines)
+
+
+def claim_devices():
+    """Makes /dev/kvm and /dev/snd ours, as Launch.sh does, for containers
+    where they are owned by a group the arch user is not in"""
+    owner = '%d:%d' % (os.getuid(), os.getgid())
+    for args in (['chown', owner, '/dev/kvm'], ['chown', '-R', owner, '/dev/snd']):
+        try:
+            subprocess.run(['sudo'] + args, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        except OSError:
+            pass
+
+
+def qmp_command(sock, reader, command):
+    sock.sendall(json.dumps({'execute': command}).encode('utf-8') + b'\n')
+    for line in reader:
+        reply = json.loads(line)
+        if 'return' in reply or 'error' in reply:
+            if 'error' in reply:
+                raise RuntimeError(reply['error'].get('desc', command))
+            return reply['return']
+    raise RuntimeError('QMP connection closed')
+
+
+def run_pinned(profile):
+    """Starts QEMU, pins its threads through QMP and waits for it"""
+    qmp_path = '/tmp/launch-profile-%d.qmp' % os.getpid()
+    args = profile.args + ['-qmp', 'unix:%s,server=on,wait=off' % qmp_path]
+    if profile.housekeeping:
+        args = ['taskset', '-c', ','.join(map(str, profile.housekeeping))] + args
+    process = subprocess.Popen(args)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: process.send_signal(signum))
+    try:
+        for _ in range(100):
+            if process.poll() is not None:
+                return process.returncode
+            try:
+                sock = socket.socket(socket.AF_UNIX)
+                sock.connect(qmp_path)
+                break
+            except OSError:
+                sock.close()
+                time.sleep(0.1)
+        else:
+            print("launch_profile: QMP socket never appeared, vCPUs are not pinned",
+                  file=sys.stderr)
+            return process.wait()
+        with sock, sock.makefile('r') as reader:
+            reader.readline()
+            qmp_command(sock, reader, 'qmp_capabilities')
+            for vcpu in qmp_command(sock, reader, 'query-cpus-fast'):
+                os.sched_setaffinity(vcpu['thread-id'], {profile.pinning[vcpu['cpu-index']]})
+    except (OSError, RuntimeError, ValueError) as err:
+        print(f"launch_profile: could not pin vCPUs: {err}", file=sys.stderr)
+    finally:
+        try:
+            os.unlink(qmp_path)
+        except OSError:
+            pass
+    return process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Launch the Docker-OSX VM with a QEMU command line built from the '
+                    'environment and the host topology.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the QEMU command line and pinning plan instead of running it')
+    parser.add_argument('--json', action='store_true',
+                        help='with --dry-run, print the argv and plan as JSON')
+    parser.add_argument('--sysroot', metavar='path', default='/',
+                        help='read /proc and /sys under this directory, to review the '
+                             'profile of another host')
+    parser.add_argument('extra', nargs='*', help='extra QEMU arguments, after --')
+    args = parser.parse_args()
+
+    profile = LaunchProfile(os.environ, root=args.sysroot, extra=args.extra)
+    if args.dry_run:
+        if args.json:
+            print(json.dumps({'argv': profile.args, 'pinning': profile.pinning,
+                              'housekeeping': profile.housekeeping,
+                              'notes': profile.notes}, indent=2))
+        else:
+            print(profile.script())
+        return
+    for note in profile.notes:
+        print('# ' + note)
+    sys.stdout.flush()
+    claim_devices()
+    if profile.pinning:
+        sys.exit(run_pinned(profile))
+    os.execvp(profile.args[0], profile.args)
+
+
+if __name__ == "__main__":
+    main()
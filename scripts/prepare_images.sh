@@ -0,0 +1,43 @@
+#!/bin/bash
+# Sourced by the CMD of every Dockerfile before the VM is started, so that
+# what it exports reaches Launch.sh and launch_profile.py:
+#
+#   source ./Docker-OSX/scripts/prepare_images.sh
+#
+# BASESYSTEM_IMAGE (BaseSystem.img), if missing, is downloaded for SHORTNAME
+# and converted to a compressed qcow2 image.
+#
+# IMAGE_STORE is a directory shared by all containers on a host, mounted at
+# the same path in each: -v /var/lib/docker-osx:/image-store -e IMAGE_STORE=/image-store
+# BaseSystem.img then becomes a qcow2 overlay of an image converted once per
+# host. A SHORTNAME found in the store is re-checked against a fresh download
+# weekly, so that a newer BaseSystem.dmg for it replaces the stored image.
+#
+# With IMAGE_STORE and IMAGE_BASE set, a new disk at IMAGE_PATH becomes a
+# qcow2 overlay of IMAGE_BASE, imported into the store once, and IMAGE_FORMAT
+# is set to qcow2. A restarted container keeps its overlay. Any other disk
+# already at IMAGE_PATH, such as the one built into the auto images, is used
+# as it is and IMAGE_BASE is ignored.
+
+IMAGE_STORE_PY="$(dirname "${BASH_SOURCE[0]}")/image_store.py"
+
+! [[ -e "${BASESYSTEM_IMAGE:-BaseSystem.img}" ]] && [[ "${IMAGE_STORE}" ]] \
+    && "${IMAGE_STORE_PY}" prepare --ref "${SHORTNAME}" --compress \
+        --output "${BASESYSTEM_IMAGE:-BaseSystem.img}"
+
+! [[ -e "${BASESYSTEM_IMAGE:-BaseSystem.img}" ]] \
+    && printf '%s\n' "No BaseSystem.img available, downloading ${SHORTNAME}" \
+    && make \
+    && { [[ "${IMAGE_STORE}" ]] \
+        && "${IMAGE_STORE_PY}" prepare --source BaseSystem.dmg \
+            --ref "${SHORTNAME}" --compress --output "${BASESYSTEM_IMAGE:-BaseSystem.img}" \
+        || qemu-img convert BaseSystem.dmg -O qcow2 -p -c "${BASESYSTEM_IMAGE:-BaseSystem.img}" ; } \
+    && rm ./BaseSystem.dmg
+
+[[ "${IMAGE_STORE}" ]] && [[ "${IMAGE_BASE}" ]] \
+    && "${IMAGE_STORE_PY}" prepare --source "${IMAGE_BASE}" --format source --keep-existing \
+        --output "${IMAGE_PATH}" \
+    && export IMAGE_FORMAT=qcow2
+
+unset IMAGE_STORE_PY
+true
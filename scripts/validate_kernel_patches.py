@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Checks OpenCore Kernel -> Patch entries against kernel binaries before
+booting them: every enabled patch's Find pattern (with its Mask) is looked
+up in each kernel, and the number of matches is compared with what Skip
+and Count expect.
+
+The kernel is memory-mapped and scanned once for all patterns together:
+a single regular expression made of one lookahead alternative per pattern
+finds every offset where any pattern starts, and only those offsets are
+then checked against each pattern. Compressed kernelcaches must be
+decompressed first.
+
+Patches with a Base are only searched from that symbol on by OpenCore,
+and Limit counts from it. Symbols are not resolved here, so those
+patches are reported as unchecked rather than ok or missing.
+
+Usage: validate_kernel_patches.py [--patches config.plist|patchset] kernel..."""
+import argparse
+import json
+import mmap
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from apply_appleid_kernelpatch import (SONOMA_BT_PATCH_SET, PatchSetError, load_patch_set,
+                                       patch_lists, read_plist)
+
+KERNEL_IDENTIFIERS = ('kernel', 'com.apple.kernel')
+
+
+def darwin_version(version):
+    # '20.4.0' -> (20, 4, 0); '' -> ()
+    return tuple(int(part) for part in version.split('.') if part.isdigit()) if version else ()
+
+
+def applies_to(patch, kernel_version):
+    if not kernel_version:
+        return True
+    version = darwin_version(kernel_version)
+    minimum = darwin_version(patch.get('MinKernel', ''))
+    maximum = darwin_version(patch.get('MaxKernel', ''))
+    return (not minimum or version >= minimum) and (not maximum or version <= maximum)
+
+
+def byte_class(find, mask):
+    # regex for one pattern byte: exact, anything, or every byte value
+    # that equals find under a partial mask
+    if mask == 0xff:
+        return re.escape(bytes([find]))
+    if mask == 0:
+        return b'[\x00-\xff]'
+    allowed = b''.join(re.escape(bytes([value])) for value in range(256)
+                       if value & mask == find & mask)
+    return b'[' + allowed + b']'
+
+
+def pattern_regex(find, mask=b''):
+    if not mask:
+        return re.escape(find)
+    if len(mask) != len(find):
+        raise ValueError('Mask and Find differ in length')
+    return b''.join(byte_class(f, m) for f, m in zip(find, mask))
+
+
+def kernel_patches(patch_source, include_all=False, kernel_version=None):
+    """Returns the enabled patches to check from a config.plist or patch set
+    file, or the built-in Sonoma VM BT Enabler patches"""
+    if patch_source is None:
+        patches = SONOMA_BT_PATCH_SET['Kernel']['Patch']
+    else:
+        try:
+            config, _ = read_plist(patch_source)
+            patches = config['Kernel']['Patch']
+        except (ValueError, KeyError, TypeError):
+            patch_set = load_patch_set(patch_source)
+            patches = [entry for path, entries in patch_lists(patch_set)
+                       if path == ('Kernel', 'Patch') for entry in entries]
+    return [patch for patch in patches
+            if isinstance(patch, dict) and patch.get('Enabled', True) and patch.get('Find')
+            and (include_all or patch.get('Identifier') in KERNEL_IDENTIFIERS)
+            and applies_to(patch, kernel_version)]
+
+
+def scan(data, patches, max_offsets=16):
+    """Finds every patch's Find pattern in data in one pass. Returns one
+    result per patch with the match count, the first offsets, and a status
+    of ok, missing, short (fewer than Skip + Count matches), extra (more
+    matches than Count will patch) or unchecked (the patch has a Base)."""
+    regexes = [re.compile(pattern_regex(patch['Find'], patch.get('Mask', b'')), re.DOTALL)
+               for patch in patches]
+    combined = re.compile(b'(?=' + b'|'.join(b'(?:' + regex.pattern + b')' for regex in regexes)
+                          + b')', re.DOTALL)
+    offsets = [[] for _ in patches]
+    for match in combined.finditer(data):
+        position = match.start()
+        for index, regex in enumerate(regexes):
+            if regex.match(data, position):
+                offsets[index].append(position)
+
+    results = []
+    for patch, found in zip(patches, offsets):
+        base = patch.get('Base', '')
+        limit = patch.get('Limit', 0)
+        if limit and not base:
+            found = [offset for offset in found if offset + len(patch['Find']) <= limit]
+        skip = patch.get('Skip', 0)
+        count = patch.get('Count', 0)
+        if base:
+            # matches in the whole kernel say nothing about the ones after Base
+            status = 'unchecked'
+        elif not found:
+            status = 'missing'
+        elif len(found) < skip + max(count, 1):
+            status = 'short'
+        elif count and len(found) > skip + count:
+            status = 'extra'
+        else:
+            status = 'ok'
+        results.append({
+            'comment': patch.get('Comment', ''),
+            'matches': len(found),
+            'expected': skip + count if count else None,
+            'offsets': found[:max_offsets],
+            'status': status,
+            'base': base or None,
+        })
+    return results
+
+
+def validate_kernel(kernel_path, patches):
+    with open(kernel_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {'kernel': kernel_path, 'patches': scan(b'', patches)}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return {'kernel': kernel_path, 'patches': scan(data, patches)}
+
+
+def _validate_kernel(args):
+    try:
+        return validate_kernel(*args)
+    except OSError as err:
+        return {'kernel': args[0], 'error': str(err), 'patches': []}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that OpenCore kernel patches match kernel binaries.')
+    parser.add_argument('kernels', nargs='+', help='kernel or decompressed kernelcache files')
+    parser.add_argument('--patches', metavar='FILE',
+                        help='config.plist or patch set to check (default: the Sonoma '
+                             'VM BT Enabler patches)')
+    parser.add_argument('--kernel-version', metavar='DARWIN',
+                        help='only check patches whose MinKernel/MaxKernel include '
+                             'this Darwin version, e.g. 23.0.0')
+    parser.add_argument('--all', action='store_true',
+                        help='also check patches for kexts, not just the kernel')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    try:
+        patches = kernel_patches(args.patches, args.all, args.kernel_version)
+    except PatchSetError as err:
+        print(f"Error: {err}")
+        sys.exit(1)
+    except OSError as err:
+        print(f"Error: Could not read {args.patches}: {err.strerror or err}")
+        sys.exit(1)
+    if not patches:
+        print("Error: No enabled kernel patches to check")
+        sys.exit(1)
+
+    work = [(kernel, patches) for kernel in args.kernels]
+    if len(work) > 1 and args.jobs != 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            reports = list(pool.map(_validate_kernel, work))
+    else:
+        reports = [_validate_kernel(item) for item in work]
+
+    failed = any(report.get('error') or any(result['status'] in ('missing', 'short')
+                                            for result in report['patches'])
+                 for report in reports)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print(report['kernel'])
+            if report.get('error'):
+                print(f"  error: {report['error']}")
+            for result in report['patches']:
+                offsets = ', '.join(f'0x{offset:x}' for offset in result['offsets'])
+                expected = '' if result['expected'] is None else f"/{result['expected']}"
+                if result['base']:
+                    offsets = f"Base {result['base']} not resolved"
+                print(f"  {result['status']:9} {result['matches']}{expected:4} "
+                      f"{result['comment']}" + (f" at {offsets}" if offsets else ''))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
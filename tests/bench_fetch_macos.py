@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+'''bench_fetch_macos.py
+Times fetch-macOS.py end to end against a local HTTP server that stands in
+for Apple's softwareupdate servers. The server generates a synthetic
+sucatalog, ServerMetadata plists, .dist files and package blobs on the fly,
+with optional per-request latency and per-connection bandwidth limits, so
+the benchmark runs entirely offline.
+
+Each phase is timed separately: catalog download, catalog parse, the
+os_installer_product_info() fan-out, determine_version() and
+replicate_product(). The results are written as JSON, so that runs of
+different revisions can be compared.
+
+Usage: ./bench_fetch_macos.py [--products 2000] [--installers 20]
+                              [--package-size 256] [--latency 0.02]
+                              [--bandwidth 0] [--mirror-latency 0.2,0.005]
+                              [--repeat 3] [--output results.json]'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import email.utils
+import datetime
+import plistlib
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import http.server
+
+from bench_sucatalog import load_fetch_macos
+
+BLOCK_SIZE = 64 * 1024
+
+
+def synthetic_files(base, products, installers):
+    '''Returns (catalog bytes, {path: bytes}, [installer (product ID, version)])
+    for a catalog where every n-th product is a macOS installer'''
+    every = max(1, products // max(1, installers))
+    catalog = {'CatalogVersion': 2, 'Products': {}}
+    files = {}
+    installer_versions = []
+    for index in range(products):
+        product_id = '%03d-%05d' % (index % 1000, index)
+        prefix = '/content/downloads/%s' % product_id
+        product = {
+            'PostDate': datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=index),
+            'Distributions': {'English': base + prefix + '/English.dist'},
+            'Packages': [{'URL': base + prefix + '/Update.pkg', 'Size': 1024}],
+        }
+        if index % every == 0:
+            version = '10.%d.%d' % (10 + index // 1000 % 10, index % 1000)
+            installer_versions.append((product_id, version))
+            product['ServerMetadataURL'] = base + prefix + '/smd'
+            product['ExtendedMetaInfo'] = {
+                'InstallAssistantPackageIdentifiers': {
+                    'OSInstall': 'com.apple.mpkg.OSInstall'}}
+            product['Packages'] = [
+                {'URL': base + prefix + '/BaseSystem.dmg', 'Size': 0},
+                {'URL': base + prefix + '/InstallESDDmg.pkg', 'Size': 0},
+            ]
+            files[prefix + '/smd'] = plistlib.dumps({
+                'CFBundleShortVersionString': version,
+                'localization': {'English': {'title': 'macOS Benchmark'}},
+            })
+            files[prefix + '/English.dist'] = (
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<installer-gui-script minSpecVersion="1">\n'
+                '  <title>macOS Benchmark</title>\n'
+                '  <auxinfo><dict>\n'
+                '    <key>BUILD</key><string>19A%d</string>\n'
+                '    <key>VERSION</key><string>%s</string>\n'
+                '  </dict></auxinfo>\n'
+                '</installer-gui-script>\n' % (index, version)).encode('utf-8')
+        catalog['Products'][product_id] = product
+    return plistlib.dumps(catalog), files, installer_versions
+
+
+def blob_block(index):
+    '''Deterministic, incompressible content for the index-th block of a
+    package blob'''
+    seed = hashlib.sha256(b'%d' % index).digest()
+    return (seed * (BLOCK_SIZE // len(seed) + 1))[:BLOCK_SIZE]
+
+
+class BenchServer(http.server.ThreadingHTTPServer):
+    '''Serves the synthetic files, plus a blob of package_size bytes for
+    any path ending in .dmg or .pkg. With ranges off, Range headers are
+    ignored, as some proxies do. The synthetic files have an ETag and a
+    Last-Modified of modified, and conditional requests for them are
+    answered with 304.'''
+    daemon_threads = True
+
+    def __init__(self, files, package_size, latency=0.0, bandwidth=0):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), BenchHandler)
+        self.files = files
+        self.package_size = package_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = True
+        self.modified = time.time()
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def unmodified(self, etag):
+        '''Whether the client's copy of a file with this etag is current'''
+        if self.headers.get('If-None-Match'):
+            return etag in self.headers['If-None-Match'].split(', ')
+        since = self.headers.get('If-Modified-Since')
+        if since:
+            try:
+                return int(self.server.modified) <= email.utils.parsedate_to_datetime(
+                    since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        path = self.path.split('?', 1)[0]
+        if path in server.files:
+            data = server.files[path]
+            size = len(data)
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()
+            last_modified = email.utils.formatdate(server.modified, usegmt=True)
+            if self.unmodified(etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                with server.lock:
+                    server.not_modified += 1
+                return
+        elif path.endswith(('.dmg', '.pkg')):
+            data = None
+            size = server.package_size
+        else:
+            self.send_error(404)
+            return
+
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if server.ranges and range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        if data is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with server.lock:
+            server.requests += 1
+
+        offset = start
+        while offset <= end:
+            if data is not None:
+                chunk = data[offset:min(end + 1, offset + BLOCK_SIZE)]
+            else:
+                block, skip = divmod(offset, BLOCK_SIZE)
+                chunk = blob_block(block)[skip:skip + end + 1 - offset]
+            sent = time.perf_counter()
+            self.wfile.write(chunk)
+            offset += len(chunk)
+            with server.lock:
+                server.bytes_sent += len(chunk)
+            if server.bandwidth:
+                delay = len(chunk) / float(server.bandwidth) - (time.perf_counter() - sent)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def git_revision():
+    '''Returns the revision of the checkout being benchmarked, if known'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(fetch_macos, server, installer_versions, args):
+    '''Runs every phase once in a fresh working directory and returns the
+    timings in seconds'''
+    fetch_macos.connection_pool = fetch_macos.ConnectionPool()
+    if args.mirror_latency:
+        # rank from scratch every run
+        fetch_macos.mirror_ranker = fetch_macos.MirrorRanker(
+            [mirror.base for mirror in args.mirrors])
+    timings = {}
+    with tempfile.TemporaryDirectory() as workdir, \
+            contextlib.redirect_stdout(open(os.devnull, 'w')):
+        start = time.perf_counter()
+        catalog_path = fetch_macos.replicate_url(
+            server.base + '/index.sucatalog', root_dir=workdir)
+        timings['catalog_download'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        catalog = fetch_macos.parse_sucatalog(catalog_path)
+        timings['catalog_parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        product_info = fetch_macos.os_installer_product_info(
+            catalog, workdir, jobs=args.jobs)
+        timings['product_info'] = time.perf_counter() - start
+
+        product_id, version = installer_versions[-1]
+        start = time.perf_counter()
+        found_id, title = fetch_macos.determine_version(version, product_info)
+        timings['determine_version'] = time.perf_counter() - start
+        if found_id != product_id:
+            raise RuntimeError('determine_version() returned %s, expected %s' % (
+                found_id, product_id))
+
+        servers = [server] + args.mirrors
+        bytes_before = sum(each.bytes_sent for each in servers)
+        start = time.perf_counter()
+        fetch_macos.replicate_product(catalog, product_id, workdir,
+                                      product_title=title)
+        timings['replicate_product'] = time.perf_counter() - start
+        timings['replicate_bytes'] = sum(each.bytes_sent for each in servers) - bytes_before
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=2000,
+                        help='Number of products in the synthetic catalog.')
+    parser.add_argument('--installers', type=int, default=20,
+                        help='How many of them are macOS installers.')
+    parser.add_argument('--package-size', metavar='MiB', type=float, default=256,
+                        help='Size of each package blob.')
+    parser.add_argument('--latency', metavar='seconds', type=float, default=0.02,
+                        help='Delay before the server answers each request.')
+    parser.add_argument('--bandwidth', metavar='MiB/s', type=float, default=0,
+                        help='Per-connection bandwidth limit. 0 is unlimited.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Metadata fetch concurrency passed to fetch-macOS.py.')
+    parser.add_argument('--segments', type=int, default=None,
+                        help='Range segments per download passed to fetch-macOS.py.')
+    parser.add_argument('--mirror-latency', metavar='seconds', default='',
+                        help='Comma-separated latencies of mirror servers to start '
+                             'next to the main one, e.g. 0.2,0.005; packages are '
+                             'then fetched from the fastest.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs; the median of each phase is reported.')
+    parser.add_argument('--output', metavar='path', default=None,
+                        help='Write the JSON results here instead of stdout.')
+    args = parser.parse_args()
+
+    fetch_macos = load_fetch_macos()
+    if args.segments:
+        fetch_macos.DOWNLOAD_SEGMENTS = args.segments
+
+    server = BenchServer({}, int(args.package_size * 1048576),
+                         latency=args.latency,
+                         bandwidth=int(args.bandwidth * 1048576))
+    catalog, files, installer_versions = synthetic_files(
+        server.base, args.products, args.installers)
+    files['/index.sucatalog'] = catalog
+    server.files = files
+    # mirrors serve the same paths, so only the packages need to be on them
+    args.mirrors = [BenchServer(files, server.package_size, latency=float(latency),
+                                bandwidth=server.bandwidth)
+                    for latency in args.mirror_latency.split(',') if latency]
+    for each in [server] + args.mirrors:
+        threading.Thread(target=each.serve_forever, daemon=True).start()
+    try:
+        runs = [run_once(fetch_macos, server, installer_versions, args)
+                for _ in range(max(1, args.repeat))]
+    finally:
+        for each in [server] + args.mirrors:
+            each.shutdown()
+    args.mirrors = [mirror.base for mirror in args.mirrors]
+
+    phases = {}
+    for name in runs[0]:
+        values = sorted(run[name] for run in runs)
+        phases[name] = values[len(values) // 2]
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'catalog_bytes': len(catalog),
+        'phases': phases,
+        'replicate_mib_per_second': (phases['replicate_bytes'] / 1048576.0 /
+                                     phases['replicate_product']),
+        'runs': runs,
+    }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as the_file:
+            the_file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
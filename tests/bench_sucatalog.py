@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+'''bench_sucatalog.py
+Compares reading a large synthetic softwareupdate catalog with plistlib plus
+find_mac_os_installers() against the streaming InstallerCatalogReader in
+fetch_macos.py, for time and peak memory.
+
+Usage: ./bench_sucatalog.py [--products 20000] [--installers 40] [--gzip]'''
+
+import os
+import sys
+import gzip
+import time
+import argparse
+import datetime
+import plistlib
+import tempfile
+import tracemalloc
+import importlib
+
+
+def load_fetch_macos():
+    '''Imports fetch_macos.py from the repository root'''
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir))
+    return importlib.import_module('fetch_macos')
+
+
+def synthetic_catalog(products, installers):
+    '''Returns a catalog shaped like Apple's merged sucatalogs, where only
+    every n-th product is a macOS installer'''
+    base = 'http://swcdn.apple.com/content/downloads'
+    every = max(1, products // max(1, installers))
+    catalog = {
+        'CatalogVersion': 2,
+        'ApplePostURL': 'http://metrics.apple.com/',
+        'IndexDate': datetime.datetime(2024, 1, 1),
+        'Products': {},
+    }
+    for index in range(products):
+        product_id = '%03d-%05d' % (index % 1000, index)
+        product = {
+            'ServerMetadataURL': '%s/%s/%s.smd' % (base, index, product_id),
+            'Packages': [{
+                'Digest': '%040x' % (index * 7919 + package),
+                'Size': 1024 * (index + package),
+                'MetadataURL': '%s/%s/pkg%d.pkm' % (base, index, package),
+                'URL': '%s/%s/pkg%d.pkg' % (base, index, package),
+            } for package in range(4)],
+            'PostDate': datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=index),
+            'Distributions': dict(
+                (language, '%s/%s/%s.%s.dist' % (base, index, product_id, language))
+                for language in ('English', 'French', 'German', 'Japanese', 'Spanish')),
+            'State': 'ramped',
+        }
+        if index % every == 0:
+            product['ExtendedMetaInfo'] = {
+                'InstallAssistantPackageIdentifiers': {
+                    'OSInstall': 'com.apple.mpkg.OSInstall',
+                    'SharedSupport': 'com.apple.pkg.InstallAssistant.macOS',
+                },
+            }
+        catalog['Products'][product_id] = product
+    return catalog
+
+
+def measure(function):
+    '''Returns (result, seconds, peak bytes) of calling function. Time and
+    memory come from separate runs, as tracing allocations skews timings.'''
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20000,
+                        help='Number of products in the synthetic catalog.')
+    parser.add_argument('--installers', type=int, default=40,
+                        help='How many of them are macOS installers.')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Gzip the catalog before reading it.')
+    args = parser.parse_args()
+
+    fetch_macos = load_fetch_macos()
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'index.sucatalog')
+        data = plistlib.dumps(synthetic_catalog(args.products, args.installers))
+        if args.gzip:
+            path += '.gz'
+            data = gzip.compress(data)
+        with open(path, 'wb') as the_file:
+            the_file.write(data)
+        print('catalog: %d products, %.1f MiB on disk' % (
+            args.products, len(data) / 1048576.0))
+
+        def full_parse():
+            opener = gzip.open if args.gzip else open
+            with opener(path, 'rb') as the_file:
+                catalog = plistlib.load(the_file)
+            return fetch_macos.find_mac_os_installers(catalog)
+
+        def streaming_parse():
+            with open(path, 'rb') as the_file:
+                catalog = fetch_macos.read_installer_catalog(the_file)
+            return fetch_macos.find_mac_os_installers(catalog)
+
+        full, full_time, full_peak = measure(full_parse)
+        streamed, streamed_time, streamed_peak = measure(streaming_parse)
+
+    if sorted(full) != sorted(streamed):
+        print('installer products differ between readers', file=sys.stderr)
+        exit(1)
+    print('%-10s %10s %12s  %s' % ('reader', 'seconds', 'peak MiB', 'installers'))
+    print('%-10s %10.3f %12.1f  %d' % ('plistlib', full_time, full_peak / 1048576.0, len(full)))
+    print('%-10s %10.3f %12.1f  %d' % ('streaming', streamed_time, streamed_peak / 1048576.0, len(streamed)))
+
+
+if __name__ == '__main__':
+    main()
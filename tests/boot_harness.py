@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+'''boot_harness.py
+Boots several Docker-OSX image tags at once and measures how long each
+takes to reach its installer screen, replacing the one-at-a-time,
+exact-match loop of boot-images.sh.
+
+Frames are compared with the *_master.png screenshots in this folder by
+perceptual hash (a 16x16 difference hash), so a clock in the corner or
+a slightly different rendering still matches, as long as at most
+--tolerance of the master's edges differ. Boots run concurrently within
+--jobs, --ram-budget and --cpu-budget; each gets its own Xvfb display
+and is captured with xwd, or scrot when xwd is missing.
+
+The comparator and the scheduler take any frame source. --recorded DIR
+replays frame sequences recorded earlier with --record DIR (one folder
+of PNG files per tag, named by seconds since the boot started), which
+runs the whole harness offline, without docker or KVM.
+
+The results, including time-to-installer per tag, are written as JSON
+together with the revision, so that boot latency can be compared across
+revisions; --history appends one JSON line per tag to a log.
+
+Usage: ./boot_harness.py [--tags ventura,sonoma] [--jobs 2] [--ram-budget 16]
+                         [--tolerance 0.4] [--timeout 1800] [--output results.json]
+       ./boot_harness.py --recorded frames/ [--tags ...]'''
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import zlib
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+TAGS = ['high-sierra', 'mojave', 'catalina', 'big-sur', 'monterey', 'ventura', 'sonoma']
+MASTER_DIR = os.path.dirname(os.path.abspath(__file__))
+HASH_SIZE = 16
+FLAT = 4
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class Frame(object):
+    '''A screen capture: width x height pixels of channels 8-bit values,
+    read a row at a time so that sources only decode what is sampled'''
+
+    def __init__(self, width, height, channels, row):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.row = row
+
+
+def frame_from_bytes(width, height, channels, data):
+    stride = width * channels
+    return Frame(width, height, channels, lambda y: data[y * stride:(y + 1) * stride])
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def read_png(path):
+    '''Decodes an 8-bit, non-interlaced PNG into a Frame, with Pillow when
+    it is installed'''
+    if Image is not None:
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            return frame_from_bytes(image.width, image.height, 3, image.tobytes())
+    with open(path, 'rb') as the_file:
+        data = the_file.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('%s is not a PNG file' % path)
+    position, idat = 8, []
+    while position < len(data):
+        length, kind = struct.unpack('>I4s', data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        position += 12 + length
+        if kind == b'IHDR':
+            width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', body)
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+    channels = {0: 1, 2: 3, 4: 2, 6: 4}.get(color)
+    if depth != 8 or interlace or channels is None:
+        raise ValueError('%s: only 8-bit, non-interlaced grey or RGB PNGs are supported' % path)
+    raw = zlib.decompress(b''.join(idat))
+    stride = width * channels
+    previous = bytearray(stride)
+    pixels = bytearray()
+    for y in range(height):
+        start = y * (stride + 1)
+        kind = raw[start]
+        line = bytearray(raw[start + 1:start + 1 + stride])
+        if kind == 1:
+            for i in range(channels, stride):
+                line[i] = (line[i] + line[i - channels]) & 255
+        elif kind == 2:
+            for i in range(stride):
+                line[i] = (line[i] + previous[i]) & 255
+        elif kind == 3:
+            for i in range(stride):
+                left = line[i - channels] if i >= channels else 0
+                line[i] = (line[i] + ((left + previous[i]) >> 1)) & 255
+        elif kind == 4:
+            for i in range(stride):
+                if i >= channels:
+                    predictor = paeth(line[i - channels], previous[i], previous[i - channels])
+                else:
+                    predictor = previous[i]
+                line[i] = (line[i] + predictor) & 255
+        pixels += line
+        previous = line
+    return frame_from_bytes(width, height, channels, bytes(pixels))
+
+
+def write_png(frame, path):
+    '''Saves a Frame as an RGB PNG, for --record'''
+    rows = []
+    for y in range(frame.height):
+        row = frame.row(y)
+        if frame.channels != 3:
+            gray = frame.channels < 3
+            row = bytes(value for x in range(frame.width)
+                        for value in (row[x * frame.channels:x * frame.channels + 1] * 3
+                                      if gray else row[x * frame.channels:x * frame.channels + 3]))
+        rows.append(b'\0' + bytes(row))
+
+    def chunk(kind, body):
+        return (struct.pack('>I', len(body)) + kind + body +
+                struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff))
+    with open(path, 'wb') as the_file:
+        the_file.write(PNG_SIGNATURE +
+                       chunk(b'IHDR', struct.pack('>IIBBBBB', frame.width, frame.height,
+                                                  8, 2, 0, 0, 0)) +
+                       chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) +
+                       chunk(b'IEND', b''))
+
+
+def read_xwd(data):
+    '''Decodes an xwd -root dump of a TrueColor ZPixmap screen into a Frame'''
+    header = struct.unpack('>25I', data[:100])
+    if header[1] != 7:
+        header = struct.unpack('<25I', data[:100])
+    (header_size, _, pixmap_format, _, width, height, _, byte_order, _, _, _,
+     bits_per_pixel, bytes_per_line, _, red_mask, green_mask, blue_mask, _, _,
+     colors) = header[:20]
+    if pixmap_format != 2 or bits_per_pixel not in (16, 24, 32):
+        raise ValueError('unsupported xwd pixmap format')
+    offset = header_size + colors * 12
+    pixel_size = bits_per_pixel // 8
+    endian = 'little' if byte_order == 0 else 'big'
+    masks = []
+    for mask in (red_mask, green_mask, blue_mask):
+        shift = (mask & -mask).bit_length() - 1
+        masks.append((mask, shift, (mask >> shift) or 1))
+
+    def row(y):
+        start = offset + y * bytes_per_line
+        line = data[start:start + width * pixel_size]
+        if pixel_size == 4 and endian == 'little' and \
+                (red_mask, green_mask, blue_mask) == (0xff0000, 0xff00, 0xff):
+            # BGRX in memory
+            values = bytearray(len(line))
+            values[0::4], values[1::4], values[2::4] = line[2::4], line[1::4], line[0::4]
+            return bytes(values)
+        values = bytearray()
+        for x in range(0, len(line), pixel_size):
+            value = int.from_bytes(line[x:x + pixel_size], endian)
+            values += bytes(((value & mask) >> shift) * 255 // top
+                            for mask, shift, top in masks) + b'\0'
+        return bytes(values)
+    return Frame(width, height, 4, row)
+
+
+def difference_hash(frame, size=HASH_SIZE):
+    '''Perceptual hash of size x size neighbour pairs: the frame is shrunk
+    to a grey (size + 1) x size thumbnail by averaging sampled pixels, and
+    each pair of horizontal neighbours is brighter, darker or flat (within
+    FLAT grey levels). Returns (brighter bits, darker bits). Keeping flat
+    pairs apart stops noise over plain backgrounds from flipping bits.'''
+    columns = size + 1
+    colors = min(frame.channels, 3)
+    step = max(1, frame.width // (columns * 16))
+    thumbnail = []
+    for band in range(size):
+        top = band * frame.height // size
+        bottom = max(top + 1, (band + 1) * frame.height // size)
+        rows = [frame.row(y) for y in
+                sorted({top + i * (bottom - top) // 4 for i in range(4)})]
+        cells = []
+        for column in range(columns):
+            left = column * frame.width // columns * frame.channels
+            right = (column + 1) * frame.width // columns * frame.channels
+            total = count = 0
+            for row in rows:
+                segment = row[left:right]
+                for color in range(colors):
+                    values = segment[color::frame.channels * step]
+                    total += sum(values)
+                    count += len(values)
+            cells.append(total / max(1, count))
+        thumbnail.append(cells)
+    brighter = darker = 0
+    for cells in thumbnail:
+        for left, right in zip(cells, cells[1:]):
+            brighter = brighter << 1 | (left - right > FLAT)
+            darker = darker << 1 | (right - left > FLAT)
+    return brighter, darker
+
+
+def edges(image_hash):
+    '''Number of pairs in a hash that are not flat'''
+    return bin(image_hash[0] | image_hash[1]).count('1')
+
+
+def distance(first, second):
+    '''Number of pairs that differ between two hashes'''
+    return bin((first[0] ^ second[0]) | (first[1] ^ second[1])).count('1')
+
+
+class Comparator(object):
+    '''Matches frames against a master screenshot's hash. A frame matches
+    when at most `tolerance` of the master's non-flat pairs differ from it,
+    and a boot has reached its installer screen after `stable` consecutive
+    matching frames.'''
+
+    def __init__(self, master_hash, tolerance=0.4, stable=1):
+        self.master_hash = master_hash
+        self.limit = tolerance * max(1, edges(master_hash))
+        self.stable = stable
+        self.streak = 0
+        self.best = None
+
+    def feed(self, frame):
+        differing = distance(difference_hash(frame), self.master_hash)
+        self.best = differing if self.best is None else min(self.best, differing)
+        self.streak = self.streak + 1 if differing <= self.limit else 0
+        return self.streak >= self.stable
+
+
+def recorded_frames(directory):
+    '''Replays PNG frames recorded with --record; file names are seconds
+    since the boot started, e.g. 0042.500.png'''
+    paths = glob.glob(os.path.join(directory, '*.png'))
+    for path in sorted(paths, key=lambda path: float(os.path.basename(path)[:-4])):
+        yield float(os.path.basename(path)[:-4]), read_png(path)
+
+
+def capture_frames(display, interval, timeout):
+    '''Captures the root window of an X display every interval seconds'''
+    start = time.time()
+    while time.time() - start < timeout:
+        time.sleep(max(0.0, interval - (time.time() - start) % interval))
+        elapsed = time.time() - start
+        try:
+            if shutil.which('xwd'):
+                data = subprocess.check_output(['xwd', '-root', '-silent', '-display', display],
+                                               stderr=subprocess.DEVNULL)
+                frame = read_xwd(data)
+            else:
+                with tempfile.NamedTemporaryFile(suffix='.png') as shot:
+                    subprocess.check_call(['scrot', '--overwrite', '--display', display,
+                                           shot.name], stderr=subprocess.DEVNULL)
+                    frame = read_png(shot.name)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            continue
+        yield elapsed, frame
+
+
+class RecordedBoot(object):
+    '''A boot replayed from recorded frames'''
+
+    def __init__(self, tag, directory):
+        self.tag = tag
+        self.directory = directory
+
+    def start(self):
+        pass
+
+    def frames(self, interval, timeout):
+        for elapsed, frame in recorded_frames(self.directory):
+            if elapsed > timeout:
+                return
+            yield elapsed, frame
+
+    def stop(self):
+        pass
+
+
+class DockerBoot(object):
+    '''A sickcodes/docker-osx container on its own Xvfb display'''
+
+    def __init__(self, tag, display, image='sickcodes/docker-osx', ram=4, smp=4):
+        self.tag = tag
+        self.display = display
+        self.image = image
+        self.ram = ram
+        self.smp = smp
+        self.xvfb = None
+        self.container = None
+
+    def start(self):
+        self.xvfb = subprocess.Popen(['Xvfb', self.display, '-screen', '0', '1920x1080x24'],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+        self.container = subprocess.check_output([
+            'docker', 'run', '--rm', '-d', '--device', '/dev/kvm',
+            '-v', '/tmp/.X11-unix:/tmp/.X11-unix',
+            '-e', 'DISPLAY=%s' % self.display,
+            '-e', 'RAM=%s' % self.ram,
+            '-e', 'SMP=%s' % self.smp, '-e', 'CORES=%s' % self.smp,
+            '%s:%s' % (self.image, self.tag)]).decode('utf-8').strip()
+
+    def frames(self, interval, timeout):
+        return capture_frames(self.display, interval, timeout)
+
+    def stop(self):
+        if self.container:
+            subprocess.call(['docker', 'kill', self.container],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self.xvfb:
+            self.xvfb.terminate()
+            self.xvfb.wait()
+
+
+class Budget(object):
+    '''Admits boots while their summed RAM and vCPUs fit. A boot bigger
+    than the whole budget still runs, alone.'''
+
+    def __init__(self, ram=0, cpus=0):
+        self.limits = (ram, cpus)
+        self.used = [0, 0]
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def fits(self, request):
+        if not self.running:
+            return True
+        return all(not limit or used + wanted <= limit
+                   for limit, used, wanted in zip(self.limits, self.used, request))
+
+    def acquire(self, request):
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(request))
+            self.used = [used + wanted for used, wanted in zip(self.used, request)]
+            self.running += 1
+
+    def release(self, request):
+        with self.condition:
+            self.used = [used - wanted for used, wanted in zip(self.used, request)]
+            self.running -= 1
+            self.condition.notify_all()
+
+
+def run_boot(boot, master_hash, budget, request, args):
+    '''Boots one tag and returns its result'''
+    budget.acquire(request)
+    comparator = Comparator(master_hash, args.tolerance, args.stable)
+    result = {'tag': boot.tag, 'status': 'timeout', 'time_to_installer': None, 'frames': 0}
+    record_dir = args.record and os.path.join(args.record, boot.tag)
+    if record_dir:
+        os.makedirs(record_dir, exist_ok=True)
+    try:
+        boot.start()
+        for elapsed, frame in boot.frames(args.interval, args.timeout):
+            result['frames'] += 1
+            if record_dir:
+                write_png(frame, os.path.join(record_dir, '%08.3f.png' % elapsed))
+            if comparator.feed(frame):
+                result['status'] = 'pass'
+                result['time_to_installer'] = round(elapsed, 3)
+                break
+    except (OSError, ValueError, subprocess.CalledProcessError) as error:
+        result['status'] = 'error'
+        result['error'] = str(error)
+    finally:
+        boot.stop()
+        budget.release(request)
+    result['best_distance'] = comparator.best
+    return result
+
+
+def git_revision():
+    '''Returns the revision of the checkout being tested, if known'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=MASTER_DIR).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def master_hashes(tags):
+    '''Hashes the master screenshots, in parallel since PNG decoding
+    without Pillow takes a second or two each'''
+    paths = [os.path.join(MASTER_DIR, '%s_master.png' % tag) for tag in tags]
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        return dict(zip(tags, pool.map(master_hash, paths)))
+
+
+def master_hash(path):
+    return difference_hash(read_png(path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tags', default=','.join(TAGS),
+                        help='Comma-separated image tags to boot.')
+    parser.add_argument('--image', default='sickcodes/docker-osx',
+                        help='Image to run the tags of.')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Boots running at once.')
+    parser.add_argument('--ram', type=int, default=4,
+                        help='RAM per VM in GB.')
+    parser.add_argument('--smp', type=int, default=4,
+                        help='vCPUs per VM.')
+    parser.add_argument('--ram-budget', type=int, default=0,
+                        help='Total RAM of the VMs running at once, in GB. 0 is unlimited.')
+    parser.add_argument('--cpu-budget', type=int, default=0,
+                        help='Total vCPUs of the VMs running at once. 0 is unlimited.')
+    parser.add_argument('--tolerance', type=float, default=0.4,
+                        help='Fraction of the master\'s edges a frame may differ in.')
+    parser.add_argument('--stable', type=int, default=1,
+                        help='Consecutive matching frames needed.')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='Seconds between screen captures.')
+    parser.add_argument('--timeout', type=float, default=1800.0,
+                        help='Seconds before a boot counts as failed.')
+    parser.add_argument('--display-base', type=int, default=100,
+                        help='First Xvfb display number to use.')
+    parser.add_argument('--recorded', metavar='path', default=None,
+                        help='Replay recorded frames from path/<tag>/ instead of booting.')
+    parser.add_argument('--record', metavar='path', default=None,
+                        help='Save every captured frame under path/<tag>/.')
+    parser.add_argument('--output', metavar='path', default=None,
+                        help='Write the JSON results here instead of stdout.')
+    parser.add_argument('--history', metavar='path', default=None,
+                        help='Append one JSON line per tag with the revision to this log.')
+    args = parser.parse_args()
+
+    tags = [tag for tag in args.tags.split(',') if tag]
+    hashes = master_hashes(tags)
+    if args.recorded:
+        boots = [RecordedBoot(tag, os.path.join(args.recorded, tag)) for tag in tags]
+    else:
+        boots = [DockerBoot(tag, ':%d' % (args.display_base + index), args.image,
+                            args.ram, args.smp) for index, tag in enumerate(tags)]
+    budget = Budget(args.ram_budget, args.cpu_budget)
+    request = (args.ram, args.smp)
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(run_boot, boot, hashes[boot.tag], budget, request, args)
+                   for boot in boots]
+        results = [future.result() for future in futures]
+
+    revision = git_revision()
+    report = {
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'wall_time': time.time() - start,
+        'results': {result['tag']: result for result in results},
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as the_file:
+            the_file.write(text + '\n')
+    else:
+        print(text)
+    if args.history:
+        with open(args.history, 'a') as the_file:
+            for result in results:
+                the_file.write(json.dumps(dict(result, revision=revision,
+                                               time=int(time.time())), sort_keys=True) + '\n')
+    if any(result['status'] != 'pass' for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
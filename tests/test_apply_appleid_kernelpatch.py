@@ -0,0 +1,135 @@
+'''test_apply_appleid_kernelpatch.py
+Applies patch sets with scripts/apply_appleid_kernelpatch.py to small
+config.plists: patch sets in each format, reapplying a patch set, and
+disabled copies of its entries.
+
+Usage: python -m pytest tests/test_apply_appleid_kernelpatch.py'''
+
+import os
+import sys
+import copy
+import json
+import base64
+import plistlib
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scripts'))
+apply_patch = importlib.import_module('apply_appleid_kernelpatch')
+
+PREFIX = b'<!-- OpenCore config -->\n'
+PATCHES = apply_patch.SONOMA_BT_PATCH_SET['Kernel']['Patch']
+
+
+def write_config(path, patches=()):
+    with open(path, 'wb') as f:
+        f.write(PREFIX + plistlib.dumps({'Kernel': {'Patch': list(patches)}}))
+    return str(path)
+
+
+def read_patches(path):
+    config, prefix = apply_patch.read_plist(path)
+    assert prefix == PREFIX
+    return config['Kernel']['Patch']
+
+
+def as_text(node):
+    # a patch set as JSON and YAML give it, with data as base64
+    if isinstance(node, bytes):
+        return base64.b64encode(node).decode('ascii')
+    if isinstance(node, dict):
+        return {key: as_text(value) for key, value in node.items()}
+    if isinstance(node, list):
+        return [as_text(value) for value in node]
+    return node
+
+
+@pytest.mark.parametrize('extension', ['.plist', '.json', '.yaml'])
+def test_load_patch_set(tmp_path, extension):
+    path = tmp_path / ('patches' + extension)
+    if extension == '.plist':
+        path.write_bytes(plistlib.dumps(apply_patch.SONOMA_BT_PATCH_SET))
+    elif extension == '.json':
+        path.write_text(json.dumps(as_text(apply_patch.SONOMA_BT_PATCH_SET)))
+    else:
+        yaml = pytest.importorskip('yaml')
+        path.write_text(yaml.safe_dump(as_text(apply_patch.SONOMA_BT_PATCH_SET)))
+
+    assert apply_patch.load_patch_set(str(path)) == apply_patch.SONOMA_BT_PATCH_SET
+
+
+def test_load_patch_set_errors(tmp_path):
+    with pytest.raises(apply_patch.PatchSetError):
+        apply_patch.load_patch_set(str(tmp_path / 'missing.plist'))
+    path = tmp_path / 'patches.json'
+    path.write_text(json.dumps({'Kernel': {'Quirks': {}}}))
+    with pytest.raises(apply_patch.PatchSetError):
+        apply_patch.load_patch_set(str(path))
+    path.write_text(json.dumps({'Kernel': {'Patch': ['not an entry']}}))
+    with pytest.raises(apply_patch.PatchSetError):
+        apply_patch.load_patch_set(str(path))
+
+
+def test_reapplying_is_a_no_op(tmp_path):
+    config_path = write_config(tmp_path / 'config.plist')
+
+    report = apply_patch.patch_file(config_path, apply_patch.SONOMA_BT_PATCH_SET)
+    assert report['status'] == 'patched'
+    assert report['added'] == [patch['Comment'] for patch in PATCHES]
+    assert read_patches(config_path) == PATCHES
+    assert os.path.exists(config_path + '.backup')
+    patched = (tmp_path / 'config.plist').read_bytes()
+
+    report = apply_patch.patch_file(config_path, apply_patch.SONOMA_BT_PATCH_SET)
+    assert (report['status'], report['added'], report['enabled']) == ('unchanged', [], [])
+    assert report['present'] == [patch['Comment'] for patch in PATCHES]
+    assert (tmp_path / 'config.plist').read_bytes() == patched
+
+
+def test_renamed_and_terse_copies_are_present(tmp_path):
+    # the same patch under another comment, with its defaults left out
+    terse = dict((key, value) for key, value in PATCHES[0].items()
+                 if apply_patch.DEFAULT_VALUES.get(key, object()) != value)
+    terse['Comment'] = 'hv_vmm_present, part 1'
+    config_path = write_config(tmp_path / 'config.plist', [terse])
+
+    report = apply_patch.patch_file(config_path, apply_patch.SONOMA_BT_PATCH_SET)
+    assert report['present'] == [PATCHES[0]['Comment']]
+    assert report['added'] == [PATCHES[1]['Comment']]
+    assert read_patches(config_path) == [terse, PATCHES[1]]
+
+
+def test_disabled_copy_is_enabled(tmp_path, monkeypatch):
+    disabled = dict(PATCHES[0], Enabled=False)
+    config_path = write_config(tmp_path / 'config.plist', [disabled, PATCHES[1]])
+    report_path = str(tmp_path / 'report.json')
+    monkeypatch.setattr(sys, 'argv', ['apply_appleid_kernelpatch.py', '--report', report_path,
+                                      config_path])
+
+    apply_patch.main()
+    assert read_patches(config_path) == PATCHES
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report['summary']['patched'] == 1
+    assert report['files'][0]['enabled'] == [PATCHES[0]['Comment']]
+    assert report['files'][0]['present'] == [PATCHES[1]['Comment']]
+
+    # a patch set that disables the patch does not enable it
+    patch_set = copy.deepcopy(apply_patch.SONOMA_BT_PATCH_SET)
+    patch_set['Kernel']['Patch'][0]['Enabled'] = False
+    config_path = write_config(tmp_path / 'other.plist', [disabled])
+    report = apply_patch.patch_file(config_path, patch_set)
+    assert report['enabled'] == [] and report['present'] == [PATCHES[0]['Comment']]
+    assert read_patches(config_path)[0]['Enabled'] is False
+
+
+def test_missing_patch_list_is_skipped(tmp_path):
+    config_path = str(tmp_path / 'config.plist')
+    with open(config_path, 'wb') as f:
+        f.write(plistlib.dumps({'Kernel': {}}))
+
+    report = apply_patch.patch_file(config_path, apply_patch.SONOMA_BT_PATCH_SET)
+    assert report['status'] == 'skipped'
+    assert report['error'] == 'no Kernel -> Patch section'
@@ -0,0 +1,137 @@
+'''test_boot_harness.py
+Checks the frame decoders and the difference-hash matcher of
+boot_harness.py offline, against the *_master.png screenshots and boots
+replayed from recorded frames.
+
+Usage: python -m pytest tests/test_boot_harness.py'''
+
+import os
+import struct
+import argparse
+
+import pytest
+
+import boot_harness
+
+
+@pytest.fixture(scope='module')
+def masters():
+    return {tag: boot_harness.read_png(os.path.join(boot_harness.MASTER_DIR,
+                                                    '%s_master.png' % tag))
+            for tag in ('sonoma', 'catalina')}
+
+
+def pixels(frame):
+    return b''.join(bytes(frame.row(y)) for y in range(frame.height))
+
+
+def shrink(frame, factor):
+    '''Every factor-th pixel of every factor-th row, as a recording at a
+    lower resolution would have'''
+    channels = frame.channels
+    out = bytearray()
+    for y in range(0, frame.height, factor):
+        row = bytes(frame.row(y))
+        for x in range(0, frame.width, factor):
+            out += row[x * channels:(x + 1) * channels]
+    return boot_harness.frame_from_bytes(-(-frame.width // factor), -(-frame.height // factor),
+                                         channels, bytes(out))
+
+
+def with_clock(frame):
+    '''The frame with a white box where a menu bar clock would be'''
+    data = bytearray(pixels(frame))
+    stride = frame.width * frame.channels
+    for y in range(frame.height // 40):
+        start = y * stride + (frame.width * 9 // 10) * frame.channels
+        data[start:(y + 1) * stride] = b'\xff' * ((y + 1) * stride - start)
+    return boot_harness.frame_from_bytes(frame.width, frame.height, frame.channels,
+                                         bytes(data))
+
+
+def xwd_dump(width, height, rgb, bits_per_pixel, byte_order, masks):
+    '''An xwd -root dump of a TrueColor ZPixmap holding rgb pixels'''
+    name = b'root\0\0\0\0'
+    bytes_per_line = width * bits_per_pixel // 8
+    header = struct.pack('>25I', 100 + len(name), 7, 2, 24, width, height, 0, byte_order,
+                         32, byte_order, 32, bits_per_pixel, bytes_per_line, 4,
+                         masks[0], masks[1], masks[2], 8, 0, 0, width, height, 0, 0, 0)
+    endian = 'little' if byte_order == 0 else 'big'
+    body = bytearray()
+    for index in range(0, len(rgb), 3):
+        value = 0
+        for channel, mask in zip(rgb[index:index + 3], masks):
+            shift = (mask & -mask).bit_length() - 1
+            value |= (channel * (mask >> shift) // 255) << shift
+        body += value.to_bytes(bits_per_pixel // 8, endian)
+    return header + name + bytes(body)
+
+
+def test_png_round_trip(tmp_path):
+    rgb = bytes(range(256)) * 3
+    frame = boot_harness.frame_from_bytes(16, 16, 3, rgb)
+    path = str(tmp_path / 'frame.png')
+    boot_harness.write_png(frame, path)
+
+    assert pixels(boot_harness.read_png(path)) == rgb
+
+
+def test_read_master(masters):
+    frame = masters['sonoma']
+    assert (frame.width, frame.height, frame.channels) == (1920, 1080, 3)
+    assert len(pixels(frame)) == 1920 * 1080 * 3
+
+
+def test_read_png_rejects_other_files(tmp_path):
+    path = tmp_path / 'frame.png'
+    path.write_bytes(b'GIF89a')
+    with pytest.raises(ValueError):
+        boot_harness.read_png(str(path))
+
+
+@pytest.mark.parametrize('bits_per_pixel, byte_order, masks', [
+    (32, 0, (0xff0000, 0xff00, 0xff)),
+    (32, 1, (0xff0000, 0xff00, 0xff)),
+    (16, 0, (0xf800, 0x07e0, 0x001f)),
+])
+def test_read_xwd(bits_per_pixel, byte_order, masks):
+    rgb = bytes([255, 0, 0, 0, 255, 0, 0, 0, 255, 255, 255, 255])
+    frame = boot_harness.read_xwd(xwd_dump(2, 2, rgb, bits_per_pixel, byte_order, masks))
+
+    assert (frame.width, frame.height, frame.channels) == (2, 2, 4)
+    decoded = pixels(frame)
+    assert [decoded[index:index + 3] for index in range(0, len(decoded), 4)] == \
+        [rgb[index:index + 3] for index in range(0, len(rgb), 3)]
+
+
+def test_matcher(masters):
+    master_hash = boot_harness.difference_hash(masters['sonoma'])
+    comparator = boot_harness.Comparator(master_hash, tolerance=0.4)
+
+    assert not comparator.feed(masters['catalina'])
+    assert comparator.feed(with_clock(masters['sonoma']))
+    assert comparator.feed(shrink(masters['sonoma'], 4))
+
+
+def test_recorded_boot(masters, tmp_path):
+    recording = tmp_path / 'sonoma'
+    recording.mkdir()
+    black = boot_harness.frame_from_bytes(480, 270, 3, bytes(480 * 270 * 3))
+    for elapsed, frame in ((0.0, black), (30.0, shrink(masters['catalina'], 4)),
+                           (95.5, shrink(with_clock(masters['sonoma']), 4))):
+        boot_harness.write_png(frame, str(recording / ('%08.3f.png' % elapsed)))
+    args = argparse.Namespace(tolerance=0.4, stable=1, interval=5.0, timeout=1800.0,
+                              record=None)
+
+    result = boot_harness.run_boot(boot_harness.RecordedBoot('sonoma', str(recording)),
+                                   boot_harness.difference_hash(masters['sonoma']),
+                                   boot_harness.Budget(), (4, 4), args)
+    assert result['status'] == 'pass'
+    assert result['time_to_installer'] == 95.5
+    assert result['frames'] == 3
+
+    args.timeout = 60.0
+    result = boot_harness.run_boot(boot_harness.RecordedBoot('sonoma', str(recording)),
+                                   boot_harness.difference_hash(masters['sonoma']),
+                                   boot_harness.Budget(), (4, 4), args)
+    assert result['status'] == 'timeout'
@@ -0,0 +1,202 @@
+'''test_bootdisk_factory.py
+Patches config.plist into small GPT + FAT16 bootdisks with
+custom/bootdisk_factory.py and checks that the directory entry size and the
+cluster chain still agree, with fsck.vfat where dosfstools is installed.
+
+Usage: python -m pytest tests/test_bootdisk_factory.py'''
+
+import os
+import sys
+import shutil
+import struct
+import plistlib
+import subprocess
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'custom'))
+bootdisk_factory = importlib.import_module('bootdisk_factory')
+
+SECTOR = bootdisk_factory.SECTOR_SIZE
+FAT_CLUSTERS = 4200          # enough for FAT16 with one sector per cluster
+FAT_SECTORS = -(-(FAT_CLUSTERS + 2) * 2 // SECTOR)
+ROOT_ENTRIES = 512
+PARTITION_LBA = 34
+# config.plist deliberately fragmented, as it is after mcopy on a used image
+CONFIG_CLUSTERS = [10, 11, 12, 20, 21]
+
+
+def plist(keys):
+    return plistlib.dumps({f'Key{index}': 'x' * 40 for index in range(keys)})
+
+
+def short_entry(name, attributes, cluster, size):
+    return struct.pack('<11sB8xHHHHI', name, attributes, 0, 0, 0, cluster, size)
+
+
+def long_name_entry(name, short_name):
+    checksum = 0
+    for byte in short_name:
+        checksum = ((checksum >> 1) | (checksum << 7 & 0x80)) + byte & 0xff
+    chars = (name + '\0').ljust(13, '￿').encode('utf-16-le')
+    return (bytes([0x41]) + chars[:10] + bytes([0x0f, 0, checksum]) + chars[10:22] +
+            b'\0\0' + chars[22:26])
+
+
+def fat16_partition(config):
+    '''Returns a FAT16 file system holding EFI/OC/config.plist'''
+    total = 1 + 2 * FAT_SECTORS + ROOT_ENTRIES * 32 // SECTOR + FAT_CLUSTERS
+    boot = bytearray(SECTOR)
+    boot[0:3] = b'\xeb\x3c\x90'
+    boot[3:11] = b'MSWIN4.1'
+    struct.pack_into('<HBHBHHBHHHIIBxBI11s8s', boot, 11, SECTOR, 1, 1, 2, ROOT_ENTRIES,
+                     total, 0xf8, FAT_SECTORS, 32, 64, 0, 0, 0x80, 0x29, 0x1234abcd,
+                     b'EFI        ', b'FAT16   ')
+    boot[510:512] = b'\x55\xaa'
+
+    fat = [0xfff8, 0xffff, 0xffff, 0xffff] + [0] * (FAT_CLUSTERS - 2)
+    for cluster, following in zip(CONFIG_CLUSTERS, CONFIG_CLUSTERS[1:] + [0xffff]):
+        fat[cluster] = following
+    fat = struct.pack('<%dH' % len(fat), *fat).ljust(FAT_SECTORS * SECTOR, b'\0')
+
+    root = short_entry(b'EFI        ', 0x10, 2, 0).ljust(ROOT_ENTRIES * 32, b'\0')
+    data = bytearray(FAT_CLUSTERS * SECTOR)
+    efi = (short_entry(b'.          ', 0x10, 2, 0) + short_entry(b'..         ', 0x10, 0, 0) +
+           short_entry(b'OC         ', 0x10, 3, 0))
+    opencore = (short_entry(b'.          ', 0x10, 3, 0) + short_entry(b'..         ', 0x10, 2, 0) +
+                long_name_entry('config.plist', b'CONFIG~1PLI') +
+                short_entry(b'CONFIG~1PLI', 0x20, CONFIG_CLUSTERS[0], len(config)))
+    data[0:len(efi)] = efi
+    data[SECTOR:SECTOR + len(opencore)] = opencore
+    for index, cluster in enumerate(CONFIG_CLUSTERS):
+        chunk = config[index * SECTOR:(index + 1) * SECTOR]
+        data[(cluster - 2) * SECTOR:(cluster - 2) * SECTOR + len(chunk)] = chunk
+    return bytes(boot) + fat + fat + root + bytes(data)
+
+
+def gpt_disk(partition):
+    '''Wraps a partition in a protective MBR and a GPT with one ESP'''
+    mbr = bytearray(SECTOR)
+    struct.pack_into('<B3xB3xII', mbr, 446, 0, 0xee, 1, 0xffffffff)
+    mbr[510:512] = b'\x55\xaa'
+    last_lba = PARTITION_LBA + len(partition) // SECTOR - 1
+    header = b'EFI PART' + struct.pack('<IIIIQQQQ16sQIII', 0x10000, 92, 0, 0, 1, 0,
+                                       PARTITION_LBA, last_lba, b'\x11' * 16, 2, 128, 128, 0)
+    entries = bootdisk_factory.ESP_TYPE + b'\x22' * 16 + struct.pack(
+        '<QQQ', PARTITION_LBA, last_lba, 0) + 'EFI'.encode('utf-16-le').ljust(72, b'\0')
+    return (bytes(mbr) + header.ljust(SECTOR, b'\0') +
+            entries.ljust(32 * SECTOR, b'\0') + partition)
+
+
+def master_config():
+    # the base image pads the master plist to the clusters it is given
+    master = plist(25)
+    return master.ljust(len(CONFIG_CLUSTERS) * SECTOR - 1) + b'\n'
+
+
+@pytest.fixture
+def base(tmp_path):
+    path = tmp_path / 'base.raw'
+    path.write_bytes(gpt_disk(fat16_partition(master_config())))
+    with bootdisk_factory.DiskImage(str(path)) as image:
+        yield image
+
+
+def make(base, config, output_path):
+    location = bootdisk_factory.locate_config(base)
+    patches = bootdisk_factory.config_patches(base, location, config)
+    if output_path.endswith('.raw'):
+        bootdisk_factory.write_raw(base, output_path, patches)
+    else:
+        bootdisk_factory.write_overlay(base, output_path, patches)
+
+
+def read_config(path):
+    with bootdisk_factory.DiskImage(path) as image:
+        location = bootdisk_factory.locate_config(image)
+        data = b''.join(image.read(offset, length) for offset, length in location.extents)
+        return location, data[:location.size]
+
+
+@pytest.mark.parametrize('name', ['disk.raw', 'disk.qcow2'])
+def test_shorter_config_keeps_the_chain(base, tmp_path, name):
+    config = plist(3)
+    output = str(tmp_path / name)
+    make(base, config, output)
+
+    location, data = read_config(output)
+    assert location.size == len(CONFIG_CLUSTERS) * SECTOR
+    assert location.capacity == len(CONFIG_CLUSTERS) * SECTOR
+    assert data.startswith(config) and not data[len(config):].strip()
+    assert b'\0' not in data
+    assert plistlib.loads(data) == plistlib.loads(config)
+    assert bootdisk_factory.check_bootdisk(output, config) == []
+
+
+def test_longer_config_keeps_the_recorded_size(base, tmp_path):
+    config = plist(3).ljust(len(CONFIG_CLUSTERS) * SECTOR - 100)
+    config = config.replace(b'</plist>', b'') + b'</plist>\n'
+    output = str(tmp_path / 'disk.raw')
+    make(base, config, output)
+
+    location, data = read_config(output)
+    assert location.size == len(CONFIG_CLUSTERS) * SECTOR
+    assert data.startswith(config)
+    assert bootdisk_factory.check_bootdisk(output, config) == []
+
+
+def test_config_larger_than_the_chain_is_refused(base, tmp_path):
+    location = bootdisk_factory.locate_config(base)
+    with pytest.raises(bootdisk_factory.BootdiskError):
+        bootdisk_factory.config_patches(base, location, b' ' * (location.capacity + 1))
+
+
+def test_check_flags_a_size_shorter_than_the_chain(base, tmp_path):
+    location = bootdisk_factory.locate_config(base)
+    entry = bytearray(base.read(location.entry_offset, 32))
+    struct.pack_into('<I', entry, 28, SECTOR + 1)
+    output = str(tmp_path / 'disk.raw')
+    bootdisk_factory.write_raw(base, output, {location.entry_offset: bytes(entry)})
+
+    problems = bootdisk_factory.check_bootdisk(output)
+    assert problems and 'cluster chain' in problems[0]
+
+
+def test_check_flags_a_different_config(base, tmp_path):
+    output = str(tmp_path / 'disk.raw')
+    make(base, plist(3), output)
+    assert bootdisk_factory.check_bootdisk(output, plist(4)) == [
+        'config.plist differs from the expected file']
+
+
+@pytest.mark.skipif(not all(shutil.which(tool) for tool in ('mkfs.vfat', 'fsck.vfat',
+                                                              'mmd', 'mcopy', 'mtype')),
+                    reason='needs dosfstools and mtools')
+def test_fsck_accepts_a_patched_mkfs_image(tmp_path):
+    partition = tmp_path / 'esp.img'
+    master = tmp_path / 'config.plist'
+    master.write_bytes(master_config())
+    subprocess.run(['mkfs.vfat', '-F', '16', '-C', str(partition), '4096'],
+                   check=True, stdout=subprocess.DEVNULL)
+    for directory in ('::EFI', '::EFI/OC'):
+        subprocess.run(['mmd', '-i', str(partition), directory], check=True)
+    subprocess.run(['mcopy', '-i', str(partition), str(master), '::EFI/OC/config.plist'],
+                   check=True)
+    (tmp_path / 'base.raw').write_bytes(gpt_disk(partition.read_bytes()))
+
+    config = plist(3)
+    output = str(tmp_path / 'disk.raw')
+    with bootdisk_factory.DiskImage(str(tmp_path / 'base.raw')) as image:
+        make(image, config, output)
+    with open(output, 'rb') as f:
+        f.seek(PARTITION_LBA * SECTOR)
+        partition.write_bytes(f.read())
+
+    fsck = subprocess.run(['fsck.vfat', '-n', str(partition)],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert fsck.returncode == 0, fsck.stdout
+    shown = subprocess.run(['mtype', '-i', str(partition), '::EFI/OC/config.plist'],
+                           stdout=subprocess.PIPE, check=True).stdout
+    assert shown.startswith(config) and not shown[len(config):].strip()
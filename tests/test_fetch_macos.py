@@ -0,0 +1,866 @@
+'''test_fetch_macos.py
+Downloads and converts packages with fetch_macos.py against the local
+BenchServer from bench_fetch_macos.py: ranged and resumed downloads,
+chunklist and digest verification, servers without range support, and
+UDIF images decoded to raw and qcow2. Also covers the package store,
+mirror ranking, transfer limits, telemetry, catalog indexes and the
+choice of version.
+
+Usage: python -m pytest tests/test_fetch_macos.py'''
+
+import io
+import os
+import bz2
+import json
+import lzma
+import zlib
+import datetime
+import time
+import socket
+import struct
+import hashlib
+import plistlib
+import threading
+
+import pytest
+
+from bench_fetch_macos import BenchServer, blob_block, synthetic_files, BLOCK_SIZE
+from bench_sucatalog import load_fetch_macos, synthetic_catalog
+
+fetch_macos = load_fetch_macos()
+
+SEGMENT_SIZE = 64 * 1024
+PACKAGE_SIZE = 16 * BLOCK_SIZE
+
+
+def blob(size):
+    return b''.join(blob_block(index) for index in range(-(-size // BLOCK_SIZE)))[:size]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # small segments, so that a 1 MiB package is downloaded in several
+    monkeypatch.setattr(fetch_macos, 'MIN_SEGMENT_SIZE', SEGMENT_SIZE)
+    monkeypatch.setattr(fetch_macos, 'connection_pool', fetch_macos.ConnectionPool())
+    monkeypatch.setattr(fetch_macos, 'transfer_limits', fetch_macos.TransferLimits())
+    monkeypatch.setattr(fetch_macos, 'telemetry', fetch_macos.Telemetry())
+    server = BenchServer({}, PACKAGE_SIZE)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def chunklist_bytes(data, chunk_size):
+    chunks = [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+    header = fetch_macos.CHUNKLIST_HEADER
+    return header.pack(fetch_macos.CHUNKLIST_MAGIC, header.size, 1, 1, 0, 0,
+                       len(chunks), header.size, 0) + b''.join(
+        fetch_macos.CHUNKLIST_ENTRY.pack(len(chunk), hashlib.sha256(chunk).digest())
+        for chunk in chunks)
+
+
+def test_segmented_download(server, tmp_path):
+    path = str(tmp_path / 'InstallESDDmg.pkg')
+    fetch_macos.download_file(server.base + '/InstallESDDmg.pkg', path, segments=4)
+
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == blob(PACKAGE_SIZE)
+    assert server.requests > 1
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_resume_fetches_only_missing_segments(server, tmp_path):
+    url = server.base + '/InstallESDDmg.pkg'
+    path = str(tmp_path / 'InstallESDDmg.pkg')
+    half = PACKAGE_SIZE // 2
+    with open(path + '.part', 'wb') as the_file:
+        the_file.write(blob(half))
+    with open(path + '.part.json', 'w') as the_file:
+        json.dump({'url': url, 'size': PACKAGE_SIZE,
+                   'segments': [[0, half, half], [half, PACKAGE_SIZE, 0]]}, the_file)
+
+    fetch_macos.download_file(url, path, attempt_resume=True)
+
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == blob(PACKAGE_SIZE)
+    # the second half, and one byte to check the size
+    assert server.bytes_sent == PACKAGE_SIZE - half + 1
+
+
+def test_resume_starts_over_when_the_file_changed_size(server, tmp_path):
+    url = server.base + '/InstallESDDmg.pkg'
+    path = str(tmp_path / 'InstallESDDmg.pkg')
+    with open(path + '.part', 'wb') as the_file:
+        the_file.write(b'\xff' * 2 * PACKAGE_SIZE)
+    with open(path + '.part.json', 'w') as the_file:
+        json.dump({'url': url, 'size': 2 * PACKAGE_SIZE,
+                   'segments': [[0, 2 * PACKAGE_SIZE, PACKAGE_SIZE]]}, the_file)
+
+    fetch_macos.download_file(url, path, attempt_resume=True)
+
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == blob(PACKAGE_SIZE)
+
+
+def test_tampered_chunk_is_rejected(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_macos, 'DOWNLOAD_RETRIES', 2)
+    data = blob(PACKAGE_SIZE)
+    chunklist = fetch_macos.ChunkList.parse(chunklist_bytes(data, SEGMENT_SIZE))
+    tampered = bytearray(data)
+    tampered[5 * SEGMENT_SIZE + 100] ^= 0xff
+    server.files['/BaseSystem.dmg'] = bytes(tampered)
+    url = server.base + '/BaseSystem.dmg'
+    path = str(tmp_path / 'BaseSystem.dmg')
+
+    with pytest.raises(fetch_macos.ReplicationError):
+        fetch_macos.download_file(url, path, chunklist=chunklist, segments=4)
+    assert not os.path.exists(path)
+    with open(path + '.part.json') as the_file:
+        segments = json.load(the_file)['segments']
+    # everything but the tampered chunk's segment, which stops right before it
+    assert sum(done for _, _, done in segments) < PACKAGE_SIZE
+    assert [start + done for start, end, done in segments
+            if start + done < end] == [5 * SEGMENT_SIZE]
+
+    server.files['/BaseSystem.dmg'] = data
+    server.bytes_sent = 0
+    fetch_macos.download_file(url, path, attempt_resume=True, chunklist=chunklist, segments=4)
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == data
+    assert server.bytes_sent < PACKAGE_SIZE
+
+
+def test_rejected_chunk_is_not_counted(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_macos, 'DOWNLOAD_RETRIES', 2)
+    monkeypatch.setattr(fetch_macos.time, 'sleep', lambda seconds: None)
+    data = blob(PACKAGE_SIZE)
+    chunklist = fetch_macos.ChunkList.parse(chunklist_bytes(data, SEGMENT_SIZE))
+    tampered = bytearray(data)
+    tampered[2 * SEGMENT_SIZE + 100] ^= 0xff
+    server.files['/BaseSystem.dmg'] = bytes(tampered)
+    state = fetch_macos.SegmentState(str(tmp_path / 'state.json'), 'url', PACKAGE_SIZE,
+                                     [[0, PACKAGE_SIZE, 0]])
+    progress = fetch_macos.DownloadProgress(PACKAGE_SIZE)
+
+    with open(str(tmp_path / 'BaseSystem.dmg'), 'wb') as the_file:
+        with pytest.raises(fetch_macos.ReplicationError):
+            fetch_macos.fetch_segment(server.base + '/BaseSystem.dmg', the_file.fileno(),
+                                      state, 0, progress, chunklist)
+    # both attempts got the two good chunks and part of the bad one, but
+    # only the good chunks count
+    assert state.segments[0][2] == 2 * SEGMENT_SIZE
+    assert progress.done == 2 * SEGMENT_SIZE
+    assert server.bytes_sent > 2 * SEGMENT_SIZE
+
+
+def test_resume_without_chunklist_is_realigned(server, tmp_path):
+    data = blob(PACKAGE_SIZE)
+    chunklist = fetch_macos.ChunkList.parse(chunklist_bytes(data, SEGMENT_SIZE))
+    server.files['/BaseSystem.dmg'] = data
+    url = server.base + '/BaseSystem.dmg'
+    path = str(tmp_path / 'BaseSystem.dmg')
+    # a run without the chunklist wrote the first half and a bit, in
+    # segments that are not on chunk boundaries, and one bad byte
+    written = PACKAGE_SIZE // 2 + 1000
+    partial = bytearray(data[:written])
+    partial[SEGMENT_SIZE + 5] ^= 0xff
+    with open(path + '.part', 'wb') as the_file:
+        the_file.write(bytes(partial))
+    with open(path + '.part.json', 'w') as the_file:
+        json.dump({'url': url, 'size': PACKAGE_SIZE,
+                   'segments': [[0, 3000, 3000], [3000, written, written - 3000],
+                                [written, PACKAGE_SIZE, 0]]}, the_file)
+
+    fetch_macos.download_file(url, path, attempt_resume=True, chunklist=chunklist, segments=1)
+
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == data
+    # everything from the bad chunk on, and the partial chunk, is fetched
+    assert server.bytes_sent == PACKAGE_SIZE - SEGMENT_SIZE
+
+
+def test_chunklist_alignment():
+    data = blob(PACKAGE_SIZE)
+    chunklist = fetch_macos.ChunkList.parse(chunklist_bytes(data, SEGMENT_SIZE))
+    assert chunklist.aligned(chunklist.segments(4))
+    assert chunklist.aligned([[0, SEGMENT_SIZE, SEGMENT_SIZE],
+                              [SEGMENT_SIZE, PACKAGE_SIZE, 2 * SEGMENT_SIZE]])
+    assert not chunklist.aligned([[0, 100, 100], [100, PACKAGE_SIZE, 0]])
+    assert not chunklist.aligned([[0, PACKAGE_SIZE, 100]])
+
+
+def test_invalid_chunklist_is_rejected():
+    with pytest.raises(fetch_macos.IntegrityError):
+        fetch_macos.ChunkList.parse(b'\0' * 64)
+
+
+def test_bad_digest_is_rejected(server, tmp_path):
+    url = server.base + '/InstallESDDmg.pkg'
+    path = str(tmp_path / 'InstallESDDmg.pkg')
+
+    with pytest.raises(fetch_macos.IntegrityError):
+        fetch_macos.download_file(url, path, digest='0' * 64)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+    digest = hashlib.sha256(blob(PACKAGE_SIZE)).hexdigest()
+    assert fetch_macos.download_file(url, path, digest=digest.upper()) == path
+
+
+def test_server_without_range_support(server, tmp_path):
+    server.ranges = False
+    path = str(tmp_path / 'InstallESDDmg.pkg')
+    fetch_macos.download_file(server.base + '/InstallESDDmg.pkg', path, segments=4)
+
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == blob(PACKAGE_SIZE)
+    assert server.requests == 1
+    assert not os.path.exists(path + '.part.json')
+
+
+def sectors(count, seed):
+    # incompressible, so that the .dmg spans several download segments
+    return b''.join(hashlib.sha256(b'%s %d' % (seed, index)).digest()
+                    for index in range(count * 16))
+
+
+def mish(first_sector, sector_count, chunks):
+    '''A mish block table for chunks of (type, sector, count, offset, length)'''
+    header = fetch_macos.MISH_HEADER.pack(b'mish', 1, first_sector, sector_count, 0, 0, 0,
+                                          b'', 0, 0, b'', len(chunks) + 1)
+    entries = [fetch_macos.MISH_CHUNK.pack(*chunk) for chunk in chunks]
+    entries.append(fetch_macos.MISH_CHUNK.pack(fetch_macos.UDIF_TERMINATOR,
+                                               0, sector_count, 0, 0, 0))
+    return header + b''.join(entries)
+
+
+def synthetic_dmg():
+    '''Returns (.dmg bytes, the disk it decodes to) for a UDIF image with
+    two partitions and raw, zero, zlib, bzip2 and lzma chunks'''
+    first = [(fetch_macos.UDIF_RAW, sectors(8, b'raw'), lambda data: data),
+             (fetch_macos.UDIF_ZERO, bytes(8 * 512), None),
+             (fetch_macos.UDIF_ZLIB, sectors(256, b'zlib'), zlib.compress),
+             (fetch_macos.UDIF_COMMENT, b'', None)]
+    second = [(fetch_macos.UDIF_BZIP2, sectors(128, b'bzip2'), bz2.compress),
+              (fetch_macos.UDIF_IGNORE, bytes(64 * 512), None),
+              (fetch_macos.UDIF_LZMA, sectors(1024, b'lzma'), lzma.compress),
+              (fetch_macos.UDIF_RAW, bytes(16 * 512), lambda data: data)]
+    data_fork = bytearray(b'data fork header')
+    disk = bytearray()
+    blkx = []
+    for name, partition in (('Driver', first), ('Apple_HFS', second)):
+        first_sector = len(disk) // 512
+        chunks = []
+        for entry_type, contents, compress in partition:
+            stored = compress(contents) if compress else b''
+            chunks.append((entry_type, 0, len(disk) // 512 - first_sector,
+                           len(contents) // 512, len(data_fork), len(stored)))
+            data_fork += stored
+            disk += contents
+        blkx.append({'Name': name, 'Data': mish(first_sector, len(disk) // 512 - first_sector,
+                                                chunks)})
+    xml = plistlib.dumps({'resource-fork': {'blkx': blkx}})
+    trailer = fetch_macos.KOLY_TRAILER.pack(
+        b'koly', 4, 512, 1, 0, 0, len(data_fork), 0, 0, 1, 1, b'', 0, 0, b'',
+        len(data_fork), len(xml), b'', 0, 0, b'', 1, len(disk) // 512, b'')
+    return bytes(data_fork) + xml + trailer, bytes(disk)
+
+
+def read_qcow2(path):
+    '''Returns the guest contents of a qcow2 image without a backing file'''
+    with open(path, 'rb') as the_file:
+        image = the_file.read()
+    (magic, version, _, _, cluster_bits, size, _, l1_size,
+     l1_offset) = struct.unpack_from('>4sIQIIQIIQ', image)
+    assert (magic, version) == (b'QFI\xfb', 2)
+    cluster_size = 1 << cluster_bits
+    mask = 0x00fffffffffffe00
+    disk = bytearray(size)
+    for l1_index, l2_offset in enumerate(struct.unpack_from('>%dQ' % l1_size, image, l1_offset)):
+        if not l2_offset & mask:
+            continue
+        for l2_index, offset in enumerate(struct.unpack_from(
+                '>%dQ' % (cluster_size // 8), image, l2_offset & mask)):
+            if offset & mask:
+                guest = (l1_index * cluster_size // 8 + l2_index) * cluster_size
+                disk[guest:guest + cluster_size] = \
+                    image[offset & mask:(offset & mask) + cluster_size][:size - guest]
+    return bytes(disk)
+
+
+def read_image(path, output_format):
+    if output_format == 'qcow2':
+        return read_qcow2(path)
+    with open(path, 'rb') as the_file:
+        return the_file.read()
+
+
+def test_udif_block_tables():
+    dmg, disk = synthetic_dmg()
+    image = fetch_macos.UdifImage.read(lambda offset, length: dmg[offset:offset + length],
+                                       len(dmg))
+
+    assert image.size == len(disk)
+    types = [chunk[0] for chunk in image.chunks]
+    assert fetch_macos.UDIF_COMMENT not in types
+    assert fetch_macos.UDIF_TERMINATOR not in types
+    assert len(image.chunks) == 7
+    # output offsets count from each partition's first sector
+    assert [chunk[1] // 512 for chunk in image.chunks] == [0, 8, 16, 272, 400, 464, 1488]
+    raw = image.chunks[0]
+    assert dmg[raw[3]:raw[3] + raw[4]] == disk[:raw[2]]
+
+
+def test_udif_without_koly_trailer():
+    with pytest.raises(fetch_macos.UdifError):
+        fetch_macos.UdifImage.read(lambda offset, length: bytes(length), 4096)
+
+
+@pytest.mark.parametrize('output_format', ['raw', 'qcow2'])
+def test_convert_dmg(tmp_path, output_format):
+    dmg, disk = synthetic_dmg()
+    (tmp_path / 'BaseSystem.dmg').write_bytes(dmg)
+    output = str(tmp_path / ('BaseSystem.' + output_format))
+    fetch_macos.convert_dmg(str(tmp_path / 'BaseSystem.dmg'), output, output_format, jobs=2)
+
+    assert read_image(output, output_format) == disk
+    assert not os.path.exists(output + '.part')
+
+
+def test_convert_while_downloading(server, tmp_path):
+    dmg, disk = synthetic_dmg()
+    assert len(dmg) > 2 * SEGMENT_SIZE
+    server.files['/content/BaseSystem.dmg'] = dmg
+    output = str(tmp_path / 'BaseSystem.qcow2')
+    fetch_macos.replicate_and_convert(server.base + '/content/BaseSystem.dmg',
+                                      str(tmp_path), output, 'qcow2', jobs=2,
+                                      installer=True)
+
+    assert read_qcow2(output) == disk
+    with open(str(tmp_path / 'BaseSystem.dmg'), 'rb') as the_file:
+        assert the_file.read() == dmg
+
+
+def test_convert_while_downloading_from_a_mirror(server, tmp_path, monkeypatch):
+    dmg, disk = synthetic_dmg()
+    # the catalog's host is slower and serves garbage, so the block tables
+    # have to come from the mirror that the download uses
+    server.files['/content/BaseSystem.dmg'] = bytes(len(dmg))
+    server.latency = 0.2
+    mirror = BenchServer({'/content/BaseSystem.dmg': dmg}, PACKAGE_SIZE)
+    threading.Thread(target=mirror.serve_forever, daemon=True).start()
+    monkeypatch.setattr(fetch_macos, 'mirror_ranker', fetch_macos.MirrorRanker([mirror.base]))
+    output = str(tmp_path / 'BaseSystem.qcow2')
+    try:
+        fetch_macos.replicate_and_convert(server.base + '/content/BaseSystem.dmg',
+                                          str(tmp_path), output, 'qcow2', jobs=2,
+                                          installer=True)
+    finally:
+        mirror.shutdown()
+        mirror.server_close()
+
+    assert read_qcow2(output) == disk
+
+
+def store_download(data, calls):
+    def download(path):
+        calls.append(path)
+        # download_file() creates the directory of the file it is given
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as the_file:
+            the_file.write(data)
+        return path
+    return download
+
+
+def test_package_store_links_into_every_workdir(tmp_path):
+    store = fetch_macos.PackageStore(str(tmp_path / 'store'))
+    url = 'http://example.com/content/InstallAssistant.pkg'
+    calls = []
+    first = str(tmp_path / 'one' / 'InstallAssistant.pkg')
+    second = str(tmp_path / 'two' / 'InstallAssistant.pkg')
+    digest = hashlib.sha1(b'package').hexdigest()
+    store.replicate(url, first, store_download(b'package', calls), digest=digest)
+    store.replicate(url, second, store_download(b'package', calls), digest=digest)
+
+    assert calls == [store.entry_path(url, digest)]
+    assert os.path.samefile(first, second)
+    assert os.path.samefile(first, store.entry_path(url, digest))
+
+    # another catalog digest is another package, and the old copy in the
+    # working directory is not adopted for it
+    store.replicate(url, first, store_download(b'other', calls),
+                    digest=hashlib.sha1(b'other').hexdigest())
+    assert len(calls) == 2
+    with open(second, 'rb') as the_file:
+        assert the_file.read() == b'package'
+
+
+def test_package_store_copies_across_filesystems(tmp_path, monkeypatch):
+    def cross_device(source, destination):
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', cross_device)
+    store = fetch_macos.PackageStore(str(tmp_path / 'store'))
+    url = 'http://example.com/content/BaseSystem.dmg'
+    path = str(tmp_path / 'work' / 'BaseSystem.dmg')
+    store.replicate(url, path, store_download(b'base system', []))
+
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == b'base system'
+    assert not os.path.samefile(path, store.entry_path(url))
+    assert not [name for name in os.listdir(str(tmp_path / 'work')) if name.endswith('.tmp')]
+
+
+def test_package_store_downloads_each_entry_once(tmp_path):
+    store = fetch_macos.PackageStore(str(tmp_path / 'store'))
+    url = 'http://example.com/content/InstallAssistant.pkg'
+    calls = []
+    download = store_download(b'package', calls)
+
+    def slow_download(path):
+        time.sleep(0.2)
+        return download(path)
+
+    # every replicate() opens its own lock file, so the threads contend
+    # for the entry's flock just as separate processes would
+    threads = [threading.Thread(target=store.replicate,
+                                args=(url, str(tmp_path / str(index) / 'pkg'), slow_download))
+               for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    for index in range(4):
+        assert os.path.samefile(str(tmp_path / str(index) / 'pkg'), store.entry_path(url))
+
+
+def test_package_store_evicts_least_recently_used(tmp_path):
+    store = fetch_macos.PackageStore(str(tmp_path / 'store'), max_bytes=2500)
+    urls = ['http://example.com/content/%s.pkg' % name for name in ('a', 'b', 'c', 'd')]
+    for age, url in enumerate(urls[:2]):
+        store.replicate(url, str(tmp_path / 'work' / url[-5:]), store_download(b'x' * 1000, []))
+        os.utime(store.entry_path(url), (1000 + age, 1000 + age))
+    # using a makes b the least recently used
+    store.replicate(urls[0], str(tmp_path / 'again.pkg'), store_download(b'', []))
+
+    store.replicate(urls[2], str(tmp_path / 'work' / 'c.pkg'), store_download(b'x' * 1000, []))
+    assert os.path.exists(store.entry_path(urls[0]))
+    assert not os.path.exists(store.entry_path(urls[1]))
+    assert os.path.exists(store.entry_path(urls[2]))
+    # the working directory keeps its link
+    assert os.path.exists(str(tmp_path / 'work' / 'b.pkg'))
+
+    # an entry locked by another process is skipped, and the next one goes
+    os.utime(store.entry_path(urls[2]), (1000, 1000))
+    fd = store._lock(os.path.dirname(store.entry_path(urls[2])) + '.lock')
+    try:
+        store.replicate(urls[3], str(tmp_path / 'work' / 'd.pkg'),
+                        store_download(b'x' * 1000, []))
+    finally:
+        store._unlock(fd)
+    assert os.path.exists(store.entry_path(urls[2]))
+    assert not os.path.exists(store.entry_path(urls[0]))
+    assert os.path.exists(store.entry_path(urls[3]))
+
+
+def test_concurrent_metadata_keeps_catalog_order(monkeypatch, capsys):
+    catalog = synthetic_catalog(40, 8)
+    installers = fetch_macos.find_mac_os_installers(catalog)
+
+    def product_installer_info(catalog, product_key, workdir, ignore_cache=False):
+        # later products finish first
+        time.sleep(0.01 * (len(installers) - installers.index(product_key)))
+        for _ in range(50):
+            fetch_macos.print_line('[+] Fetching %s' % product_key)
+        if product_key == installers[2]:
+            raise fetch_macos.ReplicationError('unreachable')
+        return {'title': 'macOS', 'version': product_key}
+    monkeypatch.setattr(fetch_macos, 'product_installer_info', product_installer_info)
+    monkeypatch.setattr(fetch_macos, 'telemetry', fetch_macos.Telemetry())
+
+    product_info = fetch_macos.os_installer_product_info(catalog, None, jobs=len(installers))
+    assert list(product_info) == installers
+    assert [info['version'] for info in product_info.values()] == [
+        None if index == 2 else key for index, key in enumerate(installers)]
+    # every message is a whole line
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 50 * len(installers)
+    assert set(lines) == set('[+] Fetching %s' % key for key in installers)
+
+
+def test_merge_product_indexes():
+    catalog = {'Products': {'001': {'PostDate': 1}, '002': {'PostDate': 2}}}
+    seed = {'Products': {'002': {'PostDate': 3}, '003': {'PostDate': 4}}}
+    merged_catalog, merged_info = fetch_macos.merge_product_indexes([
+        ('PublicRelease', catalog, {'001': {'version': '14.1'}, '002': {'version': '14.2'}}),
+        ('DeveloperSeed', seed, {'002': {'version': '14.2'}, '003': {'version': '15.0'}}),
+    ])
+
+    assert list(merged_info) == ['001', '002', '003']
+    assert [info['seeds'] for info in merged_info.values()] == [
+        ['PublicRelease'], ['PublicRelease', 'DeveloperSeed'], ['DeveloperSeed']]
+    # the first catalog's entry wins
+    assert merged_catalog['Products']['002'] == {'PostDate': 2}
+
+
+def test_shared_fetches_submit_each_key_once():
+    import concurrent.futures
+    calls = []
+    lock = threading.Lock()
+
+    def fetch(url):
+        with lock:
+            calls.append(url)
+        time.sleep(0.05)
+        return url
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        fetches = fetch_macos.SharedFetches(pool)
+        futures = [fetches.submit((url, None), fetch, url)
+                   for url in ['a', 'b', 'a', 'c', 'b', 'a']]
+        assert [future.result() for future in futures] == ['a', 'b', 'a', 'c', 'b', 'a']
+    assert sorted(calls) == ['a', 'b', 'c']
+
+
+def test_merged_index_leaves_out_unreachable_seeds(server, tmp_path, monkeypatch, capsys):
+    catalog, files, installers = synthetic_files(server.base, 20, 4)
+    files['/first.sucatalog'] = catalog
+    files['/second.sucatalog'] = catalog
+    server.files = files
+    monkeypatch.setattr(fetch_macos, 'catalogs', {
+        'First': server.base + '/first.sucatalog',
+        'Dead': server.base + '/dead.sucatalog',
+        'Second': server.base + '/second.sucatalog',
+    })
+
+    _, product_info = fetch_macos.get_merged_product_index(
+        ['First', 'Dead', 'Second'], str(tmp_path / 'work'), cache_dir=str(tmp_path / 'cache'))
+    assert [(key, info['version'], info['seeds']) for key, info in product_info.items()] == [
+        (key, version, ['First', 'Second']) for key, version in installers]
+    # two catalogs, and the metadata and .dist of each installer once
+    assert server.requests == 2 + 2 * len(installers)
+    assert 'Leaving out the Dead catalog.' in capsys.readouterr().err
+
+    with pytest.raises(SystemExit):
+        fetch_macos.get_merged_product_index(['Dead', 'Dead'], str(tmp_path / 'work'),
+                                             cache_dir=str(tmp_path / 'cache'))
+
+
+def dead_mirror():
+    '''A base URL that refuses connections'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%d' % sock.getsockname()[1]
+
+
+@pytest.fixture
+def mirror():
+    mirror = BenchServer({}, PACKAGE_SIZE)
+    threading.Thread(target=mirror.serve_forever, daemon=True).start()
+    yield mirror
+    mirror.shutdown()
+    mirror.server_close()
+
+
+def test_mirrors_are_ranked_fastest_first(server, mirror):
+    server.latency = 0.2
+    dead = dead_mirror()
+    slow = BenchServer({}, PACKAGE_SIZE, latency=0.4)
+    threading.Thread(target=slow.serve_forever, daemon=True).start()
+    try:
+        ranker = fetch_macos.MirrorRanker([dead, slow.base + '/', mirror.base])
+        ranking = ranker.rank(server.base + '/content/InstallAssistant.pkg')
+    finally:
+        slow.shutdown()
+        slow.server_close()
+
+    assert ranking == [mirror.base, None, slow.base, dead]
+
+
+def test_unusable_mirrors_fall_back_to_the_catalog_host(server, tmp_path, monkeypatch):
+    # one refuses connections, the other has a different file
+    other = BenchServer({}, PACKAGE_SIZE // 2)
+    threading.Thread(target=other.serve_forever, daemon=True).start()
+    dead = dead_mirror()
+    ranker = fetch_macos.MirrorRanker([dead, other.base])
+    monkeypatch.setattr(fetch_macos, 'mirror_ranker', ranker)
+    try:
+        path = fetch_macos.replicate_url(server.base + '/content/BaseSystem.dmg',
+                                         root_dir=str(tmp_path), installer=True)
+    finally:
+        other.shutdown()
+        other.server_close()
+
+    assert ranker.rank(server.base + '/content/BaseSystem.dmg')[0] is None
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == blob(PACKAGE_SIZE)
+    # only the probe reached the other mirror
+    assert other.requests == 1
+
+
+def test_mirror_ranking_expires_after_its_ttl(server, mirror, tmp_path):
+    server.latency = 0.2
+    url = server.base + '/content/InstallAssistant.pkg'
+    cache_path = str(tmp_path / 'mirrors.json')
+    assert fetch_macos.MirrorRanker([mirror.base], cache_path, ttl=60).rank(url)[0] == mirror.base
+    probes = mirror.requests
+
+    # another run within the ttl reuses the ranking from the cache
+    ranker = fetch_macos.MirrorRanker([mirror.base], cache_path, ttl=60)
+    assert ranker.rank(url)[0] == mirror.base
+    assert mirror.requests == probes
+
+    with open(cache_path) as the_file:
+        rankings = json.load(the_file)
+    for entry in rankings.values():
+        entry['time'] -= 120
+    with open(cache_path, 'w') as the_file:
+        json.dump(rankings, the_file)
+    ranker = fetch_macos.MirrorRanker([mirror.base], cache_path, ttl=60)
+    assert ranker.rank(url)[0] == mirror.base
+    assert mirror.requests == probes + 1
+    # other mirrors are ranked afresh
+    fetch_macos.MirrorRanker([mirror.base, dead_mirror()], cache_path, ttl=60).rank(url)
+    assert mirror.requests == probes + 2
+
+
+class FakeClock(object):
+    '''Stands in for the time module: sleeping moves the clock on'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_bandwidth_is_a_token_bucket(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(fetch_macos, 'time', clock)
+    rate = 1024 * 1024
+    limits = fetch_macos.TransferLimits(bytes_per_second=rate)
+    chunk = fetch_macos.READ_CHUNK_SIZE
+
+    start = clock.now
+    for _ in range(40):
+        limits.throttle(chunk)
+    # 10 MiB at 1 MiB/s, less the quarter second of burst
+    assert clock.now - start == pytest.approx(40 * chunk / float(rate) - 0.25)
+
+    # idle time refills the burst, but no more than it
+    clock.now += 60
+    start = clock.now
+    limits.throttle(chunk)
+    assert clock.now == start
+    limits.throttle(chunk)
+    assert clock.now - start == pytest.approx(chunk / float(rate))
+
+    unlimited = fetch_macos.TransferLimits()
+    start = clock.now
+    unlimited.throttle(100 * rate)
+    assert clock.now == start
+
+
+def test_free_connections_go_to_the_highest_priority():
+    limits = fetch_macos.TransferLimits(connections=1)
+    order = []
+
+    def transfer(priority, name):
+        with limits.connection(priority):
+            order.append(name)
+
+    threads = []
+    with limits.connection():
+        for count, (priority, name) in enumerate([(0, 'low'), (5, 'first'), (1, 'middle'),
+                                                  (5, 'second')], 1):
+            thread = threading.Thread(target=transfer, args=(priority, name))
+            thread.start()
+            threads.append(thread)
+            deadline = time.time() + 5
+            while len(limits._waiting) < count and time.time() < deadline:
+                time.sleep(0.01)
+        assert not order
+    for thread in threads:
+        thread.join()
+
+    # equal priorities keep their order of arrival
+    assert order == ['first', 'second', 'middle', 'low']
+
+
+def test_connections_are_limited():
+    limits = fetch_macos.TransferLimits(connections=2)
+    active = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def transfer():
+        with limits.connection():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=transfer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+
+
+def test_catalog_index_is_revalidated(server, tmp_path):
+    catalog, files, installers = synthetic_files(server.base, 20, 4)
+    files['/index.sucatalog'] = catalog
+    server.files = files
+    url = server.base + '/index.sucatalog'
+    workdir = str(tmp_path / 'work')
+    cache_dir = str(tmp_path / 'cache')
+
+    def product_index(**kwargs):
+        requests = server.requests + server.not_modified
+        _, product_info = fetch_macos.get_product_index(url, workdir, cache_dir=cache_dir,
+                                                        **kwargs)
+        return ([info['version'] for info in product_info.values()],
+                server.requests + server.not_modified - requests)
+
+    versions = [version for _, version in installers]
+    # the catalog, and the metadata and .dist of each installer
+    assert product_index() == (versions, 1 + 2 * len(installers))
+    # within the ttl the index is used as it is
+    assert product_index() == (versions, 0)
+
+    # after it, an unchanged catalog is only revalidated
+    assert product_index(ttl=0) == (versions, 1)
+    assert server.not_modified == 1
+    index_path = fetch_macos.catalog_index_path(cache_dir, url)
+    index = fetch_macos.load_catalog_index(index_path)
+    # with If-Modified-Since, if that is all there is
+    fetch_macos.save_catalog_index(index_path, dict(index, etag=None))
+    assert product_index(ttl=0) == (versions, 1)
+    assert server.not_modified == 2
+
+    # a changed catalog is parsed again
+    catalog, files, installers = synthetic_files(server.base, 30, 6)
+    files['/index.sucatalog'] = catalog
+    server.files = files
+    server.modified += 10
+    versions = [version for _, version in installers]
+    assert product_index(ttl=0)[0] == versions
+    assert server.not_modified == 2
+
+    # --ignore-cache fetches everything again
+    assert product_index(ignore_cache=True) == (versions, 1 + 2 * len(installers))
+    assert server.not_modified == 2
+
+
+def test_telemetry_records_verify_failures_and_retries(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_macos, 'DOWNLOAD_RETRIES', 2)
+    monkeypatch.setattr(fetch_macos.time, 'sleep', lambda seconds: None)
+    events_path = str(tmp_path / 'events.jsonl')
+    prometheus_path = str(tmp_path / 'fetch_macos.prom')
+    telemetry = fetch_macos.Telemetry(events_path, prometheus_path)
+    monkeypatch.setattr(fetch_macos, 'telemetry', telemetry)
+    data = blob(PACKAGE_SIZE)
+    chunklist = fetch_macos.ChunkList.parse(chunklist_bytes(data, SEGMENT_SIZE))
+    tampered = bytearray(data)
+    tampered[5 * SEGMENT_SIZE + 100] ^= 0xff
+    server.files['/BaseSystem.dmg'] = bytes(tampered)
+
+    with pytest.raises(fetch_macos.ReplicationError):
+        fetch_macos.download_file(server.base + '/BaseSystem.dmg',
+                                  str(tmp_path / 'BaseSystem.dmg'),
+                                  chunklist=chunklist, segments=4)
+    with pytest.raises(fetch_macos.IntegrityError):
+        fetch_macos.download_file(server.base + '/InstallESDDmg.pkg',
+                                  str(tmp_path / 'InstallESDDmg.pkg'), digest='0' * 64)
+    telemetry.close()
+
+    with open(events_path) as the_file:
+        events = [json.loads(line) for line in the_file]
+    failures = [event for event in events if event['event'] == 'verify_failed']
+    # the bad chunk on both attempts, then the whole-file digest
+    assert [event['check'] for event in failures] == ['chunk', 'chunk', 'digest']
+    assert 'Chunk 5' in failures[0]['error']
+    assert failures[2]['url'] == server.base + '/InstallESDDmg.pkg'
+    retries = [event for event in events if event['event'] == 'retry']
+    assert len(retries) == 1 and retries[0]['attempt'] == 1
+
+    with open(prometheus_path) as the_file:
+        metrics = dict(line.rsplit(' ', 1) for line in the_file.read().splitlines())
+    assert float(metrics['fetch_macos_verify_failures_total{check="chunk"}']) == 2
+    assert float(metrics['fetch_macos_verify_failures_total{check="digest"}']) == 1
+    assert float(metrics['fetch_macos_retries_total']) == 1
+    # neither download completed
+    assert 'fetch_macos_downloads_total' not in metrics
+
+
+def installer_info(*versions):
+    return dict(('%03d-%05d' % (index, index), {
+        'version': version,
+        'title': 'macOS',
+        'BUILD': '%dA%d' % (20 + index, index),
+        'PostDate': datetime.datetime(2024, 1, 1 + index),
+    }) for index, version in enumerate(versions))
+
+
+def test_version_key_is_numeric():
+    versions = ['10.10.8', None, '11.0', '10.10.75', '10.9', '10.10', '10.15.7', 'beta']
+    assert sorted(versions, key=fetch_macos.version_key) == [
+        None, 'beta', '10.9', '10.10', '10.10.8', '10.10.75', '10.15.7', '11.0']
+    assert fetch_macos.version_key('13.6.1 (b)') == (13, 6, 1)
+
+
+def test_partial_versions_resolve_to_the_highest():
+    product_info = installer_info('10.10.8', '10.10.75', '10.1', '11.0', None, '10.10.75')
+
+    def resolve(version):
+        return fetch_macos.resolve_version(version, product_info)
+
+    assert resolve('10.10.8') == '000-00000'
+    # the newest post of equal versions
+    assert resolve('10.10.75') == '005-00005'
+    assert resolve('10.10') == '005-00005'
+    # 10.1 is a version of its own, not a prefix of 10.10
+    assert resolve('10.1') == '002-00002'
+    assert resolve('10') == '005-00005'
+    assert resolve('latest') == '003-00003'
+    assert resolve('12') is None
+    assert resolve('sonoma') is None
+
+
+def test_list_json(monkeypatch, tmp_path, capsys):
+    product_info = installer_info('10.15.7', '10.9.5', '10.15.7')
+    product_info['000-00000']['seeds'] = ['PublicRelease', 'DeveloperSeed']
+    monkeypatch.setattr(fetch_macos, 'get_merged_product_index',
+                        lambda seeds, workdir, **kwargs: ({'Products': {}}, product_info))
+
+    def main(*argv):
+        fetch_macos.main(list(argv) + ['--workdir', str(tmp_path)])
+        return json.loads(capsys.readouterr().out)
+
+    installers = main('--list', '--json')
+    assert [(installer['product_id'], installer['version']) for installer in installers] == [
+        ('001-00001', '10.9.5'), ('000-00000', '10.15.7'), ('002-00002', '10.15.7')]
+    assert installers[1] == {'product_id': '000-00000', 'version': '10.15.7',
+                             'build': '20A0', 'title': 'macOS',
+                             'post_date': '2024-01-01T00:00:00',
+                             'seeds': ['PublicRelease', 'DeveloperSeed']}
+    assert main('--resolve', '10.15', '--json')['product_id'] == '002-00002'
+
+
+def test_menu_needs_a_terminal(monkeypatch, capsys):
+    monkeypatch.setattr(fetch_macos.sys, 'stdin', io.StringIO('1\n'))
+    with pytest.raises(SystemExit) as exit_info:
+        fetch_macos.determine_version(None, installer_info('10.15.7'))
+    assert exit_info.value.code == 1
+    error = capsys.readouterr().err
+    assert '--version' in error and '--resolve' in error
@@ -0,0 +1,102 @@
+'''test_generate_unique_machine_values.py
+Renders the custom master plists with
+custom/generate_unique_machine_values.py and checks the escaping of the
+values put in, the placeholders left in comments, and the validation of
+the rendered plists.
+
+Usage: python -m pytest tests/test_generate_unique_machine_values.py'''
+
+import os
+import sys
+import base64
+import plistlib
+import importlib
+
+import pytest
+
+CUSTOM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'custom')
+sys.path.insert(0, CUSTOM_DIR)
+generate = importlib.import_module('generate_unique_machine_values')
+
+
+def row(serial='C02XL0GYJG5J', **values):
+    return dict({
+        'DEVICE_MODEL': 'iMacPro1,1',
+        'SERIAL': serial,
+        'BOARD_SERIAL': 'C02948201J9JG36A8',
+        'UUID': '007076A6-F2A2-4461-BBE5-BAD019F8025A',
+        'MAC_ADDRESS': 'A8:5C:2C:9A:46:2F',
+        'WIDTH': '1920',
+        'HEIGHT': '1080',
+        'KERNEL_ARGS': '',
+    }, **values)
+
+
+@pytest.fixture
+def template():
+    with open(os.path.join(CUSTOM_DIR, 'config-nopicker-custom.plist')) as the_file:
+        return generate.PlistTemplate(the_file.read())
+
+
+def parse(text):
+    return plistlib.loads(text[text.find('<?xml'):].encode('utf-8'))
+
+
+def test_render_fills_every_placeholder(template):
+    text = template.render(row())
+    config = parse(text)
+
+    generic = config['PlatformInfo']['Generic']
+    assert generic['SystemProductName'] == 'iMacPro1,1'
+    assert generic['SystemSerialNumber'] == 'C02XL0GYJG5J'
+    assert generic['MLB'] == 'C02948201J9JG36A8'
+    assert generic['SystemUUID'] == '007076A6-F2A2-4461-BBE5-BAD019F8025A'
+    # as with the shell script, the MAC address goes into <data> as it is
+    assert generic['ROM'] == base64.b64decode('a85c2c9a462f')
+    # the header comment describing the placeholders is left alone
+    assert '{{SERIAL}}' in text.splitlines()[1]
+    assert '{{' not in text[text.find('<?xml'):]
+
+
+def test_render_escapes_values(template):
+    kernel_args = 'amfi_get_out_of_my_way=0x1 -lilubetaall <&> "quoted"'
+    config = parse(template.render(row(KERNEL_ARGS=kernel_args)))
+
+    boot_args = config['NVRAM']['Add']['7C436110-AB2A-4BBB-A880-FE41995C9F82']['boot-args']
+    assert boot_args.endswith(kernel_args)
+
+
+def test_validate_plist():
+    generate.validate_plist('<!-- {{SERIAL}} -->\n' + plistlib.dumps({'a': 1}).decode())
+    with pytest.raises(ValueError):
+        generate.validate_plist('<?xml version="1.0"?><plist><dict><key>a</key></plist>')
+
+
+def test_broken_template_gives_one_error(tmp_path):
+    template = generate.PlistTemplate('<?xml version="1.0"?>\n<plist version="1.0">'
+                                      '<dict><key>{{SERIAL}}</key><string></dict></plist>')
+    items = [(str(tmp_path / ('%d.plist' % index)), row('SERIAL%d' % index))
+             for index in range(20)]
+
+    errors = generate.render_plists(template, items, jobs=1)
+    assert len(errors) == 1 and errors[0].startswith('Invalid plist for SERIAL0')
+    assert not os.listdir(str(tmp_path))
+
+
+def test_render_plists_in_workers(template, tmp_path):
+    items = [(str(tmp_path / ('%d.plist' % index)), row('SERIAL%02d' % index))
+             for index in range(generate.PARALLEL_PLISTS + 4)]
+
+    assert generate.render_plists(template, items, jobs=2) == []
+    for path, values in items:
+        with open(path) as the_file:
+            assert parse(the_file.read())['PlatformInfo']['Generic'][
+                'SystemSerialNumber'] == values['SERIAL']
+
+
+def test_missing_master_plist_exits(tmp_path, capsys):
+    args = generate.parse_args(['--master-plist', str(tmp_path / 'missing.plist')])
+    with pytest.raises(SystemExit) as exit_info:
+        generate.master_plist(args)
+    assert exit_info.value.code == 1
+    assert 'Could not find' in capsys.readouterr().err
@@ -0,0 +1,207 @@
+'''test_image_store.py
+Checks scripts/image_store.py with a stub qemu-img on the PATH: one
+conversion per source, ref expiry, the digest cache and its lock, and
+the exit codes of prepare for a missing ref and an existing disk.
+
+Usage: python -m pytest tests/test_image_store.py'''
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scripts'))
+image_store = importlib.import_module('image_store')
+
+# convert copies the source, create writes a qcow2 magic followed by the
+# backing file, and info reports it back; every call is logged
+QEMU_IMG = '''#!%s
+import json, os, shutil, sys
+args = sys.argv[1:]
+with open(os.environ['QEMU_IMG_LOG'], 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+if args[0] == 'convert':
+    shutil.copyfile(args[1], args[-1])
+elif args[0] == 'create':
+    with open(args[-1], 'wb') as f:
+        f.write(b'QFI\\xfb' + args[args.index('-b') + 1].encode())
+elif args[0] == 'info':
+    with open(args[-1], 'rb') as f:
+        backing = f.read()[4:].decode()
+    print(json.dumps({'backing-filename': backing} if backing else {}))
+'''
+
+
+@pytest.fixture
+def qemu_img(tmp_path, monkeypatch):
+    '''The logged qemu-img calls, as a function'''
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'qemu-img'
+    stub.write_text(QEMU_IMG % sys.executable)
+    stub.chmod(0o755)
+    log = tmp_path / 'qemu-img.log'
+    log.write_text('')
+    monkeypatch.setenv('PATH', '%s%s%s' % (bin_dir, os.pathsep, os.environ['PATH']))
+    monkeypatch.setenv('QEMU_IMG_LOG', str(log))
+    return lambda: [json.loads(line) for line in log.read_text().splitlines()]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return image_store.ImageStore(str(tmp_path / 'store'))
+
+
+def run_main(monkeypatch, store, *args):
+    monkeypatch.setattr(sys, 'argv', ['image_store.py', '--store', store.path] + list(args))
+    try:
+        image_store.main()
+    except SystemExit as err:
+        return err.code
+    return 0
+
+
+def test_prepare_converts_each_source_once(store, qemu_img, tmp_path):
+    source = tmp_path / 'BaseSystem.dmg'
+    source.write_bytes(b'dmg')
+
+    key, image = store.prepare(str(source), 'qcow2', True)
+    assert store.prepare(str(source), 'qcow2', True) == (key, image)
+    assert [call[0] for call in qemu_img()] == ['convert']
+    assert '-c' in qemu_img()[0]
+    assert os.stat(image).st_mode & 0o777 == 0o444
+    # other parameters are another entry
+    assert store.prepare(str(source), 'raw', False)[0] != key
+
+
+def test_ref_expires_after_its_ttl(store, qemu_img, tmp_path):
+    source = tmp_path / 'BaseSystem.dmg'
+    source.write_bytes(b'dmg')
+    key, image = store.prepare(str(source))
+    store.set_ref('sonoma-qcow2', key)
+
+    assert store.resolve('sonoma-qcow2', ttl=60) == image
+    with open(os.path.join(store.path, 'refs', 'sonoma-qcow2'), 'w') as f:
+        f.write('%s %d\n' % (key, time.time() - 120))
+    assert store.resolve('sonoma-qcow2', ttl=60) is None
+    assert store.resolve('sonoma-qcow2', ttl=None) == image
+    # refs written before they had a time are due at once
+    with open(os.path.join(store.path, 'refs', 'sonoma-qcow2'), 'w') as f:
+        f.write(key + '\n')
+    assert store.resolve('sonoma-qcow2', ttl=60) is None
+    assert store.resolve('sequoia-qcow2') is None
+
+
+def test_source_digest_is_cached_by_stamp(store, tmp_path):
+    source = tmp_path / 'disk.img'
+    source.write_bytes(b'a' * 100)
+    digest = store.source_digest(str(source))
+    stat = os.stat(str(source))
+
+    # same size and mtime: the cached digest is trusted
+    source.write_bytes(b'b' * 100)
+    os.utime(str(source), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert store.source_digest(str(source)) == digest
+
+    os.utime(str(source), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert store.source_digest(str(source)) != digest
+
+
+def test_source_digests_are_merged_under_the_lock(store, tmp_path):
+    first = tmp_path / 'first.img'
+    first.write_bytes(b'first')
+    second = tmp_path / 'second.img'
+    second.write_bytes(b'second')
+    store.source_digest(str(first))
+
+    fd = store._lock(os.path.join(store.path, 'digests.lock'))
+    thread = threading.Thread(target=store.source_digest, args=(str(second),))
+    try:
+        thread.start()
+        thread.join(0.3)
+        # hashed, but waiting to write digests.json
+        assert thread.is_alive()
+    finally:
+        store._unlock(fd)
+    thread.join()
+
+    with open(os.path.join(store.path, 'digests.json')) as f:
+        digests = json.load(f)
+    assert sorted(digests) == sorted([os.path.realpath(str(first)),
+                                      os.path.realpath(str(second))])
+
+
+def test_prepare_exits_3_without_the_ref(store, qemu_img, tmp_path, monkeypatch):
+    output = str(tmp_path / 'BaseSystem.img')
+    assert run_main(monkeypatch, store, 'prepare', '--ref', 'sonoma', '--compress',
+                    '--output', output) == image_store.NOT_IN_STORE
+    assert not os.path.exists(output)
+
+    source = tmp_path / 'BaseSystem.dmg'
+    source.write_bytes(b'dmg')
+    assert run_main(monkeypatch, store, 'prepare', '--source', str(source), '--ref', 'sonoma',
+                    '--compress', '--output', output) == 0
+    os.remove(output)
+    # the source is gone now, and the ref stands in for it
+    source.unlink()
+    assert run_main(monkeypatch, store, 'prepare', '--source', str(source), '--ref', 'sonoma',
+                    '--compress', '--output', output) == 0
+    assert store.is_overlay(output)
+    os.remove(output)
+    assert run_main(monkeypatch, store, 'prepare', '--ref', 'sonoma', '--ref-ttl', '-1',
+                    '--compress', '--output', output) == image_store.NOT_IN_STORE
+    # another format is another ref
+    assert run_main(monkeypatch, store, 'prepare', '--ref', 'sonoma',
+                    '--output', output) == image_store.NOT_IN_STORE
+
+
+def test_prepare_keeps_an_existing_disk(store, qemu_img, tmp_path, monkeypatch):
+    base = tmp_path / 'base.img'
+    base.write_bytes(b'base disk')
+    disk = tmp_path / 'mac_hdd_ng.img'
+    disk.write_bytes(b'QFI\xfb')
+
+    assert run_main(monkeypatch, store, 'prepare', '--source', str(base), '--format', 'source',
+                    '--keep-existing', '--output', str(disk)) == image_store.KEPT_EXISTING
+    assert disk.read_bytes() == b'QFI\xfb'
+    assert not [call for call in qemu_img() if call[0] != 'info']
+    # without --keep-existing it is an error
+    assert run_main(monkeypatch, store, 'prepare', '--source', str(base), '--format', 'source',
+                    '--output', str(disk)) == 1
+
+    # a new disk becomes an overlay, which a restart keeps
+    disk.unlink()
+    assert run_main(monkeypatch, store, 'prepare', '--source', str(base), '--format', 'source',
+                    '--keep-existing', '--output', str(disk)) == 0
+    overlay = disk.read_bytes()
+    assert store.is_overlay(str(disk))
+    assert run_main(monkeypatch, store, 'prepare', '--source', str(base), '--format', 'source',
+                    '--keep-existing', '--output', str(disk)) == 0
+    assert disk.read_bytes() == overlay
+    assert [call[0] for call in qemu_img()].count('create') == 1
+
+
+@pytest.mark.parametrize('existing, image_format', [(False, 'qcow2'), (True, 'raw')])
+def test_prepare_images_sh(store, qemu_img, tmp_path, existing, image_format):
+    base = tmp_path / 'base.img'
+    base.write_bytes(b'base disk')
+    (tmp_path / 'BaseSystem.img').write_bytes(b'installer')
+    disk = tmp_path / 'mac_hdd_ng.img'
+    if existing:
+        # as built into the auto images
+        disk.write_bytes(b'preinstalled')
+    script = os.path.join(os.path.dirname(image_store.__file__), 'prepare_images.sh')
+    env = dict(os.environ, IMAGE_STORE=store.path, IMAGE_BASE=str(base),
+               IMAGE_PATH=str(disk), IMAGE_FORMAT='raw', SHORTNAME='sonoma')
+
+    shown = subprocess.run(['bash', '-c', 'source "$0" && echo "IMAGE_FORMAT=${IMAGE_FORMAT}"',
+                            script], cwd=str(tmp_path), env=env, check=True,
+                           stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert shown.splitlines()[-1] == 'IMAGE_FORMAT=' + image_format
+    assert store.is_overlay(str(disk)) != existing
@@ -0,0 +1,142 @@
+'''test_launch_profile.py
+Checks the QEMU command lines scripts/launch_profile.py --dry-run builds
+for the compat and tuned profiles, against a fake /proc and /sys.
+
+Usage: python -m pytest tests/test_launch_profile.py'''
+
+import os
+import sys
+import json
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scripts'))
+launch_profile = importlib.import_module('launch_profile')
+
+ENVIRONMENT = ('LAUNCH_PROFILE', 'RAM', 'SMP', 'CORES', 'CPU_STRING', 'CPU_PINNING',
+               'HUGEPAGES', 'DISK_AIO', 'DISK_CACHE', 'DISK_BUS', 'NETWORK_BACKEND',
+               'NETWORKING', 'NET_QUEUES', 'TAP_DEVICE', 'EXTRA', 'IMAGE_PATH', 'BOOTDISK')
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as the_file:
+        the_file.write(text + '\n')
+
+
+@pytest.fixture
+def sysroot(tmp_path):
+    '''One NUMA node with 4 cores of 2 threads, CPU n and n + 4 being
+    siblings, 8 GB of memory and 1024 free 2M hugepages'''
+    root = str(tmp_path)
+    write(os.path.join(root, 'proc/meminfo'), 'MemTotal:        8000000 kB')
+    cpu_dir = os.path.join(root, 'sys/devices/system/cpu')
+    write(os.path.join(cpu_dir, 'online'), '0-7')
+    for cpu in range(8):
+        write(os.path.join(cpu_dir, 'cpu%d/topology/core_id' % cpu), str(cpu % 4))
+        write(os.path.join(cpu_dir, 'cpu%d/topology/physical_package_id' % cpu), '0')
+    write(os.path.join(root, 'sys/devices/system/node/node0/cpulist'), '0-7')
+    write(os.path.join(root, 'sys/kernel/mm/hugepages/hugepages-2048kB/free_hugepages'), '1024')
+    return root
+
+
+def dry_run(monkeypatch, capsys, sysroot, **env):
+    for name in ENVIRONMENT:
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(launch_profile, 'io_uring_available', lambda: True)
+    monkeypatch.setattr(sys, 'argv', ['launch_profile.py', '--dry-run', '--json',
+                                      '--sysroot', sysroot])
+    launch_profile.main()
+    return json.loads(capsys.readouterr().out)
+
+
+def option(argv, name):
+    '''The values given to every name option in argv'''
+    return [argv[index + 1] for index, arg in enumerate(argv[:-1]) if arg == name]
+
+
+def test_compat_profile_matches_launch_sh(monkeypatch, capsys, sysroot):
+    plan = dry_run(monkeypatch, capsys, sysroot, RAM='2.5', SMP='4', CORES='2')
+    argv = plan['argv']
+
+    assert argv[0] == 'qemu-system-x86_64'
+    assert option(argv, '-m') == ['2500']
+    assert option(argv, '-smp') == ['4,cores=2']
+    assert option(argv, '-machine') == ['q35,accel=kvm:tcg']
+    assert '-object' not in argv
+    assert plan['pinning'] is None
+    drives = option(argv, '-drive')
+    assert [drive.split(',')[0] for drive in drives[2:]] == [
+        'id=OpenCoreBoot', 'id=InstallMedia', 'id=MacHDD']
+    assert not [drive for drive in drives if 'aio=' in drive or 'cache=' in drive]
+    assert option(argv, '-netdev') == [
+        'user,id=net0,hostfwd=tcp::10022-:22,hostfwd=tcp::5900-:5900']
+
+
+def test_compat_profile_resolves_half_the_memory(monkeypatch, capsys, sysroot):
+    plan = dry_run(monkeypatch, capsys, sysroot, RAM='half')
+    assert option(plan['argv'], '-m') == ['4000']
+
+
+@pytest.mark.parametrize('cpu_string, vcpus', [
+    ('8,sockets=1,cores=4,threads=2', 8),
+    ('cpus=6,sockets=1,cores=6', 6),
+    ('sockets=1,cores=2,threads=2', 4),
+    ('maxcpus=2', 2),
+])
+def test_cpu_string_is_passed_through(monkeypatch, capsys, sysroot, cpu_string, vcpus):
+    plan = dry_run(monkeypatch, capsys, sysroot, CPU_STRING=cpu_string,
+                   NETWORK_BACKEND='tap', NETWORKING='virtio-net-pci')
+    argv = plan['argv']
+
+    assert option(argv, '-smp') == [cpu_string]
+    # one queue per vCPU
+    assert option(argv, '-netdev') == ['tap,id=net0,ifname=tap0,script=no,downscript=no,'
+                                       'queues=%d' % vcpus]
+    assert 'mq=on,vectors=%d' % (2 * vcpus + 2) in option(argv, '-device')[-1]
+
+
+def test_unreadable_cpu_string_is_refused(monkeypatch, capsys, sysroot):
+    with pytest.raises(SystemExit) as error:
+        dry_run(monkeypatch, capsys, sysroot, CPU_STRING='cores=four')
+    assert 'vCPU count' in str(error.value)
+
+
+def test_tuned_profile(monkeypatch, capsys, sysroot):
+    plan = dry_run(monkeypatch, capsys, sysroot, LAUNCH_PROFILE='tuned', RAM='2',
+                   CPU_STRING='sockets=1,cores=2,threads=2', DISK_BUS='virtio')
+    argv = plan['argv']
+
+    # one thread per physical core first, leaving the first core to the host
+    assert plan['pinning'] == [1, 2, 3, 5]
+    assert plan['housekeeping'] == [0, 4, 6, 7]
+    assert option(argv, '-m') == ['2000']
+    assert option(argv, '-object')[0] == ('memory-backend-memfd,id=mem0,size=2000M,'
+                                          'hugetlb=on,hugetlbsize=2M,prealloc=on')
+    assert option(argv, '-machine') == ['q35,accel=kvm:tcg,memory-backend=mem0']
+    assert option(argv, '-smp') == ['sockets=1,cores=2,threads=2']
+    drives = [drive for drive in option(argv, '-drive') if drive.startswith(
+        ('id=InstallMedia', 'id=MacHDD'))]
+    assert len(drives) == 2 and all(drive.endswith(',aio=io_uring') for drive in drives)
+    assert option(argv, '-object')[1:] == ['iothread,id=io0', 'iothread,id=io1']
+    assert 'virtio-blk-pci,drive=MacHDD,iothread=io1' in option(argv, '-device')
+
+
+def test_tuned_profile_without_enough_hugepages(monkeypatch, capsys, sysroot):
+    plan = dry_run(monkeypatch, capsys, sysroot, LAUNCH_PROFILE='tuned', RAM='4', SMP='2')
+
+    assert 'not enough free hugepages for 4000 MB' in plan['notes']
+    assert '-object' not in plan['argv']
+    assert plan['pinning'] == [1, 2]
+
+
+def test_native_aio_needs_direct_io(monkeypatch, capsys, sysroot):
+    plan = dry_run(monkeypatch, capsys, sysroot, DISK_AIO='native')
+    assert option(plan['argv'], '-drive')[-1].endswith(',cache=none,aio=native')
+
+    with pytest.raises(SystemExit):
+        dry_run(monkeypatch, capsys, sysroot, DISK_AIO='native', DISK_CACHE='writeback')
@@ -0,0 +1,117 @@
+'''test_validate_kernel_patches.py
+Checks scripts/validate_kernel_patches.py against small synthetic kernels:
+masks, Skip and Count, Limit, Base and missing patterns.
+
+Usage: python -m pytest tests/test_validate_kernel_patches.py'''
+
+import os
+import sys
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scripts'))
+validate_kernel_patches = importlib.import_module('validate_kernel_patches')
+
+KERNEL = (b'\x00' * 16 + b'hibernatehidready\x00' + b'\x90' * 8 +
+          b'\x48\x89\xe5\x41' + b'\x90' * 8 + b'\x48\x89\xe5\x42' + b'\x90' * 8 +
+          b'\x48\x89\xe5\x43')
+
+
+def patch(find, **fields):
+    return dict(fields, Comment=fields.get('Comment', find.hex()), Find=find)
+
+
+def statuses(patches, data=KERNEL):
+    return [result['status'] for result in validate_kernel_patches.scan(data, patches)]
+
+
+def test_exact_and_missing():
+    results = validate_kernel_patches.scan(KERNEL, [patch(b'hibernatehidready'),
+                                                    patch(b'hv_vmm_present')])
+    assert [result['status'] for result in results] == ['ok', 'missing']
+    assert results[0]['offsets'] == [16]
+    assert results[1]['matches'] == 0
+
+
+def test_mask():
+    # the low nibble of the last byte is ignored
+    masked = patch(b'\x48\x89\xe5\x40', Mask=b'\xff\xff\xff\xf0')
+    results = validate_kernel_patches.scan(KERNEL, [masked, patch(b'\x48\x89\xe5\x40')])
+    assert results[0]['matches'] == 3
+    assert results[1]['status'] == 'missing'
+
+    with pytest.raises(ValueError):
+        validate_kernel_patches.scan(KERNEL, [patch(b'\x48\x89', Mask=b'\xff')])
+
+
+def test_skip_and_count():
+    prologue = b'\x48\x89\xe5'
+    assert statuses([patch(prologue, Count=3),
+                     patch(prologue, Skip=2, Count=1),
+                     patch(prologue, Skip=2, Count=2),
+                     patch(prologue, Count=1),
+                     patch(prologue, Skip=3)]) == ['ok', 'ok', 'short', 'extra', 'short']
+
+
+def test_limit_counts_from_the_start():
+    prologue = b'\x48\x89\xe5'
+    first = KERNEL.index(prologue)
+    results = validate_kernel_patches.scan(KERNEL, [
+        patch(prologue, Limit=first + 3),
+        patch(prologue, Limit=first + 2),
+    ])
+    assert [result['matches'] for result in results] == [1, 0]
+    assert [result['status'] for result in results] == ['ok', 'missing']
+
+
+def test_base_is_not_claimed_ok_or_missing():
+    results = validate_kernel_patches.scan(KERNEL, [
+        patch(b'\x48\x89\xe5', Base='_hv_vmm_present', Count=1, Limit=4),
+        patch(b'hv_vmm_present', Base='_hv_vmm_present'),
+    ])
+    assert [result['status'] for result in results] == ['unchecked', 'unchecked']
+    assert results[0]['base'] == '_hv_vmm_present'
+
+
+def test_patch_selection(monkeypatch):
+    patches = [patch(b'one', Identifier='kernel'),
+               patch(b'two', Identifier='kernel', Enabled=False),
+               patch(b'three', Identifier='com.apple.driver.AppleHDA'),
+               patch(b'four', Identifier='kernel', MinKernel='23.0.0')]
+    monkeypatch.setitem(validate_kernel_patches.SONOMA_BT_PATCH_SET['Kernel'], 'Patch',
+                        patches)
+
+    def pick(**kwargs):
+        return [entry['Find'] for entry in validate_kernel_patches.kernel_patches(None, **kwargs)]
+
+    assert pick() == [b'one', b'four']
+    assert pick(include_all=True) == [b'one', b'three', b'four']
+    assert pick(kernel_version='22.6.0') == [b'one']
+
+
+def test_validate_kernel_files(tmp_path):
+    kernel = tmp_path / 'kernel'
+    kernel.write_bytes(KERNEL)
+    empty = tmp_path / 'empty'
+    empty.write_bytes(b'')
+    patches = [patch(b'hibernatehidready')]
+
+    assert validate_kernel_patches.validate_kernel(str(kernel), patches)['patches'][0][
+        'status'] == 'ok'
+    assert validate_kernel_patches.validate_kernel(str(empty), patches)['patches'][0][
+        'status'] == 'missing'
+    assert 'error' in validate_kernel_patches._validate_kernel(
+        (str(tmp_path / 'nonexistent'), patches))
+
+
+def test_missing_patch_file_exits_with_a_message(tmp_path, monkeypatch, capsys):
+    kernel = tmp_path / 'kernel'
+    kernel.write_bytes(KERNEL)
+    monkeypatch.setattr(sys, 'argv', ['validate_kernel_patches.py', '--patches',
+                                      str(tmp_path / 'config.plist'), str(kernel)])
+    with pytest.raises(SystemExit) as exit_info:
+        validate_kernel_patches.main()
+    assert exit_info.value.code == 1
+    assert 'Could not read' in capsys.readouterr().out